@@ -1,5 +1,11 @@
+import os
+
 import tiktoken
 
+# Provider-sized embedding batches: at most this many chunks and tokens per embedding request
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", 64))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 16000))
+
 
 class ProcessorUtils:
 	@staticmethod
@@ -27,3 +33,27 @@ class ProcessorUtils:
 		encoding = tiktoken.get_encoding(encoding_name)
 		num_tokens = len(encoding.encode(string))
 		return num_tokens
+
+	@staticmethod
+	def batch_texts(
+		texts: list[str],
+		max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+		max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS
+	) -> list[tuple[int, int, int]]:
+		"""Group consecutive texts into batches limited by item count and token count.
+
+		Returns a list of (start, end, tokens) tuples, `texts[start:end]` being a batch of `tokens` tokens.
+		A single text longer than `max_tokens` gets a batch of its own.
+		"""
+		encoding = tiktoken.get_encoding('cl100k_base')
+		batches = []
+		start, tokens = 0, 0
+		for i, text in enumerate(texts):
+			text_tokens = len(encoding.encode(text))
+			if i > start and (i - start >= max_items or tokens + text_tokens > max_tokens):
+				batches.append((start, i, tokens))
+				start, tokens = i, 0
+			tokens += text_tokens
+		if start < len(texts):
+			batches.append((start, len(texts), tokens))
+		return batches
@@ -8,10 +8,10 @@ from typing import List
 
 from fastapi import UploadFile
 from langchain.docstore.document import Document
-from langchain_community.vectorstores.faiss import FAISS
 
 from background.processor_context import ProcessorContext, DOCS_TYPE
 from db import models, crud_vectordocrecord
+from factory.embedding_scheduler import embedding_scheduler
 from log import log
 
 
@@ -23,6 +23,7 @@ class BlackHole:
 		self.knowledge_base_id = None
 		self.raw_filename = None
 		self.processor_context = ProcessorContext(bot)
+		self.last_ingestion_stats = None
 
 	def save_uploaded_file_to_path(self, file: UploadFile, filename: str = None):
 		if filename is None:
@@ -110,35 +111,53 @@ class BlackHole:
 		:return: a list of document ids
 		"""
 		log(f"Preparing to memorize {len(docs)} vectors")
-		faiss_db: FAISS = self.bot.memory.vectors.faiss_db(self.knowledge_base_id, folder_path)
-		doc_ids = []
+		started_at = time.time()
 
-		# classic embed
+		# run the insert hook on every chunk, keeping only the non-empty ones
+		chunks = []
 		for d, doc in enumerate(docs):
 			doc.metadata["source"] = source
 			doc.metadata["when"] = time.time()
 			doc = self.bot.mad_hatter.execute_hook(
 				"before_blackhole_insert_memory", doc
 			)
-			inserting_info = f"{d + 1}/{len(docs)}):\nPage content: {doc.page_content}\nMetadata: {doc.metadata}"
 			if doc.page_content != "":
-				ids = faiss_db.add_texts(
-					[doc.page_content],
-					[doc.metadata],
-				)
-
-				log(f"doc id: {ids[0]}")
-				doc_ids.append(ids[0])
-				log(f"Inserted into memory({inserting_info})\n")
+				# order of the chunk in its source, to recall it with its neighbours
+				doc.metadata["ordinal"] = len(chunks)
+				chunks.append(doc)
 			else:
-				log(f"Skipped memory insertion of empty doc ({inserting_info})")
+				log(f"Skipped memory insertion of empty doc ({d + 1}/{len(docs)}):\nMetadata: {doc.metadata}")
 
-			# wait a little to avoid APIs rate limit errors
-			time.sleep(0.1)
-
-		# save to disk
-		log("Save the vector store embeddings to disk")
-		faiss_db.save_local(folder_path, self.knowledge_base_id)
+		# embed chunks in provider-sized batches, several in flight at once within the embedder rate limits,
+		# with one index insertion per batch
+		# batches are appended to the index mutation log as they come, and applied together once all succeeded:
+		# a file failing half way leaves the index untouched
+		texts = [doc.page_content for doc in chunks]
+		doc_ids = []
+		total_tokens = 0
+		with self.bot.memory.vectors.transaction(self.knowledge_base_id, folder_path) as transaction:
+			for start, end, tokens, embeddings in embedding_scheduler.embed_batches(self.bot.embedder, texts):
+				ids = transaction.add_embeddings(
+					list(zip(texts[start:end], embeddings)),
+					[doc.metadata for doc in chunks[start:end]],
+				)
+				doc_ids += ids
+				total_tokens += tokens
+				log(f"Inserted chunks {start + 1}-{end}/{len(chunks)} into memory ({tokens} tokens)")
+
+		elapsed = max(time.time() - started_at, 1e-6)
+		self.last_ingestion_stats = {
+			"chunks": len(doc_ids),
+			"tokens": total_tokens,
+			"seconds": elapsed,
+			"chunks_per_second": len(doc_ids) / elapsed,
+			"tokens_per_second": total_tokens / elapsed,
+		}
+		log(
+			f"Memorized {len(doc_ids)} chunks ({total_tokens} tokens) in {elapsed:.2f}s: "
+			f"{len(doc_ids) / elapsed:.1f} chunks/s, {total_tokens / elapsed:.1f} tokens/s",
+			'INFO'
+		)
 		log("Done uploading")
 		return doc_ids
 
@@ -1,10 +1,12 @@
+import asyncio
 import json
 import os
+import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from copy import deepcopy
 from dataclasses import asdict
-
-from langchain_community.vectorstores.faiss import FAISS
+from typing import AsyncIterator
 
 from black_hole import BlackHole
 from db.crud_user import redis_client
@@ -12,9 +14,47 @@ from db.database import create_db_and_tables, get_db_session
 from infrastructure.feishu import Feishu
 from log import log
 from looking_glass.agent_manager import AgentManager
+from looking_glass.chat_context import ChatContext
 from mad_hatter.mad_hatter import MadHatter
+from memory.embedding_cache import CachedEmbeddings
 from memory.long_term_memory import LongTermMemory
-from memory.working_memory import WorkingMemory
+
+# Recall of the memories: `vector`, `keyword` (BM25, without embedding the query) or `hybrid` (both rankings fused,
+# the vector hits passing the threshold only)
+RECALL_RETRIEVAL_MODE = os.getenv("RECALL_RETRIEVAL_MODE", "vector")
+# Chunks recalled with every declarative memory, before and after it in its source
+RECALL_NEIGHBOURS = int(os.getenv("RECALL_NEIGHBOURS", 0))
+# Memories recalled at the same time, over all the requests
+RECALL_THREADS = int(os.getenv("RECALL_THREADS", 8))
+
+recall_executor = ThreadPoolExecutor(max_workers=RECALL_THREADS, thread_name_prefix="recall")
+
+
+def default_recall_configs() -> tuple[dict, dict]:
+	"""Recall configs of the declarative and procedural memories, before the hooks change them."""
+	declarative_recall_config = {
+		"k": 2,
+		"threshold": 0.55,
+		"metadata": None,
+		"retrieval": RECALL_RETRIEVAL_MODE,
+		# off: a hook can pick the k memories among `fetch_k` candidates, skipping near-duplicate chunks
+		# (e.g. fetch_k 10, mmr_lambda 0.7), see `memory.rerank`
+		"rerank": {
+			"fetch_k": None,
+			"mmr_lambda": None,
+			"recency_boost": 0.0,
+			"source_boosts": {},
+		},
+		"neighbours": RECALL_NEIGHBOURS,
+	}
+
+	procedural_recall_config = {
+		"k": 2,
+		"threshold": 0.55,
+		"metadata": None,
+		"retrieval": RECALL_RETRIEVAL_MODE,
+	}
+	return declarative_recall_config, procedural_recall_config
 
 
 class DeepAI:
@@ -34,7 +74,6 @@ class DeepAI:
 		create_db_and_tables()
 		# access db from instance
 		self.db = get_db_session
-		self.email = None
 
 	def bootstrap(self):
 		self.upload_path = os.getenv("UPLOAD_FILE_PATH")
@@ -73,7 +112,7 @@ class DeepAI:
 	def load_natural_language(self):
 		# LLM and embedder
 		self.llm = self.mad_hatter.execute_hook("get_language_model", "gpt-3.5-turbo")
-		self.embedder = self.mad_hatter.execute_hook("get_language_embedder")
+		self.embedder = self.load_language_embedder()
 
 		# set the default prompt settings
 		self.default_prompt_settings = {
@@ -82,51 +121,123 @@ class DeepAI:
 			"use_procedural_memory": True,
 		}
 
-	def rebuild_llm_embedder(self, model_name: str):
-		self.llm = self.mad_hatter.execute_hook("get_language_model", model_name)
-		self.embedder = self.mad_hatter.execute_hook("get_language_embedder")
-		self.memory.vectors.refresh_embedder(self.embedder)
-
-		return self.llm, self.embedder
+	def language_model(self, model_name: str):
+		"""The LLM of a model, the one of the bot is not replaced."""
+		return self.mad_hatter.execute_hook("get_language_model", model_name)
+
+	def chat_context(self, knowledge_base_id, model_name: str | None = None, user=None) -> ChatContext:
+		"""
+		The state of a chat request, see `ChatContext`, with the LLM and embedder of a model when given, loaded with
+		the hooks of the plugins used by the knowledge base (the first one when several are searched).
+		"""
+		knowledge_base_id = knowledge_base_id[0] if isinstance(knowledge_base_id, list) else knowledge_base_id
+		context = ChatContext(self, knowledge_base_id, user=user)
+		if model_name is not None:
+			context.llm = context.mad_hatter.execute_hook("get_language_model", model_name)
+			# every embedder looks document texts up in the persistent embedding cache before calling the provider
+			context.embedder = CachedEmbeddings(context.mad_hatter.execute_hook("get_language_embedder"))
+		return context
+
+	def load_language_embedder(self):
+		# every embedder looks document texts up in the persistent embedding cache before calling the provider
+		return CachedEmbeddings(self.mad_hatter.execute_hook("get_language_embedder"))
 
 	def load_memory(self):
 		# Memory
 		vector_memory_config = {"bot": self, "verbose": False}
 		self.memory = LongTermMemory(vector_memory_config=vector_memory_config)
-		self.working_memory = WorkingMemory()
 
-	def recall_relevant_memories_to_working_memory(self, index_name, folder_path, refs_uuid: str):
-		user_message = self.working_memory["user_message_json"]["text"]
-		prompt_settings = self.working_memory["user_message_json"]["prompt_settings"]
+	def recall_relevant_memories_to_working_memory(
+		self, context: ChatContext, index_name: str | list[str], folder_path, refs_uuid: str
+	):
+		# several knowledge bases are searched together, e.g. the user's and the global ones
+		index_names = index_name if isinstance(index_name, list) else [index_name]
+		working_memory = context.working_memory
+		mad_hatter = context.mad_hatter
+		user_message = working_memory["user_message_json"]["text"]
 
 		# We may want to search in memory
-		memory_query_text = self.mad_hatter.execute_hook("bot_recall_query", user_message)
+		memory_query_text = mad_hatter.execute_hook("bot_recall_query", user_message)
 		log(f'Recall query: "{memory_query_text}"')
 
-		# Embed recall query
-		self.working_memory["memory_query"] = memory_query_text
+		working_memory["memory_query"] = memory_query_text
 
 		# hook to do something before recall begins
-		self.mad_hatter.execute_hook("before_bot_recalls_memories")
+		mad_hatter.execute_hook("before_bot_recalls_memories")
 
-		# Setting default recall configs for each memory
-		default_declarative_recall_config = {
-			"k": 2,
-			"threshold": 0.55,
-			"metadata": None,
-		}
+		# hooks to change recall configs for each memory
+		default_declarative_recall_config, default_procedural_recall_config = default_recall_configs()
+		recall_configs = [
+			mad_hatter.execute_hook("before_bot_recalls_declarative_memories", default_declarative_recall_config),
+			mad_hatter.execute_hook("before_bot_recalls_procedural_memories", default_procedural_recall_config)
+		]
+		memory_types, recalls, query_embedding = self.submit_recalls(
+			context, index_names, folder_path, recall_configs, memory_query_text
+		)
 
-		default_procedural_recall_config = {
-			"k": 2,
-			"threshold": 0.55,
-			"metadata": None,
-		}
+		# Embed recall query once, every memory is searched with the same vector
+		try:
+			if query_embedding is not None:
+				query_embedding.set_result(context.embedder.embed_query(memory_query_text))
+		except Exception as e:
+			query_embedding.set_exception(e)
+			raise
 
-		# hooks to change recall configs for each memory
+		results = {memory_type: recall.result() for memory_type, recall in recalls.items()}
+		refs = self.store_recalled_memories(context, memory_types, results, query_embedding)
+		self.store_refs(refs_uuid, refs)
+
+		# hook to modify/enrich retrieved memories
+		mad_hatter.execute_hook("after_bot_recalled_memories", memory_query_text)
+
+	async def arecall_relevant_memories_to_working_memory(
+		self, context: ChatContext, index_name: str | list[str], folder_path, refs_uuid: str
+	):
+		"""Async `recall_relevant_memories_to_working_memory`: the event loop waits for the searches without blocking."""
+		index_names = index_name if isinstance(index_name, list) else [index_name]
+		working_memory = context.working_memory
+		mad_hatter = context.mad_hatter
+		user_message = working_memory["user_message_json"]["text"]
+
+		memory_query_text = await mad_hatter.aexecute_hook("bot_recall_query", user_message)
+		log(f'Recall query: "{memory_query_text}"')
+
+		working_memory["memory_query"] = memory_query_text
+
+		await mad_hatter.aexecute_hook("before_bot_recalls_memories")
+
+		default_declarative_recall_config, default_procedural_recall_config = default_recall_configs()
 		recall_configs = [
-			self.mad_hatter.execute_hook("before_bot_recalls_declarative_memories", default_declarative_recall_config),
-			self.mad_hatter.execute_hook("before_bot_recalls_procedural_memories", default_procedural_recall_config)
+			await mad_hatter.aexecute_hook("before_bot_recalls_declarative_memories", default_declarative_recall_config),
+			await mad_hatter.aexecute_hook("before_bot_recalls_procedural_memories", default_procedural_recall_config)
 		]
+		memory_types, recalls, query_embedding = self.submit_recalls(
+			context, index_names, folder_path, recall_configs, memory_query_text
+		)
+
+		try:
+			if query_embedding is not None:
+				query_embedding.set_result(await context.embedder.aembed_query(memory_query_text))
+		except Exception as e:
+			query_embedding.set_exception(e)
+			raise
+
+		results = {memory_type: await asyncio.wrap_future(recall) for memory_type, recall in recalls.items()}
+		refs = self.store_recalled_memories(context, memory_types, results, query_embedding)
+		# the redis client is synchronous
+		await asyncio.get_running_loop().run_in_executor(None, self.store_refs, refs_uuid, refs)
+
+		await mad_hatter.aexecute_hook("after_bot_recalled_memories", memory_query_text)
+
+	def submit_recalls(
+		self, context: ChatContext, index_names: list[str], folder_path, recall_configs: list[dict], query_text: str
+	) -> tuple[list[str], dict[str, Future], Future | None]:
+		"""
+		Submit the recalls of the memories the prompt settings use to the recall executor, where their indexes are loaded
+		and searched while the query is embedded: returns the memory types, the recalls, and the query embedding
+		to set (None when every recall is by keywords).
+		"""
+		prompt_settings = context.working_memory["user_message_json"]["prompt_settings"]
 
 		# declarative: chat history memories
 		# procedural: tools and hooks
@@ -135,22 +246,46 @@ class DeepAI:
 		else:
 			memory_types = ["declarative", "procedural"]
 
-		for config, memory_type in zip(recall_configs, memory_types):
-			setting = f"use_{memory_type}_memory"
+		recalled = {
+			memory_type: config for config, memory_type in zip(recall_configs, memory_types)
+			if prompt_settings[f"use_{memory_type}_memory"]
+		}
+		query_embedding = Future()
+		if all(config["retrieval"] == "keyword" for config in recalled.values()):
+			query_embedding.set_result(None)
+		started_at = time.perf_counter()
+		recalls = {
+			memory_type: recall_executor.submit(
+				self.recall_memories,
+				context,
+				["procedural"] if memory_type == "procedural" else index_names,
+				folder_path,
+				config,
+				query_text,
+				query_embedding,
+				started_at
+			)
+			for memory_type, config in recalled.items()
+		}
+		return memory_types, recalls, None if query_embedding.done() else query_embedding
+
+	def store_recalled_memories(
+		self, context: ChatContext, memory_types: list[str], results: dict, query_embedding: Future | None
+	) -> list[dict]:
+		"""
+		Store the memories recalled, as (memories, latency) per memory type, in the working memory.
+		Returns the Feishu documents they come from, see `store_refs`.
+		"""
+		working_memory = context.working_memory
+		working_memory["memory_query_embedding"] = query_embedding.result() if query_embedding is not None else None
+
+		stored_refs = []
+		latencies = {}
+		for memory_type in memory_types:
 			memory_key = f"{memory_type}_memories"
 
-			if prompt_settings[setting]:
-				# recall relevant memories
-				if memory_type == "procedural":
-					vector_memory: FAISS = self.memory.vectors.faiss_db(memory_type, folder_path)
-				else:
-					vector_memory: FAISS = self.memory.vectors.faiss_db(index_name, folder_path)
-
-				memories = vector_memory.similarity_search_with_score(
-					query=memory_query_text,
-					k=config["k"],
-					score_threshold=config["threshold"]
-				)
+			if memory_type in results:
+				memories, latencies[memory_type] = results[memory_type]
 			else:
 				memories = []
 
@@ -162,43 +297,96 @@ class DeepAI:
 					refs.append(asdict(memory[0].metadata.get("node")))
 
 			if len(refs) > 0:
-				redis_client.set(refs_uuid, json.dumps(refs), ex=5 * 60)  # 5 minutes expiration
-			self.working_memory[memory_key] = memories
-
-		# hook to modify/enrich retrieved memories
-		self.mad_hatter.execute_hook("after_bot_recalled_memories", memory_query_text)
+				stored_refs = refs
+				# sent after the answer by the streaming chat
+				working_memory["refs"] = refs
+			working_memory[memory_key] = memories
+
+		working_memory["recall_latencies"] = latencies
+		log(f"Recall latencies: {', '.join(f'{t}: {s * 1000:.0f}ms' for t, s in latencies.items())}", 'INFO')
+		return stored_refs
+
+	@staticmethod
+	def store_refs(refs_uuid: str, refs: list[dict]):
+		"""Keep the Feishu documents an answer is based on, for the client to fetch them by `refs_uuid`."""
+		if len(refs) > 0:
+			redis_client.set(refs_uuid, json.dumps(refs), ex=5 * 60)  # 5 minutes expiration
+
+	def recall_memories(
+		self,
+		context: ChatContext,
+		index_names: list[str],
+		folder_path,
+		config: dict,
+		query_text: str,
+		query_embedding: Future,
+		started_at: float
+	):
+		"""
+		Recall the memories of one or several indexes, returns them with the recall latency.
+		The indexes are loaded before waiting for the query embedding, computed meanwhile.
+		"""
+		if index_names == ["procedural"] and config["retrieval"] != "keyword":
+			# the few tool embeddings are kept in memory by the MadHatter
+			memories = context.mad_hatter.recall_tools(query_embedding.result(), k=config["k"], threshold=config["threshold"])
+			return memories, time.perf_counter() - started_at
+
+		memories = self.memory.vectors.recall(
+			index_names,
+			folder_path,
+			query_text,
+			query_embedding,
+			k=config["k"],
+			threshold=config["threshold"],
+			filter=config["metadata"],
+			retrieval=config["retrieval"],
+			rerank=config.get("rerank"),
+			neighbours=config.get("neighbours", 0),
+			embedder=context.embedder
+		)
+		return memories, time.perf_counter() - started_at
 
-	def store_new_message_in_working_memory(self, user_message_json):
+	def store_new_message_in_working_memory(self, context: ChatContext, user_message_json):
 		# store last message in working memory
-		self.working_memory["user_message_json"] = user_message_json
+		context.working_memory["user_message_json"] = user_message_json
 
 		prompt_settings = deepcopy(self.default_prompt_settings)
 
 		# override current prompt_settings with prompt settings sent via api (if any)
 		prompt_settings.update(user_message_json.get("prompt_settings", {}))
 
-		self.working_memory["user_message_json"]["prompt_settings"] = prompt_settings
+		context.working_memory["user_message_json"]["prompt_settings"] = prompt_settings
 
-	def format_agent_input(self):
-		chat_history = self.working_memory["user_message_json"]["chat_history"]
+	def format_agent_input(self, context: ChatContext):
+		chat_history = context.working_memory["user_message_json"]["chat_history"]
 
 		# format memories to be inserted in the prompt
-		declarative_memory_formatted_content = self.mad_hatter.execute_hook(
+		declarative_memory_formatted_content = context.mad_hatter.execute_hook(
 			"agent_prompt_declarative_memories",
-			self.working_memory["declarative_memories"],
+			context.working_memory["declarative_memories"],
 		)
 
 		# format conversation history to be inserted in the prompt
-		conversation_history_formatted_content = self.mad_hatter.execute_hook(
+		conversation_history_formatted_content = context.mad_hatter.execute_hook(
 			"agent_prompt_chat_history", chat_history
 		)
 
 		return {
-			"input": self.working_memory["user_message_json"]["text"],
+			"input": context.working_memory["user_message_json"]["text"],
 			"declarative_memory": declarative_memory_formatted_content,
 			"chat_history": conversation_history_formatted_content,
 		}
 
+	async def aformat_agent_input(self, context: ChatContext):
+		chat_history = context.working_memory["user_message_json"]["chat_history"]
+		return {
+			"input": context.working_memory["user_message_json"]["text"],
+			"declarative_memory": await context.mad_hatter.aexecute_hook(
+				"agent_prompt_declarative_memories", context.working_memory["declarative_memories"]
+			),
+			"chat_history": await context.mad_hatter.aexecute_hook("agent_prompt_chat_history", chat_history),
+		}
+
 	def get_base_path(self):
 		"""Allows the Bot expose the base path."""
 		# return os.getcwd()
@@ -208,25 +396,25 @@ class DeepAI:
 		"""Allows the Bot expose the plugins path."""
 		return os.path.join(self.get_base_path(), "storage/plugins/")
 
-	def __call__(self, user_message_json, index_name, folder_path=None):
+	def __call__(self, user_message_json, index_name, folder_path=None, context: ChatContext | None = None):
 		folder_path = folder_path if folder_path else self.common_storage
 		log(f"user_message_json: {user_message_json}", "DEBUG")
 		log(f"index_folder_path: {folder_path}", "DEBUG")
 		log(f"index_name(knowledge_base_id): {index_name}", "DEBUG")
 
-		# recall use_plugins to memory by current knowledge_base_id
-		self.mad_hatter.sync_hooks_and_tools_when_chat(index_name)
+		# the working memory, models and plugins of this chat only
+		context = context or self.chat_context(index_name)
 
 		# hook to modify/enrich user input
-		user_message_json = self.mad_hatter.execute_hook("before_bot_reads_message", user_message_json)
+		user_message_json = context.mad_hatter.execute_hook("before_bot_reads_message", user_message_json)
 
 		# store user_message_json in working memory
 		# it contains the new message, prompt settings and other info plugins may find useful
-		self.store_new_message_in_working_memory(user_message_json)
+		self.store_new_message_in_working_memory(context, user_message_json)
 
 		# recall procedural and declarative memories from vector collections and store them in working_memory
 		try:
-			self.recall_relevant_memories_to_working_memory(index_name, folder_path, '')
+			self.recall_relevant_memories_to_working_memory(context, index_name, folder_path, '')
 		except Exception as e:
 			log(e)
 			traceback.print_exc()
@@ -238,11 +426,11 @@ class DeepAI:
 			}
 
 		# prepare input to be passed to the agent executor. Info will be extracted from working memory
-		agent_input = self.format_agent_input()
+		agent_input = self.format_agent_input(context)
 
 		# reply with agent
 		try:
-			bot_message = self.agent_manager.execute_agent(agent_input)
+			bot_message = self.agent_manager.execute_agent(agent_input, context)
 		except Exception as e:
 			# This error happens when the LLM
 			#   does not respect prompt instructions.
@@ -266,9 +454,9 @@ class DeepAI:
 		log(bot_message, "DEBUG")
 
 		# build data structure for output (response and why with memories)
-		declarative_report = [dict(d[0]) | {"score": float(d[1])} for d in self.working_memory["declarative_memories"]]
-		if "procedural_memories" in self.working_memory:
-			procedural_report = [dict(d[0]) | {"score": float(d[1])} for d in self.working_memory["procedural_memories"]]
+		declarative_report = [dict(d[0]) | {"score": float(d[1])} for d in context.working_memory["declarative_memories"]]
+		if "procedural_memories" in context.working_memory:
+			procedural_report = [dict(d[0]) | {"score": float(d[1])} for d in context.working_memory["procedural_memories"]]
 		else:
 			procedural_report = []
 
@@ -286,41 +474,66 @@ class DeepAI:
 			},
 		}
 
-		final_output = self.mad_hatter.execute_hook("before_bot_sends_message", final_output)
+		final_output = context.mad_hatter.execute_hook("before_bot_sends_message", final_output)
 
 		return final_output
 
-	def stream(self, user_message_json, index_name, refs_uuid: str, folder_path=None):
+	def stream(self, user_message_json, index_name, refs_uuid: str, folder_path=None, context: ChatContext | None = None):
 		folder_path = folder_path if folder_path else self.common_storage
 		log(f"user_message_json: {user_message_json}", "DEBUG")
 		log(f"index_folder_path: {folder_path}", "DEBUG")
 		log(f"index_name(knowledge_base_id): {index_name}", "DEBUG")
 
-		# recall use_plugins to memory by current knowledge_base_id
-		self.mad_hatter.sync_hooks_and_tools_when_chat(index_name)
+		# the working memory, models and plugins of this chat only
+		context = context or self.chat_context(index_name)
 
 		# hook to modify/enrich user input
-		user_message_json = self.mad_hatter.execute_hook("before_bot_reads_message", user_message_json)
+		user_message_json = context.mad_hatter.execute_hook("before_bot_reads_message", user_message_json)
 
 		# store user_message_json in working memory
 		# it contains the new message, prompt settings and other info plugins may find useful
-		self.store_new_message_in_working_memory(user_message_json)
+		self.store_new_message_in_working_memory(context, user_message_json)
 
 		# recall procedural and declarative memories from vector collections and store them in working_memory
 		try:
-			self.recall_relevant_memories_to_working_memory(index_name, folder_path, refs_uuid)
+			self.recall_relevant_memories_to_working_memory(context, index_name, folder_path, refs_uuid)
 		except Exception as e:
 			traceback.print_exc()
 			raise e
 
 		# prepare input to be passed to the agent executor. Info will be extracted from working memory
-		agent_input = self.format_agent_input()
+		agent_input = self.format_agent_input(context)
 
 		# reply with agent
 		try:
-			bot_message_interator = self.agent_manager.execute_agent_stream(agent_input)
+			bot_message_interator = self.agent_manager.execute_agent_stream(agent_input, context)
 			return bot_message_interator
 		except Exception as e:
 			traceback.print_exc()
 			raise e
 
+	async def astream(
+		self, user_message_json, index_name, refs_uuid: str, folder_path=None, context: ChatContext | None = None
+	) -> AsyncIterator:
+		"""
+		Async `stream`, yielding the chunks of the answer as the LLM writes them: hooks are awaited when they are
+		coroutines, the indexes are searched in the recall executor and the LLM is called with `ainvoke` / `astream`,
+		so a chat never blocks the event loop. A reply without the LLM (a hook, a tool returning directly) is yielded
+		as one chunk.
+		"""
+		folder_path = folder_path if folder_path else self.common_storage
+		log(f"user_message_json: {user_message_json}", "DEBUG")
+		log(f"index_folder_path: {folder_path}", "DEBUG")
+		log(f"index_name(knowledge_base_id): {index_name}", "DEBUG")
+
+		# the plugins of the knowledge base are read from the database
+		context = context or await asyncio.get_running_loop().run_in_executor(None, self.chat_context, index_name)
+
+		user_message_json = await context.mad_hatter.aexecute_hook("before_bot_reads_message", user_message_json)
+		self.store_new_message_in_working_memory(context, user_message_json)
+
+		await self.arecall_relevant_memories_to_working_memory(context, index_name, folder_path, refs_uuid)
+
+		agent_input = await self.aformat_agent_input(context)
+		async for chunk in self.agent_manager.aexecute_agent_stream(agent_input, context):
+			yield chunk
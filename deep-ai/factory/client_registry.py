@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Type
+
+import httpx
+
+from log import log
+
+# LLM and embedder clients kept for reuse, the least recently used ones are dropped beyond
+MODEL_CLIENTS_MAX = int(os.getenv("MODEL_CLIENTS_MAX", 32))
+# Idle connections kept open to the model providers, and for how long
+MODEL_HTTP_MAX_KEEPALIVE = int(os.getenv("MODEL_HTTP_MAX_KEEPALIVE", 20))
+MODEL_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("MODEL_HTTP_KEEPALIVE_EXPIRY", 60))
+# Timeout of a model request, in seconds
+MODEL_HTTP_TIMEOUT = float(os.getenv("MODEL_HTTP_TIMEOUT", 600))
+
+
+def config_key(config) -> str:
+	"""Digest of a client config, secrets included (they differ between accounts) but never kept in clear."""
+
+	def plain(value):
+		if isinstance(value, dict):
+			return {str(k): plain(v) for k, v in value.items()}
+		if isinstance(value, (list, tuple)):
+			return [plain(v) for v in value]
+		if hasattr(value, "get_secret_value"):
+			return value.get_secret_value()
+		return value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+
+	return hashlib.sha256(json.dumps(plain(config), sort_keys=True).encode()).hexdigest()
+
+
+class ClientRegistry:
+	"""
+	LLM and embedder clients built once per (class, config) and shared by every request, instead of one per request:
+	hooks only describe the client they want, so a changed config is a new client, and the old one ages out.
+	Clients of the OpenAI compatible providers also share the HTTP connection pool of the registry, kept alive
+	between requests, whatever the model.
+	"""
+
+	def __init__(self, max_clients: int = MODEL_CLIENTS_MAX):
+		self.max_clients = max_clients
+		self._clients: OrderedDict[tuple, object] = OrderedDict()
+		self._lock = threading.Lock()
+		self._building_locks: dict[tuple, threading.Lock] = {}
+
+		self.constructions: dict[str, int] = {}
+		self.hits = 0
+		self.evictions = 0
+		self.http_requests = 0
+		self.http_connections = 0
+		# called with every response of the shared HTTP clients, e.g. to read rate limit headers
+		self.response_hooks: list = []
+
+		limits = httpx.Limits(max_keepalive_connections=MODEL_HTTP_MAX_KEEPALIVE, keepalive_expiry=MODEL_HTTP_KEEPALIVE_EXPIRY)
+		self.http_client = httpx.Client(
+			limits=limits, timeout=MODEL_HTTP_TIMEOUT,
+			event_hooks={"request": [self._on_request], "response": [self._on_response]}
+		)
+		self.http_async_client = httpx.AsyncClient(
+			limits=limits, timeout=MODEL_HTTP_TIMEOUT,
+			event_hooks={"request": [self._on_async_request], "response": [self._on_async_response]}
+		)
+
+	def get(self, pyclass: Type, config: dict):
+		"""The client of a class for a config, `pyclass(**config)` the first time."""
+		key = (f"{pyclass.__module__}.{pyclass.__qualname__}", config_key(config))
+		with self._lock:
+			client = self._hit(key)
+			if client is not None:
+				return client
+			building_lock = self._building_locks.setdefault(key, threading.Lock())
+
+		# clients of other configs are built at the same time, a client is built once
+		with building_lock:
+			with self._lock:
+				client = self._hit(key)
+				if client is not None:
+					return client
+
+			client = pyclass(**self._with_http_clients(pyclass, config))
+
+			with self._lock:
+				self._building_locks.pop(key, None)
+				self._clients[key] = client
+				self.constructions[pyclass.__name__] = self.constructions.get(pyclass.__name__, 0) + 1
+				while len(self._clients) > self.max_clients:
+					self._clients.popitem(last=False)
+					self.evictions += 1
+		log(f"Model client {pyclass.__name__} built, {len(self._clients)} clients kept", "DEBUG")
+		return client
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"clients": len(self._clients),
+				"max_clients": self.max_clients,
+				"constructions": dict(self.constructions),
+				"hits": self.hits,
+				"evictions": self.evictions,
+				"http_requests": self.http_requests,
+				"http_connections": self.http_connections,
+				# requests sent on a kept-alive connection
+				"http_reused_connections": max(self.http_requests - self.http_connections, 0),
+			}
+
+	def _hit(self, key: tuple):
+		client = self._clients.get(key)
+		if client is not None:
+			self._clients.move_to_end(key)
+			self.hits += 1
+		return client
+
+	def _with_http_clients(self, pyclass: Type, config: dict) -> dict:
+		fields = getattr(pyclass, "__fields__", {})
+		if "http_client" not in fields or "http_client" in config:
+			return config
+		config = {**config, "http_client": self.http_client}
+		if "http_async_client" in fields and "http_async_client" not in config:
+			config["http_async_client"] = self.http_async_client
+		return config
+
+	def _on_request(self, request: httpx.Request):
+		with self._lock:
+			self.http_requests += 1
+		request.extensions["trace"] = self._trace
+
+	def _on_response(self, response: httpx.Response):
+		for hook in self.response_hooks:
+			try:
+				hook(response)
+			except Exception as e:
+				log(f"Model client response hook failed: {e}", "WARNING")
+
+	async def _on_async_response(self, response: httpx.Response):
+		self._on_response(response)
+
+	def _trace(self, event_name: str, info: dict):
+		if event_name == "connection.connect_tcp.complete":
+			with self._lock:
+				self.http_connections += 1
+
+	async def _on_async_request(self, request: httpx.Request):
+		with self._lock:
+			self.http_requests += 1
+		request.extensions["trace"] = self._async_trace
+
+	async def _async_trace(self, event_name: str, info: dict):
+		self._trace(event_name, info)
+
+
+client_registry = ClientRegistry()
@@ -7,20 +7,22 @@ from langchain_openai import OpenAIEmbeddings, AzureOpenAIEmbeddings
 from pydantic import ConfigDict
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from factory.client_registry import client_registry
+
 
 # Base class to manage LLM configuration.
 class EmbedderSettings(BaseSettings):
 	# class instantiating the embedder
 	_pyclass: None
 
-	# instantiate an Embedder from configuration
+	# instantiate an Embedder from configuration, or reuse the one of a previous request
 	@classmethod
 	def get_embedder_from_config(cls, config):
 		if cls._pyclass is None:
 			raise Exception(
 				"Embedder configuration class has self._pyclass = None. Should be a valid Embedder class"
 			)
-		return cls._pyclass.default(**config)
+		return client_registry.get(cls._pyclass.default, config)
 
 
 class EmbedderFakeConfig(EmbedderSettings):
@@ -107,6 +109,37 @@ SUPPORTED_EMBEDDING_MODELS = [
 	EmbedderDeepInfraConfig,
 ]
 
+# attributes that name the model behind an embedder, in order of preference
+EMBEDDER_MODEL_ATTRIBUTES = ["model", "model_id", "repo_id", "deployment", "model_name"]
+
+
+def embedder_identity(embedder) -> str:
+	"""Return a stable identity for an embedder: its class plus the model it points at.
+
+	Two embedder instances with the same identity produce the same vectors, so anything built from one of them
+	(e.g. a loaded FAISS index) can be reused with the other.
+	"""
+	if embedder is None:
+		return "None"
+
+	# wrappers (e.g. the embedding cache) share the identity of the embedder they wrap
+	wrapped_embedder = getattr(embedder, "wrapped_embedder", None)
+	if wrapped_embedder is not None:
+		return embedder_identity(wrapped_embedder)
+
+	for attribute in EMBEDDER_MODEL_ATTRIBUTES:
+		value = getattr(embedder, attribute, None)
+		if value:
+			return f"{type(embedder).__name__}:{value}"
+
+	# FakeEmbeddings only has a size
+	size = getattr(embedder, "size", None)
+	if size:
+		return f"{type(embedder).__name__}:{size}"
+
+	return type(embedder).__name__
+
+
 # EMBEDDER_SCHEMAS contains metadata to let any client know which fields are required to create the language embedder.
 EMBEDDER_SCHEMAS = {}
 for config_class in SUPPORTED_EMBEDDING_MODELS:
@@ -0,0 +1,227 @@
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from background.processor_utils import ProcessorUtils
+from factory.client_registry import client_registry
+from factory.embedder import embedder_identity
+from log import log
+
+# Embedding batches in flight at the same time, shared by every caller
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))
+# Default provider limits per embedder, refined at runtime from the rate limit headers the provider sends back
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", 3000))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 1000000))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 6))
+EMBEDDING_MAX_BACKOFF_SECONDS = 60
+
+
+def parse_duration(value) -> float | None:
+	"""Parse a rate limit reset value in seconds: `12`, `0.5`, `20ms`, `1s`, `6m0s`, `1h2m`."""
+	if value is None:
+		return None
+	value = str(value).strip()
+	try:
+		return float(value)
+	except ValueError:
+		pass
+
+	parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+	if not parts:
+		return None
+	units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+	return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+	"""A 429 response, by its status code (on the error or its response), or the error class of the SDKs without one."""
+	status_code = getattr(error, "status_code", None)
+	if status_code is None:
+		status_code = getattr(getattr(error, "response", None), "status_code", None)
+	if status_code is not None:
+		return status_code == 429
+	return type(error).__name__ == "RateLimitError"
+
+
+class TokenBucket:
+	"""Thread-safe token bucket, refilled continuously up to `capacity` tokens per minute."""
+
+	def __init__(self, capacity: float):
+		self.capacity = float(capacity)
+		self.tokens = float(capacity)
+		self.updated_at = time.monotonic()
+		self.lock = threading.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / 60)
+		self.updated_at = now
+
+	def acquire(self, amount: float):
+		while True:
+			with self.lock:
+				self._refill()
+				# a request bigger than the bucket only has to wait for a full bucket
+				amount = min(amount, self.capacity)
+				if self.tokens >= amount:
+					self.tokens -= amount
+					return
+				wait = (amount - self.tokens) * 60 / self.capacity
+			time.sleep(wait)
+
+	def update(self, capacity: float | None = None, remaining: float | None = None):
+		with self.lock:
+			self._refill()
+			if capacity:
+				self.capacity = float(capacity)
+			if remaining is not None:
+				self.tokens = min(self.tokens, float(remaining))
+
+
+class RateLimiter:
+	"""Requests per minute and tokens per minute limits of a single embedder."""
+
+	def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+		self.requests = TokenBucket(requests_per_minute)
+		self.tokens = TokenBucket(tokens_per_minute)
+		self.blocked_until = 0.0
+		self.rate_limited = 0
+		self.retries = 0
+
+	def acquire(self, tokens: int):
+		delay = self.blocked_until - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		self.requests.acquire(1)
+		self.tokens.acquire(tokens)
+
+	def block_for(self, seconds: float):
+		self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+	def observe_headers(self, headers):
+		"""Adjust the buckets to the rate limit headers sent back by the provider (OpenAI style)."""
+		if not headers:
+			return
+
+		def number(name):
+			try:
+				return float(headers.get(name))
+			except (TypeError, ValueError):
+				return None
+
+		self.requests.update(number("x-ratelimit-limit-requests"), number("x-ratelimit-remaining-requests"))
+		self.tokens.update(number("x-ratelimit-limit-tokens"), number("x-ratelimit-remaining-tokens"))
+
+		retry_after = parse_duration(headers.get("retry-after"))
+		if retry_after:
+			self.block_for(retry_after)
+		elif number("x-ratelimit-remaining-requests") == 0 or number("x-ratelimit-remaining-tokens") == 0:
+			resets = [
+				parse_duration(headers.get("x-ratelimit-reset-requests")),
+				parse_duration(headers.get("x-ratelimit-reset-tokens")),
+			]
+			resets = [r for r in resets if r]
+			if resets:
+				self.block_for(max(resets))
+
+
+# limiter of the embedding batch running in the thread, whose responses it reads the rate limit headers of
+_running = threading.local()
+
+
+def observe_response(response):
+	"""
+	Response hook of the shared HTTP client of the model clients: the rate limit headers of every response to an
+	embedding batch adjust the limits of its embedder, not only the ones of 429 responses.
+	"""
+	limiter = getattr(_running, "limiter", None)
+	if limiter is not None:
+		limiter.observe_headers(response.headers)
+
+
+client_registry.response_hooks.append(observe_response)
+
+
+class EmbeddingScheduler:
+	"""Runs embedding batches concurrently while staying under each embedder's rate limits.
+
+	Every embedder (by identity) gets its own token-bucket limiter, all embedders share a bounded pool of workers,
+	and rate limited (429) batches are retried with exponential backoff.
+	"""
+
+	def __init__(self, max_concurrency: int = EMBEDDING_MAX_CONCURRENCY):
+		self.max_concurrency = max_concurrency
+		self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embedding")
+		self._limiters: dict[str, RateLimiter] = {}
+		self._lock = threading.Lock()
+
+	def limiter(self, embedder) -> RateLimiter:
+		key = embedder_identity(embedder)
+		with self._lock:
+			if key not in self._limiters:
+				self._limiters[key] = RateLimiter(EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE)
+			return self._limiters[key]
+
+	def embed_batches(self, embedder, texts: list[str]) -> Iterator[tuple[int, int, int, list[list[float]]]]:
+		"""Embed texts in provider-sized batches, several batches in flight at once.
+
+		Yields (start, end, tokens, embeddings) for `texts[start:end]`, in order.
+		"""
+		futures = [
+			(start, end, tokens, self._executor.submit(self._embed_batch, embedder, texts[start:end], tokens))
+			for start, end, tokens in ProcessorUtils.batch_texts(texts)
+		]
+		try:
+			for start, end, tokens, future in futures:
+				yield start, end, tokens, future.result()
+		finally:
+			for *_, future in futures:
+				future.cancel()
+
+	def embed_documents(self, embedder, texts: list[str]) -> list[list[float]]:
+		embeddings = []
+		for *_, batch_embeddings in self.embed_batches(embedder, texts):
+			embeddings += batch_embeddings
+		return embeddings
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				key: {
+					"requests_per_minute": limiter.requests.capacity,
+					"tokens_per_minute": limiter.tokens.capacity,
+					"rate_limited": limiter.rate_limited,
+					"retries": limiter.retries,
+				}
+				for key, limiter in self._limiters.items()
+			}
+
+	def _embed_batch(self, embedder, texts: list[str], tokens: int) -> list[list[float]]:
+		limiter = self.limiter(embedder)
+		attempt = 0
+		while True:
+			limiter.acquire(tokens)
+			_running.limiter = limiter
+			try:
+				return embedder.embed_documents(texts)
+			except Exception as e:
+				if not is_rate_limit_error(e) or attempt >= EMBEDDING_MAX_RETRIES:
+					raise
+
+				limiter.rate_limited += 1
+				limiter.retries += 1
+				limiter.observe_headers(getattr(getattr(e, "response", None), "headers", None))
+
+				backoff = min(EMBEDDING_MAX_BACKOFF_SECONDS, 2 ** attempt) + random.uniform(0, 1)
+				limiter.block_for(backoff)
+				attempt += 1
+				log(f"Embedding rate limited by {embedder_identity(embedder)}, retry {attempt} in {backoff:.1f}s", "WARNING")
+			finally:
+				_running.limiter = None
+
+
+embedding_scheduler = EmbeddingScheduler()
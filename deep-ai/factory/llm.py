@@ -11,6 +11,7 @@ from pydantic import ConfigDict
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from factory.custom_llm import LLMDefault, LLMCustom
+from factory.client_registry import client_registry
 
 
 # Base class to manage LLM configuration.
@@ -18,7 +19,7 @@ class LLMSettings(BaseSettings):
 	# class instantiating the model
 	_pyclass: Type = None
 
-	# instantiate an LLM from configuration
+	# instantiate an LLM from configuration, or reuse the one of a previous request
 	@classmethod
 	def get_llm_from_config(cls, config):
 		if cls._pyclass is None:
@@ -26,7 +27,7 @@ class LLMSettings(BaseSettings):
 				"Language model configuration class has self._pyclass = None. "
 				"Should be a valid LLM class"
 			)
-		return cls._pyclass.default(**config)
+		return client_registry.get(cls._pyclass.default, config)
 
 
 class LLMDefaultConfig(LLMSettings):
@@ -57,7 +58,7 @@ class LLMCustomConfig(LLMSettings):
 			else:
 				config["options"] = {}
 
-		return cls._pyclass.default(**config)
+		return client_registry.get(cls._pyclass.default, config)
 
 	model_config = ConfigDict(json_schema_extra={
 		"name_human_readable": "Custom LLM",
@@ -9,10 +9,12 @@ from starlette import status
 
 from db.crud_user import redis_client
 from log import log
+from memory.sqlite_docstore import register_metadata_type
 from typing import Any
 from dataclasses import dataclass
 
 
+@register_metadata_type
 @dataclass
 class FeishuNode:
 	creator: str
@@ -1,4 +1,10 @@
+import asyncio
+import os
+import threading
+import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator
 
 from langchain.prompts import PromptTemplate
 from langchain.agents import AgentExecutor, LLMSingleActionAgent
@@ -9,16 +15,75 @@ from looking_glass.output_parser import ToolOutputParser
 from looking_glass.prompts import ToolPromptTemplate
 from utils import config_metadata_chain
 
+# Start the memory chain (without tools output) while the tool agent runs, instead of after it
+AGENT_SPECULATIVE_MEMORY_CHAIN = os.getenv("AGENT_SPECULATIVE_MEMORY_CHAIN", "false").lower() == "true"
+# Memory chains run speculatively at the same time by the sync chats
+AGENT_SPECULATION_THREADS = int(os.getenv("AGENT_SPECULATION_THREADS", 8))
+
+speculation_executor = ThreadPoolExecutor(max_workers=AGENT_SPECULATION_THREADS, thread_name_prefix="speculation")
+
+# end of the chunks of a speculative memory chain
+_END_OF_CHAIN = object()
+
+
+class SpeculativeChain:
+	"""
+	Memory chain streamed in the background while the tool agent runs: its chunks are buffered until the tool
+	agent has answered, then iterated (the buffered ones first), or the chain is cancelled.
+	"""
+
+	def __init__(self, chain, chain_input):
+		self.chunks = asyncio.Queue()
+		self.task = asyncio.create_task(self._run(chain, chain_input))
+
+	async def _run(self, chain, chain_input):
+		try:
+			async for chunk in chain.astream(chain_input):
+				self.chunks.put_nowait(chunk)
+		except Exception as e:
+			self.chunks.put_nowait(e)
+		finally:
+			self.chunks.put_nowait(_END_OF_CHAIN)
+
+	def cancel(self):
+		self.task.cancel()
+
+	async def __aiter__(self):
+		while True:
+			chunk = await self.chunks.get()
+			if chunk is _END_OF_CHAIN:
+				return
+			if isinstance(chunk, Exception):
+				raise chunk
+			yield chunk
+
 
 class AgentManager:
 	def __init__(self, bot):
 		self.bot = bot
 
-	def execute_tool_agent(self, agent_input, allowed_tools):
+		# speculative memory chains: started, and then used (the tools had nothing) or cancelled
+		self.speculations = {"started": 0, "used": 0, "cancelled": 0}
+		self._speculations_lock = threading.Lock()
+
+	def execute_tool_agent(self, agent_input, allowed_tools, context):
+		instructions = context.mad_hatter.execute_hook("agent_prompt_instructions")
+		agent_executor = self.tool_agent_executor(allowed_tools, context, instructions)
+
+		out = agent_executor.invoke(agent_input)
+		return out
+
+	async def aexecute_tool_agent(self, agent_input, allowed_tools, context):
+		instructions = await context.mad_hatter.aexecute_hook("agent_prompt_instructions")
+		agent_executor = self.tool_agent_executor(allowed_tools, context, instructions)
+
+		return await agent_executor.ainvoke(agent_input)
+
+	def tool_agent_executor(self, allowed_tools, context, instructions) -> AgentExecutor:
 		allowed_tools_names = [t.name for t in allowed_tools]
 
 		prompt = ToolPromptTemplate(
-			template=self.bot.mad_hatter.execute_hook("agent_prompt_instructions"),
+			template=instructions,
 			tools=allowed_tools,
 			# This omits the `agent_scratchpad`, `tools`, and `tool_names` variables because those are generated dynamically
 			# This includes the `intermediate_steps` variable because it is needed to fill the scratchpad
@@ -26,7 +91,7 @@ class AgentManager:
 		)
 
 		# main chain
-		agent_chain = LLMChain(prompt=prompt, llm=self.bot.llm, verbose=True)
+		agent_chain = LLMChain(prompt=prompt, llm=context.llm, verbose=True)
 
 		# init agent
 		agent = LLMSingleActionAgent(
@@ -45,14 +110,12 @@ class AgentManager:
 			verbose=True
 		)
 
-		agent_executor: AgentExecutor = config_metadata_chain(agent_executor, {"email": self.bot.email})
+		agent_executor: AgentExecutor = config_metadata_chain(agent_executor, {"email": context.email})
+		return agent_executor
 
-		out = agent_executor.invoke(agent_input)
-		return out
-
-	def execute_memory_chain(self, agent_input, prompt_prefix, prompt_suffix):
-		# memory chain (second step)
-		memory_prompt = PromptTemplate(
+	@staticmethod
+	def memory_prompt(prompt_prefix, prompt_suffix) -> PromptTemplate:
+		return PromptTemplate(
 			template=prompt_prefix + prompt_suffix,
 			input_variables=[
 				"input",
@@ -62,40 +125,68 @@ class AgentManager:
 			]
 		)
 
+	def execute_memory_chain(self, agent_input, prompt_prefix, prompt_suffix, context):
+		# memory chain (second step)
 		memory_chain = LLMChain(
-			prompt=memory_prompt,
-			llm=self.bot.llm,
+			prompt=self.memory_prompt(prompt_prefix, prompt_suffix),
+			llm=context.llm,
 			verbose=True
 		)
 
-		memory_chain = config_metadata_chain(memory_chain, {"email": self.bot.email})
+		memory_chain = config_metadata_chain(memory_chain, {"email": context.email})
 
 		out = memory_chain.invoke(agent_input)
 		out["output"] = out["text"]
 		del out["text"]
 		return out
 
-	def execute_memory_chain_stream(self, agent_input, prompt_prefix, prompt_suffix):
+	def execute_memory_chain_stream(self, agent_input, prompt_prefix, prompt_suffix, context):
 		# memory chain (second step)
-		memory_prompt = PromptTemplate(
-			template=prompt_prefix + prompt_suffix,
-			input_variables=[
-				"input",
-				"chat_history",
-				"declarative_memory",
-				"tools_output"
-			]
+		memory_chain = self.memory_chain(prompt_prefix, prompt_suffix, context)
+
+		interator = memory_chain.stream(agent_input)
+		return interator
+
+	def speculate_memory_chain(self, agent_input, prompt_prefix, prompt_suffix, context) -> Future | None:
+		"""
+		Start the memory chain without tools output while the tool agent runs: most of the time the tools have
+		nothing (`none_of_the_others`) and the answer is the one of this chain, one LLM round trip earlier.
+		"""
+		if not AGENT_SPECULATIVE_MEMORY_CHAIN:
+			return None
+		self.count_speculation("started")
+		return speculation_executor.submit(
+			self.execute_memory_chain, {**agent_input, "tools_output": ""}, prompt_prefix, prompt_suffix, context
 		)
 
-		memory_chain = memory_prompt | self.bot.llm
+	def settle_speculation(self, context, used: bool, tool_agent_seconds: float):
+		outcome = "used" if used else "cancelled"
+		self.count_speculation(outcome)
+		context.working_memory["speculation"] = {"outcome": outcome, "tool_agent_seconds": tool_agent_seconds}
 
-		memory_chain = config_metadata_chain(memory_chain, {"email": self.bot.email})
+		stats = self.speculation_stats()
+		log(
+			f"Speculative memory chain {outcome} after the tool agent ({tool_agent_seconds * 1000:.0f}ms), "
+			f"{stats['used']}/{stats['used'] + stats['cancelled']} used",
+			"INFO"
+		)
 
-		interator = memory_chain.stream(agent_input)
-		return interator
+	def count_speculation(self, outcome: str):
+		with self._speculations_lock:
+			self.speculations[outcome] += 1
+
+	def speculation_stats(self) -> dict:
+		with self._speculations_lock:
+			stats = dict(self.speculations)
+		settled = stats["used"] + stats["cancelled"]
+		stats["enabled"] = AGENT_SPECULATIVE_MEMORY_CHAIN
+		# share of the speculative memory chains whose answer was the one sent
+		stats["hit_rate"] = stats["used"] / settled if settled else None
+		return stats
 
-	def execute_agent(self, agent_input):
-		mad_hatter = self.bot.mad_hatter
+	def execute_agent(self, agent_input, context):
+		# hooks and tools of the plugins used by the knowledge base of the chat
+		mad_hatter = context.mad_hatter
 
 		# this hook allows to reply without executing the agent (for example canned responses, out-of-topic barriers etc.)
 		fast_reply = mad_hatter.execute_hook("before_agent_starts", agent_input)
@@ -113,13 +204,22 @@ class AgentManager:
 
 			log(f"{len(allowed_tools)} allowed tools retrieved.", "DEBUG")
 
+			speculation = self.speculate_memory_chain(agent_input, prompt_prefix, prompt_suffix, context)
+			tool_agent_started_at = time.perf_counter()
+
 			try:
-				tools_result = self.execute_tool_agent(agent_input, allowed_tools)
+				tools_result = self.execute_tool_agent(agent_input, allowed_tools, context)
 
 				# If tools_result["output"] is None the LLM has used the fake tool none_of_the_others
 				# so no relevant information has been obtained from the tools.
 				if tools_result["output"] is not None:
 
+					# the memory chain must read the tools output: a request already sent is only ignored
+					if speculation is not None:
+						speculation.cancel()
+						self.settle_speculation(context, False, time.perf_counter() - tool_agent_started_at)
+						speculation = None
+
 					# Extract of intermediate steps in the format ((tool_name, tool_input), output)
 					used_tools = list(map(lambda x: ((x[0].tool, x[0].tool_input), x[1]), tools_result["intermediate_steps"]))
 
@@ -140,7 +240,7 @@ class AgentManager:
 					agent_input["tools_output"] = "## Tools output: \n" + tools_result["output"] if tools_result["output"] else ""
 
 					# Execute the memory chain
-					out = self.execute_memory_chain(agent_input, prompt_prefix, prompt_suffix)
+					out = self.execute_memory_chain(agent_input, prompt_prefix, prompt_suffix, context)
 
 					# If some tools are used the intermediate step are added to the agent output
 					out["intermediate_steps"] = used_tools
@@ -153,17 +253,24 @@ class AgentManager:
 				error_description = str(e)
 				log(error_description, "ERROR")
 
+			# the tools had nothing: the answer is the one of the memory chain already running
+			if speculation is not None:
+				self.settle_speculation(context, True, time.perf_counter() - tool_agent_started_at)
+				agent_input["tools_output"] = ""
+				return speculation.result()
+
 		# If an exception occur in the execute_tool_agent or there is no allowed tools execute only the memory chain
 
 		# Adding the tools_output key in agent input, needed by the memory chain
 		agent_input["tools_output"] = ""
 		# Execute the memory chain
-		out = self.execute_memory_chain(agent_input, prompt_prefix, prompt_suffix)
+		out = self.execute_memory_chain(agent_input, prompt_prefix, prompt_suffix, context)
 
 		return out
 
-	def execute_agent_stream(self, agent_input):
-		mad_hatter = self.bot.mad_hatter
+	def execute_agent_stream(self, agent_input, context):
+		# hooks and tools of the plugins used by the knowledge base of the chat
+		mad_hatter = context.mad_hatter
 
 		# this hook allows to reply without executing the agent (for example canned responses, out-of-topic barriers etc.)
 		fast_reply = mad_hatter.execute_hook("before_agent_starts", agent_input)
@@ -182,7 +289,7 @@ class AgentManager:
 			log(f"{len(allowed_tools)} allowed tools retrieved.", "DEBUG")
 
 			try:
-				tools_result = self.execute_tool_agent(agent_input, allowed_tools)
+				tools_result = self.execute_tool_agent(agent_input, allowed_tools, context)
 
 				# If tools_result["output"] is None the LLM has used the fake tool none_of_the_others
 				# so no relevant information has been obtained from the tools.
@@ -208,7 +315,7 @@ class AgentManager:
 					agent_input["tools_output"] = "## Tools output: \n" + tools_result["output"] if tools_result["output"] else ""
 
 					# Execute the memory chain
-					interator = self.execute_memory_chain_stream(agent_input, prompt_prefix, prompt_suffix)
+					interator = self.execute_memory_chain_stream(agent_input, prompt_prefix, prompt_suffix, context)
 
 					# Early return
 					return interator
@@ -222,6 +329,82 @@ class AgentManager:
 		# Adding the tools_output key in agent input, needed by the memory chain
 		agent_input["tools_output"] = ""
 		# Execute the memory chain
-		interator = self.execute_memory_chain_stream(agent_input, prompt_prefix, prompt_suffix)
+		interator = self.execute_memory_chain_stream(agent_input, prompt_prefix, prompt_suffix, context)
 
 		return interator
+
+	async def aexecute_agent_stream(self, agent_input, context) -> AsyncIterator:
+		"""
+		Async `execute_agent_stream`, yielding the chunks of the memory chain as the LLM writes them, or the reply
+		of a hook or of a tool returning directly as one chunk.
+		"""
+		# hooks and tools of the plugins used by the knowledge base of the chat
+		mad_hatter = context.mad_hatter
+
+		# this hook allows to reply without executing the agent (for example canned responses, out-of-topic barriers etc.)
+		fast_reply = await mad_hatter.aexecute_hook("before_agent_starts", agent_input)
+		if fast_reply:
+			yield fast_reply
+			return
+
+		prompt_prefix = await mad_hatter.aexecute_hook("agent_prompt_prefix")
+		prompt_suffix = await mad_hatter.aexecute_hook("agent_prompt_suffix")
+
+		# Try to reply only with tools
+		allowed_tools = await mad_hatter.aexecute_hook("agent_allowed_tools")
+
+		agent_input["tools_output"] = ""
+		if len(allowed_tools) > 0:
+
+			log(f"{len(allowed_tools)} allowed tools retrieved.", "DEBUG")
+
+			# the memory chain without tools output streams in the background while the tool agent runs
+			speculation = None
+			if AGENT_SPECULATIVE_MEMORY_CHAIN:
+				self.count_speculation("started")
+				speculation = SpeculativeChain(self.memory_chain(prompt_prefix, prompt_suffix, context), {**agent_input})
+			tool_agent_started_at = time.perf_counter()
+
+			try:
+				tools_result = None
+				try:
+					tools_result = await self.aexecute_tool_agent(agent_input, allowed_tools, context)
+				except Exception as e:
+					error_description = str(e)
+					log(error_description, "ERROR")
+
+				# If tools_result["output"] is None the LLM has used the fake tool none_of_the_others
+				if tools_result is not None and tools_result["output"] is not None:
+					if speculation is not None:
+						speculation.cancel()
+						self.settle_speculation(context, False, time.perf_counter() - tool_agent_started_at)
+						speculation = None
+
+					used_tools = list(map(lambda x: ((x[0].tool, x[0].tool_input), x[1]), tools_result["intermediate_steps"]))
+					return_direct_tools = [t.name for t in allowed_tools if t.return_direct]
+
+					# a tool with return_direct is definitely the last one used
+					if len(used_tools) > 0 and used_tools[-1][0][0] in return_direct_tools:
+						tools_result["intermediate_steps"] = used_tools
+						yield tools_result
+						return
+
+					agent_input["tools_output"] = "## Tools output: \n" + tools_result["output"] if tools_result["output"] else ""
+
+				# the tools had nothing: the chunks already written by the memory chain are sent at once
+				elif speculation is not None:
+					self.settle_speculation(context, True, time.perf_counter() - tool_agent_started_at)
+					async for chunk in speculation:
+						yield chunk
+					return
+			finally:
+				# the chat ended early (an error, a client gone...)
+				if speculation is not None:
+					speculation.cancel()
+
+		async for chunk in self.memory_chain(prompt_prefix, prompt_suffix, context).astream(agent_input):
+			yield chunk
+
+	def memory_chain(self, prompt_prefix, prompt_suffix, context):
+		memory_chain = self.memory_prompt(prompt_prefix, prompt_suffix) | context.llm
+		return config_metadata_chain(memory_chain, {"email": context.email})
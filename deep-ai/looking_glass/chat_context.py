@@ -0,0 +1,24 @@
+from memory.working_memory import WorkingMemory
+
+
+class ChatContext:
+	"""
+	State of one chat request: its working memory, models, user, and the hooks and tools of the plugins used by its
+	knowledge base (`mad_hatter`, see `mad_hatter.mad_hatter.ChatPlugins`).
+	Hooks and tools receive it as `bot`: what is not per chat (memory, db, black_hole...) is the one of the DeepAI
+	instance, so concurrent chats of one process never see each other's state.
+	"""
+
+	def __init__(self, bot, knowledge_base_id, llm=None, embedder=None, user=None):
+		self.bot = bot
+		self.mad_hatter = bot.mad_hatter.for_chat(knowledge_base_id, self)
+		self.llm = llm or bot.llm
+		self.embedder = embedder or bot.embedder
+		self.user = user
+		# Used for tools `get_my_user_information`
+		self.email = user.email if user is not None else None
+		self.working_memory = WorkingMemory()
+
+	def __getattr__(self, name):
+		# only called for the attributes the context does not have
+		return getattr(self.bot, name)
@@ -113,6 +113,15 @@ def before_bot_recalls_declarative_memories(declarative_recall_config: dict, bot
 	The hook return the values for maximum number (k) of items to retrieve from memory and the score threshold applied
 	to the query in the vector memory (items with score under threshold are not retrieved)
 	It also returns the embedded query (embedding) and the conditions on recall (metadata).
+	The retrieval mode (retrieval) is `vector`, `keyword` (BM25, the query is not embedded and the threshold
+	is ignored) or `hybrid` (reciprocal rank fusion of both rankings, of the documents passing the threshold
+	in the vector search when there is one; scores are fused ranks, not comparable with vector scores).
+	Conditions on `source`, `when` ({"gte": ..., "lt": ...} ranges) and the Feishu `space_id` / `node_token`
+	(a value or a list of values) select the documents to search before searching them.
+	The re-ranking (rerank), off by default, fetches `fetch_k` candidates once set and picks the k memories by maximal
+	marginal relevance (`mmr_lambda`, 1 for relevance only), after adding the `recency_boost` and the `source_boosts`
+	to their relevance.
+	Each memory then comes with the chunks around it in its file (neighbours on each side), merged into one text.
 
 	Parameters
 	----------
@@ -142,6 +151,11 @@ def before_bot_recalls_procedural_memories(procedural_recall_config: dict, bot)
 	The hook return the values for maximum number (k) of items to retrieve from memory and the score threshold applied
 	to the query in the vector memory (items with score under threshold are not retrieved)
 	It also returns the embedded query (embedding) and the conditions on recall (metadata).
+	The retrieval mode (retrieval) is `vector`, `keyword` (BM25, the query is not embedded and the threshold
+	is ignored) or `hybrid` (reciprocal rank fusion of both rankings, of the documents passing the threshold
+	in the vector search when there is one; scores are fused ranks, not comparable with vector scores).
+	Conditions on `source`, `when` ({"gte": ..., "lt": ...} ranges) and the Feishu `space_id` / `node_token`
+	(a value or a list of values) select the documents to search before searching them.
 
 	Parameters
 	----------
@@ -1,16 +1,22 @@
 import glob
+import inspect
 import os
 import shutil
 import time
 import traceback
 
+import numpy as np
 from langchain_community.vectorstores.faiss import FAISS
 
 from db import crud_activeplugin, crud_knowledgebase
+from factory.embedding_scheduler import embedding_scheduler
 from infrastructure.package import Package
 from install_plugin_dependencies import install_plugin_dependencies
 from log import log
 from mad_hatter.plugin import Plugin
+from memory.ann_index import store_vectors
+from memory.index_namespace import embedder_namespace
+from memory.vector_memory import VectorMemoryCollection
 
 
 # This class is responsible for plugins functionality:
@@ -34,8 +40,9 @@ class MadHatter:
 		self.tools = []  # list of active plugins tools
 		self.active_plugins = []
 
-		# plugins per knowledge base
-		self.use_plugins = []
+		# L2-normalized embeddings of the active tools with their documents and plugins per embedder namespace,
+		# see `recall_tools`
+		self.tool_matrices: dict[str, tuple] = {}
 
 		self.find_plugins()
 
@@ -123,9 +130,9 @@ class MadHatter:
 		if filter_plugins is None:
 			filter_plugins = self.active_plugins
 
-		# emptying tools and hooks
-		self.hooks = []
-		self.tools = []
+		# new lists, swapped at the end: chats never see them half filled
+		hooks = []
+		tools = []
 
 		for _, plugin in self.plugins.items():
 			if plugin.id in filter_plugins:
@@ -133,11 +140,12 @@ class MadHatter:
 					# Prepare the tool to be used in the Bot (setting the bot instance, adding properties)
 					t.augment_tool(self.bot)
 
-				self.hooks += plugin.hooks
-				self.tools += plugin.tools
+				hooks += plugin.hooks
+				tools += plugin.tools
 
 		# sort hooks by priority
-		self.hooks.sort(key=lambda x: x.priority, reverse=True)
+		hooks.sort(key=lambda x: x.priority, reverse=True)
+		self.hooks, self.tools = hooks, tools
 
 	def get_use_plugins(self, knowledge_base_id):
 		use_plugins = crud_knowledgebase.get_use_plugins_by_id(next(self.bot.db()), knowledge_base_id)
@@ -151,13 +159,9 @@ class MadHatter:
 
 		return use_plugins
 
-	def sync_hooks_and_tools_when_chat(self, knowledge_base_id):
-		self.use_plugins = self.get_use_plugins(knowledge_base_id)
-
-		if len(self.use_plugins) == 0:
-			return
-
-		self.sync_hooks_and_tools(self.use_plugins)
+	def for_chat(self, knowledge_base_id, context) -> "ChatPlugins":
+		"""Hooks and tools of the plugins used by the knowledge base, bound to the context of a chat."""
+		return ChatPlugins(self, self.get_use_plugins(knowledge_base_id), context)
 
 	# check if plugin exists
 	def plugin_exists(self, plugin_id):
@@ -186,7 +190,7 @@ class MadHatter:
 
 		# retrieve from vectorDB all tool embeddings
 		vector_db: FAISS = self.bot.memory.vectors.faiss_db(index_name)
-		tools_in_vector_db = vector_db.docstore.__dict__['_dict']
+		tools_in_vector_db = VectorMemoryCollection.documents(vector_db)
 
 		# easy access to plugin tools
 		plugins_tools_index = {t.description: t for t in self.tools}
@@ -204,30 +208,97 @@ class MadHatter:
 				log(f"Deleting embedded tool: {doc_id} - {tools_in_vector_db[doc_id].page_content}", "WARNING")
 				ids_to_be_deleted.append(doc_id)
 
-		if len(ids_to_be_deleted) > 0:
-			# vector_db.delete(ids=ids_to_be_deleted)
-			log(f"Ids to be deleted: {ids_to_be_deleted}")
-			vector_db = self.bot.memory.vectors.remove(index_name, ids_to_be_deleted)
-
-		# loop over tools
-		for tool in self.tools:
-			# if there is no doc_id, create it
-			if not tool.doc_id:
-				# save it to DB
-				ids_inserted = vector_db.add_texts(
-					[tool.description],
+		# removals and additions are applied together
+		with self.bot.memory.vectors.transaction(index_name) as transaction:
+			if len(ids_to_be_deleted) > 0:
+				log(f"Ids to be deleted: {ids_to_be_deleted}")
+				transaction.remove(ids_to_be_deleted)
+
+			# embed the tools which have no doc_id yet, all at once
+			new_tools = [tool for tool in self.tools if not tool.doc_id]
+			if len(new_tools) > 0:
+				descriptions = [tool.description for tool in new_tools]
+				embeddings = embedding_scheduler.embed_documents(self.bot.embedder, descriptions)
+
+				# save them to DB
+				ids_inserted = transaction.add_embeddings(
+					list(zip(descriptions, embeddings)),
 					[{
 						"source": "tool",
 						"when": time.time(),
 						"name": tool.name,
 						"docstring": tool.docstring
-					}],
+					} for tool in new_tools],
 				)
 
-				tool.doc_id = ids_inserted[0]
-				log(f"Newly embedded tool: {tool.doc_id} - {tool.description}", "WARNING")
-		# save to local
-		vector_db.save_local(self.bot.common_storage, index_name)
+				for tool, doc_id in zip(new_tools, ids_inserted):
+					tool.doc_id = doc_id
+					log(f"Newly embedded tool: {tool.doc_id} - {tool.description}", "WARNING")
+
+		self.build_tool_matrix(transaction.faiss_db or vector_db)
+
+	def build_tool_matrix(self, vector_db: FAISS):
+		"""Keep the embeddings of the active tools in memory, to recall tools without searching the procedural index."""
+		positions = {doc_id: position for position, doc_id in vector_db.index_to_docstore_id.items()}
+		documents = VectorMemoryCollection.documents(vector_db)
+		tools = [tool for tool in self.tools if tool.doc_id in positions and tool.doc_id in documents]
+
+		vectors = np.zeros((0, 0), dtype=np.float32)
+		if len(tools) > 0:
+			vectors = store_vectors(vector_db)[[positions[tool.doc_id] for tool in tools]].astype(np.float32)
+		vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+		# the procedural index is shared by the embedders: its vectors are the ones of the embedder of the bootstrap
+		self.tool_matrices = {
+			embedder_namespace(self.bot.embedder): (
+				vectors,
+				[documents[tool.doc_id] for tool in tools],
+				np.array([tool.plugin_id for tool in tools], dtype=object)
+			)
+		}
+		log(f"{len(tools)} tools kept in memory for recall", "DEBUG")
+
+	def tool_matrix(self, embedder) -> tuple:
+		"""The tool matrix for an embedder, the tool descriptions embedded again the first time it is used."""
+		namespace = embedder_namespace(embedder)
+		tool_matrices = self.tool_matrices
+		if namespace in tool_matrices:
+			return tool_matrices[namespace]
+		if len(tool_matrices) == 0:
+			return np.zeros((0, 0), dtype=np.float32), [], np.array([], dtype=object)
+
+		_, documents, plugin_ids = next(iter(tool_matrices.values()))
+		vectors = np.zeros((0, 0), dtype=np.float32)
+		if len(documents) > 0:
+			vectors = np.asarray(
+				embedding_scheduler.embed_documents(embedder, [doc.page_content for doc in documents]), dtype=np.float32
+			)
+		vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+		self.tool_matrices = {**tool_matrices, namespace: (vectors, documents, plugin_ids)}
+		log(f"{len(documents)} tools embedded again for {namespace}", "DEBUG")
+		return self.tool_matrices[namespace]
+
+	def recall_tools(
+		self, query_embedding: list[float], k: int, threshold: float | None = None, embedder=None, use_plugins=None
+	) -> list:
+		"""
+		Tools closest to the query among the ones of the plugins used by a knowledge base, as (document, score)
+		like the procedural vectorstore: the squared L2 distance between the normalized embeddings.
+		"""
+		if query_embedding is None:
+			return []
+		vectors, documents, plugin_ids = self.tool_matrix(embedder or self.bot.embedder)
+		if len(documents) == 0:
+			return []
+
+		query = np.asarray(query_embedding, dtype=np.float32)
+		query /= max(float(np.linalg.norm(query)), 1e-12)
+		scores = 2 - 2 * (vectors @ query)
+		scores[~np.isin(plugin_ids, list(use_plugins or self.active_plugins))] = np.inf
+		if threshold is not None:
+			scores[scores > threshold] = np.inf
+
+		best = np.argsort(scores)[:k]
+		return [(documents[i], float(scores[i])) for i in best if np.isfinite(scores[i])]
 
 	# activate / deactivate plugin
 	def toggle_plugin(self, plugin_id):
@@ -261,9 +332,49 @@ class MadHatter:
 
 	# execute requested hook
 	def execute_hook(self, hook_name, *args):
-		for h in self.hooks:
-			if hook_name == h.name:
-				return h.function(*args, bot=self.bot)
+		return run_hook(self.hooks, hook_name, args, self.bot)
+
+	async def aexecute_hook(self, hook_name, *args):
+		return await arun_hook(self.hooks, hook_name, args, self.bot)
+
+
+class ChatPlugins:
+	"""
+	Hooks and tools of the plugins used by the knowledge base of a chat, the `mad_hatter` of its `ChatContext`:
+	hooks and tools receive the context as `bot`, the other attributes are the ones of the MadHatter.
+	"""
+
+	def __init__(self, mad_hatter: MadHatter, use_plugins: list[str], context):
+		self.mad_hatter = mad_hatter
+		self.use_plugins = use_plugins
+		self.context = context
+		self.hooks = [h for h in mad_hatter.hooks if h.plugin_id in use_plugins]
+		# copies: the tools of the MadHatter are shared by the chats
+		self.tools = [t.copy(update={"bot": context}) for t in mad_hatter.tools if t.plugin_id in use_plugins]
+
+	def __getattr__(self, name):
+		return getattr(self.mad_hatter, name)
+
+	def execute_hook(self, hook_name, *args):
+		return run_hook(self.hooks, hook_name, args, self.context)
+
+	async def aexecute_hook(self, hook_name, *args):
+		return await arun_hook(self.hooks, hook_name, args, self.context)
+
+	def recall_tools(self, query_embedding: list[float], k: int, threshold: float | None = None) -> list:
+		return self.mad_hatter.recall_tools(query_embedding, k, threshold, self.context.embedder, self.use_plugins)
+
+
+def run_hook(hooks: list, hook_name: str, args: tuple, bot):
+	for h in hooks:
+		if hook_name == h.name:
+			return h.function(*args, bot=bot)
+
+	# every hook must have a default in core_plugin
+	raise Exception(f"Hook {hook_name} not present in any plugin")
+
 
-		# every hook must have a default in core_plugin
-		raise Exception(f"Hook {hook_name} not present in any plugin")
+async def arun_hook(hooks: list, hook_name: str, args: tuple, bot):
+	"""`run_hook` for async callers: hooks may be coroutines, awaited then."""
+	result = run_hook(hooks, hook_name, args, bot)
+	return await result if inspect.isawaitable(result) else result
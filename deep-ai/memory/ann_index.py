@@ -0,0 +1,352 @@
+import json
+import math
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores.faiss import FAISS
+from pydantic import BaseModel
+
+from log import log
+from memory.faiss_store import DeepAIFAISS
+from memory.index_cache import files_stamp, index_files
+from memory.index_namespace import base_index_name
+
+# Vector counts from which a knowledge base index in `auto` mode is rebuilt as HNSW, then as IVF-Flat
+FAISS_HNSW_THRESHOLD = int(os.getenv("FAISS_HNSW_THRESHOLD", 50000))
+FAISS_IVF_THRESHOLD = int(os.getenv("FAISS_IVF_THRESHOLD", 1000000))
+# Default search parameters, overridable per knowledge base
+FAISS_IVF_NPROBE = int(os.getenv("FAISS_IVF_NPROBE", 16))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", 64))
+# recall@k against exact search an ANN index must reach before it replaces the current one
+FAISS_ANN_MIN_RECALL = float(os.getenv("FAISS_ANN_MIN_RECALL", 0.95))
+FAISS_HNSW_M = 32
+FAISS_ANN_RECALL_QUERIES = 200
+FAISS_ANN_RECALL_K = 10
+# nprobe / efSearch are doubled until the recall is reached, up to this value
+FAISS_ANN_MAX_SEARCH_PARAM = 1024
+# Quantizers need training data, smaller indexes are kept as float32
+FAISS_QUANTIZATION_MIN_VECTORS = 10000
+# Dimensions encoded by each byte of a PQ code
+FAISS_PQ_DIMS_PER_CODE = 8
+
+IndexType = Literal["auto", "flat", "ivf", "hnsw"]
+Quantization = Literal["none", "sq8", "pq"]
+
+
+class IndexSettings(BaseModel):
+	"""Per knowledge base index settings, stored next to the index files."""
+	index_type: IndexType = "auto"
+	nprobe: Optional[int] = None
+	ef_search: Optional[int] = None
+	quantization: Quantization = "none"
+	# keep the float32 vectors on disk to re-rank the candidates of a quantized index
+	rerank: bool = False
+
+	@staticmethod
+	def path(folder_path: str, index_name: str) -> str:
+		# shared by the indexes of the knowledge base for every embedder
+		return os.path.join(folder_path, f"{base_index_name(index_name)}.index.json")
+
+	@classmethod
+	def load(cls, folder_path: str, index_name: str) -> "IndexSettings":
+		try:
+			with open(cls.path(folder_path, index_name), "r") as f:
+				return cls(**json.load(f))
+		except FileNotFoundError:
+			return cls()
+
+	def save(self, folder_path: str, index_name: str):
+		path = self.path(folder_path, index_name)
+		# unique per writer, so concurrent saves (of other processes, or the promoter) never mix their files
+		tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(self.dict(), f)
+		os.replace(tmp_path, path)
+
+	@property
+	def explicit(self) -> bool:
+		"""Chosen for the knowledge base, rather than derived from its size."""
+		return self.index_type != "auto" or self.quantization != "none"
+
+	def target_type(self, ntotal: int) -> str:
+		if self.index_type != "auto":
+			return self.index_type
+		if ntotal >= FAISS_IVF_THRESHOLD:
+			return "ivf"
+		if ntotal >= FAISS_HNSW_THRESHOLD:
+			return "hnsw"
+		return "flat"
+
+	def target_quantization(self, ntotal: int) -> str:
+		return self.quantization if ntotal >= FAISS_QUANTIZATION_MIN_VECTORS else "none"
+
+	def target(self, ntotal: int) -> tuple[str, str]:
+		return self.target_type(ntotal), self.target_quantization(ntotal)
+
+
+def index_type(index) -> str:
+	index = faiss.downcast_index(index)
+	if isinstance(index, faiss.IndexHNSW):
+		return "hnsw"
+	try:
+		faiss.extract_index_ivf(index)
+		return "ivf"
+	except RuntimeError:
+		return "flat"
+
+
+def index_quantization(index) -> str:
+	index = faiss.downcast_index(index)
+	if isinstance(index, faiss.IndexHNSW):
+		index = faiss.downcast_index(index.storage)
+	if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+		return "sq8"
+	if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+		return "pq"
+	return "none"
+
+
+def index_kind(index) -> tuple[str, str]:
+	return index_type(index), index_quantization(index)
+
+
+def apply_search_params(index, settings: IndexSettings):
+	"""Set nprobe / efSearch of a loaded index from the knowledge base settings."""
+	kind = index_type(index)
+	if kind == "ivf":
+		faiss.extract_index_ivf(index).nprobe = settings.nprobe or FAISS_IVF_NPROBE
+	elif kind == "hnsw":
+		faiss.downcast_index(index).hnsw.efSearch = settings.ef_search or FAISS_HNSW_EF_SEARCH
+
+
+def ensure_direct_map(index):
+	"""
+	Build the id -> list map reconstructing vectors from an IVF index needs, when it has none: once, when the index is
+	loaded, before searches share it. Vectors added later are mapped as they are added.
+	"""
+	if index_type(index) == "ivf":
+		ivf = faiss.extract_index_ivf(index)
+		if ivf.direct_map.type == faiss.DirectMap.NoMap:
+			ivf.make_direct_map()
+
+
+def reconstruct_all(index) -> np.ndarray:
+	ensure_direct_map(index)
+	return index.reconstruct_n(0, index.ntotal)
+
+
+def store_vectors(faiss_db: FAISS) -> np.ndarray:
+	"""Vectors of a vectorstore by position, exact ones if they are kept aside of a quantized index."""
+	if isinstance(faiss_db, DeepAIFAISS) and faiss_db.has_exact_vectors:
+		return faiss_db.all_exact_vectors()
+	return reconstruct_all(faiss_db.index)
+
+
+def remove_positions(faiss_db: FAISS, positions: np.ndarray):
+	"""
+	Remove vectors from a vectorstore index, the following ones being shifted down like `IndexFlat.remove_ids` does,
+	so that the positions keep matching the docstore mapping.
+	"""
+	index = faiss_db.index
+	if index_type(index) == "flat":
+		index.remove_ids(positions.astype(np.int64))
+	else:
+		# IVF keeps the ids of the remaining vectors and HNSW cannot remove at all, so the vectors are added again
+		keep = np.ones(index.ntotal, dtype=bool)
+		keep[positions] = False
+		vectors = store_vectors(faiss_db)[keep]
+		index.reset()
+		index.add(vectors)
+
+	if isinstance(faiss_db, DeepAIFAISS):
+		faiss_db.remove_exact_vectors(positions)
+
+
+def factory_string(kind: str, quantization: str, dim: int, ntotal: int) -> str:
+	"""`faiss.index_factory` description of an index type."""
+	pq_codes = dim // FAISS_PQ_DIMS_PER_CODE
+	while pq_codes > 1 and dim % pq_codes != 0:
+		pq_codes -= 1
+	pq_codes = max(1, pq_codes)
+
+	if kind == "ivf":
+		# ~4 * sqrt(n) lists
+		nlist = max(1, min(65536, int(4 * math.sqrt(ntotal))))
+		encoding = {"none": "Flat", "sq8": "SQ8", "pq": f"PQ{pq_codes}x8"}[quantization]
+		return f"IVF{nlist},{encoding}"
+	if kind == "hnsw":
+		encoding = {"none": "", "sq8": "_SQ8", "pq": f"_PQ{pq_codes}"}[quantization]
+		return f"HNSW{FAISS_HNSW_M}{encoding}"
+	return {"none": "Flat", "sq8": "SQ8", "pq": f"PQ{pq_codes}x8"}[quantization]
+
+
+def build_index(kind: str, quantization: str, vectors: np.ndarray, metric_type: int):
+	"""Build an index of the given type over the vectors, the position of each vector being its id."""
+	index = faiss.index_factory(vectors.shape[1], factory_string(kind, quantization, *vectors.shape[::-1]), metric_type)
+	if not index.is_trained:
+		# trained on up to 64 vectors per IVF list / PQ centroid
+		max_samples = 64 * max(256, faiss.extract_index_ivf(index).nlist if kind == "ivf" else 0)
+		sample = vectors
+		if len(vectors) > max_samples:
+			sample = vectors[np.random.default_rng(0).choice(len(vectors), max_samples, replace=False)]
+		index.train(sample)
+	index.add(vectors)
+	if kind == "ivf":
+		faiss.extract_index_ivf(index).make_direct_map()
+	return index
+
+
+def recall_at_k(faiss_db: FAISS, vectors: np.ndarray, k: int = FAISS_ANN_RECALL_K) -> float:
+	"""Share of the exact k nearest neighbours found by the vectorstore, over a sample of its vectors."""
+	# the vectors of removed documents are not searched
+	live = np.setdiff1d(np.arange(len(vectors)), getattr(faiss_db, "tombstones", ()))
+	k = min(k, len(live))
+	rng = np.random.default_rng(0)
+	queries = vectors[rng.choice(live, min(FAISS_ANN_RECALL_QUERIES, len(live)), replace=False)]
+	_, exact = faiss.knn(queries, vectors[live], k, metric=faiss_db.index.metric_type)
+	exact = live[exact]
+	if isinstance(faiss_db, DeepAIFAISS):
+		found = [faiss_db._search_index(query[None, :], k)[1][0] for query in queries]
+	else:
+		found = faiss_db.index.search(queries, k)[1]
+	hits = sum(len(np.intersect1d(e, f)) for e, f in zip(exact, found))
+	return hits / exact.size
+
+
+def tune_search_params(faiss_db: FAISS, vectors: np.ndarray, settings: IndexSettings) -> float:
+	"""
+	Raise nprobe / efSearch (unless fixed in the settings) until the recall is reached.
+	The values found are written back to the settings, returns the recall.
+	"""
+	index = faiss_db.index
+	kind = index_type(index)
+	apply_search_params(index, settings)
+	recall = recall_at_k(faiss_db, vectors)
+	while recall < FAISS_ANN_MIN_RECALL:
+		if kind == "ivf" and settings.nprobe is None:
+			ivf = faiss.extract_index_ivf(index)
+			if ivf.nprobe >= min(ivf.nlist, FAISS_ANN_MAX_SEARCH_PARAM):
+				break
+			ivf.nprobe = min(ivf.nprobe * 2, ivf.nlist)
+		elif kind == "hnsw" and settings.ef_search is None:
+			hnsw = faiss.downcast_index(index).hnsw
+			if hnsw.efSearch >= FAISS_ANN_MAX_SEARCH_PARAM:
+				break
+			hnsw.efSearch = hnsw.efSearch * 2
+		else:
+			break
+		recall = recall_at_k(faiss_db, vectors)
+
+	if kind == "ivf" and settings.nprobe is None:
+		settings.nprobe = faiss.extract_index_ivf(index).nprobe
+	elif kind == "hnsw" and settings.ef_search is None:
+		settings.ef_search = faiss.downcast_index(index).hnsw.efSearch
+	return recall
+
+
+class IndexPromoter:
+	"""
+	Rebuilds knowledge base indexes in the background when their settings or size call for another index type
+	(flat -> HNSW -> IVF-Flat). The new index replaces the current one only if its recall@k is high enough.
+	"""
+
+	def __init__(self):
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-promoter")
+		self._pending: set[tuple] = set()
+		# (folder_path, index_name) -> vector count of a rebuild discarded for its recall, retried at twice the size
+		self._rejected: dict[tuple, int] = {}
+		self._lock = threading.Lock()
+
+	def needs_rebuild(self, faiss_db: FAISS, folder_path: str, index_name: str) -> bool:
+		settings = IndexSettings.load(folder_path, index_name)
+		return settings.target(faiss_db.index.ntotal) != index_kind(faiss_db.index)
+
+	def maybe_schedule(self, vector_memory, faiss_db: FAISS, index_name: str, folder_path: str):
+		if not self.needs_rebuild(faiss_db, folder_path, index_name):
+			return
+
+		key = (os.path.abspath(folder_path), index_name)
+		with self._lock:
+			if key in self._pending or faiss_db.index.ntotal < 2 * self._rejected.get(key, 0):
+				return
+			self._pending.add(key)
+		self._executor.submit(self._run, vector_memory, index_name, folder_path, key)
+
+	def reset(self, folder_path: str, index_name: str):
+		"""Forget the rebuilds discarded for an index, after its settings changed."""
+		with self._lock:
+			self._rejected.pop((os.path.abspath(folder_path), index_name), None)
+
+	def _run(self, vector_memory, index_name: str, folder_path: str, key: tuple):
+		try:
+			with self._lock:
+				self._pending.discard(key)
+			stamp = files_stamp(index_files(folder_path, index_name))
+			# a private copy, mutations committed meanwhile stay in the mutation log and are replayed on top of it
+			faiss_db = vector_memory.load(index_name, folder_path)
+			promoted_db = self.promote(faiss_db, folder_path, index_name)
+			if promoted_db is None:
+				if self.needs_rebuild(faiss_db, folder_path, index_name):
+					with self._lock:
+						self._rejected[key] = faiss_db.index.ntotal
+				return
+			if not vector_memory.save(promoted_db, index_name, folder_path, expected_stamp=stamp):
+				# another snapshot was written meanwhile, the next write will schedule the rebuild again
+				log(f"FAISS index {index_name} changed during its rebuild, discarding it", "INFO")
+		except Exception as e:
+			log(f"Failed to rebuild FAISS index {index_name}: {e}", "ERROR")
+
+	@staticmethod
+	def promote(faiss_db: FAISS, folder_path: str, index_name: str) -> FAISS | None:
+		"""The vectorstore with a rebuilt index, None if the current index is kept."""
+		settings = IndexSettings.load(folder_path, index_name)
+		if settings.target(faiss_db.index.ntotal) == index_kind(faiss_db.index) or faiss_db.index.ntotal == 0:
+			return None
+
+		rebuilt_db, recall = rebuild(faiss_db, settings, index_name)
+		# sizes chosen automatically must not cost recall, explicit settings are applied anyway
+		if recall < FAISS_ANN_MIN_RECALL and not settings.explicit:
+			log(f"FAISS index {index_name} rebuilt recall is below {FAISS_ANN_MIN_RECALL}, keeping the current index", "WARNING")
+			return None
+		settings.save(folder_path, index_name)
+		return rebuilt_db
+
+
+def rebuild(faiss_db: FAISS, settings: IndexSettings, index_name: str) -> tuple[DeepAIFAISS, float]:
+	"""
+	Rebuild the index of a vectorstore according to its settings, into a new vectorstore
+	(the one being served may receive writes meanwhile). Returns it with its recall@k.
+	"""
+	kind, quantization = settings.target(faiss_db.index.ntotal)
+	log(f"Rebuilding FAISS index {index_name} ({faiss_db.index.ntotal} vectors) from {index_kind(faiss_db.index)} to {(kind, quantization)}", "INFO")
+	vectors = np.ascontiguousarray(store_vectors(faiss_db), dtype=np.float32)
+	index = build_index(kind, quantization, vectors, faiss_db.index.metric_type)
+
+	rebuilt_db = DeepAIFAISS(
+		faiss_db.embedding_function,
+		index,
+		faiss_db.docstore,
+		dict(faiss_db.index_to_docstore_id),
+		normalize_L2=faiss_db._normalize_L2,
+		distance_strategy=faiss_db.distance_strategy
+	)
+	rebuilt_db.wal_position = getattr(faiss_db, "wal_position", None)
+	rebuilt_db.keyword_index = getattr(faiss_db, "keyword_index", None)
+	rebuilt_db.metadata_index = getattr(faiss_db, "metadata_index", None)
+	rebuilt_db.chunk_index = getattr(faiss_db, "chunk_index", None)
+	if quantization != "none" and settings.rerank:
+		rebuilt_db.set_exact_vectors(vectors)
+
+	if kind == "flat" and quantization == "none":
+		return rebuilt_db, 1.0
+	recall = tune_search_params(rebuilt_db, vectors, settings)
+	log(f"FAISS index {index_name} {(kind, quantization)} recall@{FAISS_ANN_RECALL_K}: {recall:.3f}", "INFO")
+	return rebuilt_db, recall
+
+
+index_promoter = IndexPromoter()
@@ -0,0 +1,40 @@
+# Characters compared to find the overlap of consecutive chunks, beyond the splitters' overlaps
+MAX_CHUNK_OVERLAP = 1000
+
+
+class ChunkIndex:
+	"""
+	Docstore ids of the chunks of every source (file, Feishu document) by their ordinal in it, as recorded at ingestion:
+	the neighbours of a recalled chunk are found without searching. A source ingested again maps to its latest chunks.
+	"""
+
+	def __init__(self):
+		# source -> ordinal -> docstore id
+		self.chunks: dict[str, dict[int, str]] = {}
+
+	def add(self, ids: list[str], metadatas: list[dict]):
+		for _id, metadata in zip(ids, metadatas):
+			ordinal = metadata.get("ordinal")
+			if isinstance(ordinal, int) and metadata.get("source") is not None:
+				self.chunks.setdefault(metadata["source"], {})[ordinal] = _id
+
+	def ids(self, source: str, ordinals: list[int]) -> dict[int, str]:
+		chunks = self.chunks.get(source, {})
+		return {ordinal: chunks[ordinal] for ordinal in ordinals if ordinal in chunks}
+
+	def copy(self) -> "ChunkIndex":
+		copied = ChunkIndex()
+		copied.chunks = {source: dict(chunks) for source, chunks in self.chunks.items()}
+		return copied
+
+
+def merge_chunks(texts: list[str]) -> str:
+	"""Text of consecutive chunks, the overlap of each chunk with the previous one written once."""
+	merged = texts[0] if texts else ""
+	for text in texts[1:]:
+		overlap = next(
+			(n for n in range(min(len(merged), len(text), MAX_CHUNK_OVERLAP), 0, -1) if merged.endswith(text[:n])),
+			0
+		)
+		merged += text[overlap:] if overlap > 0 else f"\n{text}"
+	return merged
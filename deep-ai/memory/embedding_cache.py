@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from log import log
+from memory.index_namespace import embedder_namespace
+
+try:
+	import fcntl
+except ImportError:
+	# Windows: writers of other processes are not locked out
+	fcntl = None
+
+# Folder of the persistent embedding cache, one sub folder per embedder model
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH") or os.path.join(os.getenv("STORAGE_ROOT") or "storage", "embedding_cache")
+# Size cap of each embedder model cache, 0 disables the cache
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Share of the cache kept (most recently used first) when it reaches its size cap
+EMBEDDING_CACHE_KEEP_RATIO = 0.75
+# In-process cache of query embeddings: max entries and seconds before an entry expires
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 2048))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 3600))
+
+
+def text_digest(text: str) -> bytes:
+	return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def normalize_query(text: str) -> str:
+	"""Normalize unicode forms and whitespace, so trivially different questions share a cache entry."""
+	return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class EmbeddingStore:
+	"""Append-only file of (sha256, float32 vector) records for a single embedder model.
+
+	The file is memory-mapped for reads and indexed by a digest -> row dict.
+	Records are only ever appended, so several processes can share the same file; a compaction
+	(when the size cap is reached) rewrites it atomically, under the lock appends take too.
+	A rewritten file (a new inode) is mapped and indexed again from scratch.
+	"""
+
+	def __init__(self, folder_path: str, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+		self.folder_path = folder_path
+		self.max_bytes = max_bytes
+		self.records_path = os.path.join(folder_path, "embeddings.bin")
+		self.meta_path = os.path.join(folder_path, "meta.json")
+		self.lock_path = f"{self.records_path}.lock"
+
+		self.dim = None
+		self.dtype = None
+		self._records = None  # memory-mapped records
+		self._inode = None  # of the mapped file
+		self._index: dict[bytes, int] = {}
+		self._last_used = np.zeros(0, dtype=np.uint64)
+		self._tick = 0
+		self._lock = threading.Lock()
+
+		if os.path.exists(self.meta_path):
+			with open(self.meta_path, "r") as f:
+				self._set_dim(json.load(f)["dim"])
+			self._reload()
+
+	def _set_dim(self, dim: int):
+		self.dim = dim
+		self.dtype = np.dtype([("key", "S32"), ("vector", "<f4", (dim,))])
+
+	def _file_rows(self) -> int:
+		try:
+			return os.path.getsize(self.records_path) // self.dtype.itemsize
+		except OSError:
+			return 0
+
+	@contextmanager
+	def _file_lock(self):
+		"""Exclusive access to the records file, between the processes appending to or compacting it."""
+		if fcntl is None:
+			yield
+			return
+		with open(self.lock_path, "a") as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+	def _reset(self):
+		self._records = None
+		self._inode = None
+		self._index = {}
+		self._last_used = np.zeros(0, dtype=np.uint64)
+
+	def _reload(self):
+		self._reset()
+		self._refresh()
+
+	def _refresh(self):
+		"""Pick up records appended since the last mapping, also by other processes."""
+		try:
+			f = open(self.records_path, "rb")
+		except FileNotFoundError:
+			return
+
+		with f:
+			# the file opened is the one mapped, even if it is replaced meanwhile
+			stat = os.fstat(f.fileno())
+			rows = stat.st_size // self.dtype.itemsize
+			mapped_rows = 0 if self._records is None else len(self._records)
+			if self._records is not None and (stat.st_ino != self._inode or rows < mapped_rows):
+				# the file has been compacted by another process: rows are not where they were
+				self._reset()
+				mapped_rows = 0
+			if rows == mapped_rows:
+				return
+
+			self._records = np.memmap(f, dtype=self.dtype, mode="r", shape=(rows,))
+			self._inode = stat.st_ino
+
+		for row, key in enumerate(self._records["key"][mapped_rows:], start=mapped_rows):
+			self._index[bytes(key)] = row
+		self._last_used = np.concatenate([self._last_used, np.zeros(rows - mapped_rows, dtype=np.uint64)])
+
+	def get_many(self, keys: list[bytes]) -> dict[bytes, np.ndarray]:
+		with self._lock:
+			if self.dim is None:
+				return {}
+			if any(key not in self._index for key in keys):
+				self._refresh()
+
+			found = {}
+			self._tick += 1
+			for key in keys:
+				row = self._index.get(key)
+				if row is not None:
+					found[key] = np.array(self._records[row]["vector"])
+					self._last_used[row] = self._tick
+			return found
+
+	def put_many(self, keys: list[bytes], vectors: np.ndarray):
+		if len(keys) == 0:
+			return
+
+		with self._lock:
+			if self.dim is None:
+				os.makedirs(self.folder_path, exist_ok=True)
+				self._set_dim(len(vectors[0]))
+				with open(self.meta_path, "w") as f:
+					json.dump({"dim": self.dim}, f)
+
+			records = np.zeros(len(keys), dtype=self.dtype)
+			records["key"] = keys
+			records["vector"] = np.asarray(vectors, dtype=np.float32)
+			# under the lock, no compaction of another process can replace the file appended to
+			with self._file_lock():
+				# a single append per batch, so concurrent writers never interleave inside a record
+				with open(self.records_path, "ab") as f:
+					f.write(records.tobytes())
+
+				self._refresh()
+				self._tick += 1
+				for key in keys:
+					self._last_used[self._index[key]] = self._tick
+
+				if self._file_rows() * self.dtype.itemsize > self.max_bytes:
+					self._compact()
+
+	def _compact(self):
+		"""Keep the most recently used records only, rewriting the file atomically. To be called holding the file lock."""
+		keep_rows = int(self.max_bytes * EMBEDDING_CACHE_KEEP_RATIO) // self.dtype.itemsize
+		rows = np.sort(np.argsort(self._last_used, kind="stable")[::-1][:keep_rows])
+		log(f"Embedding cache {self.folder_path} is full, evicting {len(self._records) - len(rows)} embeddings", "INFO")
+
+		kept = np.array(self._records[rows])
+		kept_last_used = self._last_used[rows]
+		tmp_path = f"{self.records_path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			f.write(kept.tobytes())
+		# release the mapping before replacing the file
+		self._records = None
+		os.replace(tmp_path, self.records_path)
+
+		self._reload()
+		self._last_used[:len(kept_last_used)] = kept_last_used
+
+	def __len__(self):
+		return len(self._index)
+
+
+class EmbeddingCache:
+	"""Persistent embeddings of document texts, keyed by (embedder model and dimensions, sha256 of the text)."""
+
+	def __init__(self, folder_path: str = EMBEDDING_CACHE_PATH, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+		self.folder_path = folder_path
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self._stores: dict[str, EmbeddingStore] = {}
+		self._lock = threading.Lock()
+
+	@property
+	def enabled(self) -> bool:
+		return self.max_bytes > 0
+
+	def store(self, model: str) -> EmbeddingStore:
+		with self._lock:
+			if model not in self._stores:
+				folder_name = re.sub(r"[^A-Za-z0-9._-]", "_", model)
+				self._stores[model] = EmbeddingStore(os.path.join(self.folder_path, folder_name), self.max_bytes)
+			return self._stores[model]
+
+	def embed_documents(self, embedder, texts: list[str]) -> list[list[float]]:
+		"""Embed texts with the embedder, only for the ones not in the cache yet."""
+		# the model and its output dimensions, when it has several
+		store = self.store(embedder_namespace(embedder))
+		keys = [text_digest(text) for text in texts]
+		found = store.get_many(keys)
+
+		# embed each missing text once, even if it is repeated
+		missing = {}
+		for key, text in zip(keys, texts):
+			if key not in found and key not in missing:
+				missing[key] = text
+		with self._lock:
+			self.hits += len(texts) - sum(1 for key in keys if key in missing)
+			self.misses += len(missing)
+
+		if len(missing) > 0:
+			# float32, like the cached vectors, so a text gets the same vector whether it was cached or not
+			vectors = np.asarray(embedder.embed_documents(list(missing.values())), dtype=np.float32)
+			store.put_many(list(missing.keys()), vectors)
+			found.update({key: vector for key, vector in zip(missing.keys(), vectors)})
+
+		return [[float(x) for x in found[key]] for key in keys]
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"models": {model: len(store) for model, store in self._stores.items()},
+			}
+
+
+embedding_cache = EmbeddingCache()
+
+
+class QueryEmbeddingCache:
+	"""Bounded in-process LRU cache of query embeddings, keyed by (embedder, normalized text), with expiration."""
+
+	def __init__(self, max_size: int = QUERY_EMBEDDING_CACHE_SIZE, ttl: float = QUERY_EMBEDDING_CACHE_TTL):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._entries: OrderedDict[tuple, tuple[float, list[float]]] = OrderedDict()
+		self._lock = threading.Lock()
+
+	def embed_query(self, embedder, text: str) -> list[float]:
+		text = normalize_query(text)
+		if self.max_size <= 0:
+			return embedder.embed_query(text)
+
+		key = (embedder_namespace(embedder), text)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and entry[0] > time.monotonic():
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return entry[1]
+			self.misses += 1
+
+		embedding = embedder.embed_query(text)
+
+		with self._lock:
+			self._entries[key] = (time.monotonic() + self.ttl, embedding)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+		return embedding
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+query_embedding_cache = QueryEmbeddingCache()
+
+
+class CachedEmbeddings(Embeddings):
+	"""Embeddings wrapper which looks texts up in the embedding caches first.
+
+	Document texts go through the persistent embedding cache, queries through the in-process query cache.
+	"""
+
+	def __init__(
+		self,
+		wrapped_embedder: Embeddings,
+		cache: EmbeddingCache = embedding_cache,
+		query_cache: QueryEmbeddingCache = query_embedding_cache
+	):
+		self.wrapped_embedder = wrapped_embedder
+		self.cache = cache
+		self.query_cache = query_cache
+
+	def embed_documents(self, texts: list[str]) -> list[list[float]]:
+		if not self.cache.enabled:
+			return self.wrapped_embedder.embed_documents(texts)
+		return self.cache.embed_documents(self.wrapped_embedder, texts)
+
+	def embed_query(self, text: str) -> list[float]:
+		# queries may be embedded differently than documents by some providers, so they have their own cache
+		return self.query_cache.embed_query(self.wrapped_embedder, text)
+
+	def __getattr__(self, name):
+		# expose the wrapped embedder settings (model, size, ...)
+		if name == "wrapped_embedder":
+			raise AttributeError(name)
+		return getattr(self.wrapped_embedder, name)
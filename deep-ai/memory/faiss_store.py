@@ -0,0 +1,471 @@
+import copy
+import operator
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from log import log
+from memory.chunk_index import ChunkIndex
+from memory.keyword_index import KeywordIndex, reciprocal_rank_fusion
+from memory.metadata_index import MetadataIndex
+from memory.sqlite_docstore import SQLiteDocstore
+
+# Candidates fetched from a quantized index per result, before re-ranking them with the exact vectors
+FAISS_RERANK_FACTOR = int(os.getenv("FAISS_RERANK_FACTOR", 4))
+# Candidates fetched from both the vector and the keyword index per result, before fusing their rankings
+HYBRID_CANDIDATES_FACTOR = 4
+
+
+def exact_vectors_path(folder_path: str, index_name: str) -> str:
+	"""Float32 vectors of a quantized index, one row per index position."""
+	return os.path.join(folder_path, f"{index_name}.vectors.f32")
+
+
+class DeepAIFAISS(FAISS):
+	"""
+	FAISS vectorstore which can keep the exact float32 vectors of a quantized index on disk,
+	to re-rank the candidates found by the index.
+
+	Removed documents are only deleted from the docstore: their vectors stay in the index as tombstones,
+	excluded from searches, until the index is compacted.
+	"""
+
+	def __init__(self, *args, exact_vectors: np.ndarray | None = None, **kwargs):
+		super().__init__(*args, **kwargs)
+		# rows stored in the vectors file (memory-mapped), then the rows added since
+		self.exact_vectors = exact_vectors
+		self.added_vectors: list[np.ndarray] = []
+		# rows have been removed, the whole vectors file has to be written again
+		self.exact_vectors_changed = False
+		# index positions whose document has been removed
+		self.tombstones = self.find_tombstones()
+		self._selectors = None
+		# (inode, offset) of the mutation log up to which mutations are applied, see `memory.mutation_log`
+		self.wal_position = None
+		# BM25 index of the documents, built on first use when not saved with the index
+		self.keyword_index: KeywordIndex | None = None
+		# bitmap index of the metadata, built on first filtered search
+		self.metadata_index: MetadataIndex | None = None
+		# docstore ids of the chunks by source and ordinal, built on first neighbours lookup
+		self.chunk_index: ChunkIndex | None = None
+		# docstore id -> index position, built from `index_to_docstore_id` when it changes
+		self._positions: dict[str, int] = {}
+		self._positions_of = None
+
+	def copy(self, clone_index: bool = True) -> "DeepAIFAISS":
+		"""
+		Copy to apply mutations to while this vectorstore keeps serving searches.
+		SQLite docstores are shared: readers skip the documents they do not map yet, or no longer find.
+		Without `clone_index`, the faiss index and its vectors are shared too, for mutations which only add tombstones.
+		"""
+		copied = copy.copy(self)
+		if clone_index:
+			copied.index = faiss.clone_index(self.index)
+		if not isinstance(self.docstore, SQLiteDocstore):
+			copied.docstore = InMemoryDocstore(dict(self.docstore._dict))
+		copied.index_to_docstore_id = dict(self.index_to_docstore_id)
+		copied.added_vectors = list(self.added_vectors)
+		copied.tombstones = self.tombstones.copy()
+		copied._selectors = None
+		if self.keyword_index is not None:
+			copied.keyword_index = self.keyword_index.copy()
+		if self.metadata_index is not None:
+			copied.metadata_index = self.metadata_index.copy()
+		if self.chunk_index is not None:
+			copied.chunk_index = self.chunk_index.copy()
+		return copied
+
+	def keywords(self) -> KeywordIndex:
+		"""The BM25 index of the documents, built from the docstore the first time."""
+		if self.keyword_index is None:
+			keyword_index = KeywordIndex()
+			documents = self._documents(list(self.index_to_docstore_id.values()))
+			keyword_index.add(list(documents.keys()), [doc.page_content for doc in documents.values()])
+			self.keyword_index = keyword_index
+		return self.keyword_index
+
+	def metadata(self) -> MetadataIndex:
+		"""The bitmap index of the documents metadata, built from the docstore the first time."""
+		if self.metadata_index is None:
+			metadata_index = MetadataIndex()
+			ids = [self.index_to_docstore_id[i] for i in range(len(self.index_to_docstore_id))]
+			documents = self._documents(ids)
+			metadata_index.add(0, [documents[_id].metadata if _id in documents else {} for _id in ids])
+			self.metadata_index = metadata_index
+		return self.metadata_index
+
+	def chunks(self) -> ChunkIndex:
+		"""The chunk order index of the documents, built from the docstore the first time."""
+		if self.chunk_index is None:
+			chunk_index = ChunkIndex()
+			ids = [self.index_to_docstore_id[i] for i in range(len(self.index_to_docstore_id))]
+			documents = self._documents(ids)
+			chunk_index.add([_id for _id in ids if _id in documents], [documents[_id].metadata for _id in ids if _id in documents])
+			self.chunk_index = chunk_index
+		return self.chunk_index
+
+	def neighbour_documents(self, source: str, ordinals: list[int]) -> Dict[int, Document]:
+		"""Chunks of a source by ordinal, the ones removed or never stored left out."""
+		ids = self.chunks().ids(source, ordinals)
+		documents = self._documents(list(ids.values()))
+		return {ordinal: documents[_id] for ordinal, _id in ids.items() if _id in documents}
+
+	def allowed_positions(self, filter: Optional[Union[Callable, Dict[str, Any]]]) -> np.ndarray | None:
+		"""Mask of the positions a metadata filter allows, None if it cannot be resolved with the metadata index."""
+		if filter is None or callable(filter):
+			return None
+		return self.metadata().allowed(filter, self.index.ntotal)
+
+	def find_tombstones(self) -> np.ndarray:
+		if isinstance(self.docstore, (InMemoryDocstore, SQLiteDocstore)):
+			documents = self.docstore._dict if isinstance(self.docstore, InMemoryDocstore) else self.docstore.ids()
+			removed = [i for i, _id in self.index_to_docstore_id.items() if _id not in documents]
+		else:
+			removed = [i for i, _id in self.index_to_docstore_id.items() if not isinstance(self.docstore.search(_id), Document)]
+		return np.array(sorted(removed), dtype=np.int64)
+
+	def add_tombstones(self, positions: np.ndarray):
+		self.tombstones = np.union1d(self.tombstones, positions).astype(np.int64)
+		self._selectors = None
+
+	def clear_tombstones(self):
+		self.tombstones = np.zeros(0, dtype=np.int64)
+		self._selectors = None
+
+	def search_params(self, allowed: np.ndarray | None = None):
+		"""
+		Search parameters of the index excluding the tombstones, or searching only the `allowed` positions (a mask),
+		None if the index does not support it.
+		"""
+		index = faiss.downcast_index(self.index)
+		if isinstance(index, faiss.IndexPQ):
+			# IndexPQ does not support selectors
+			return None
+		if allowed is not None:
+			bitmap = np.packbits(allowed, bitorder="little")
+			selectors = (bitmap, faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)))
+		else:
+			if self._selectors is None:
+				# the batch selector has to outlive the selector pointing to it
+				batch = faiss.IDSelectorBatch(self.tombstones)
+				self._selectors = (batch, faiss.IDSelectorNot(batch))
+			selectors = self._selectors
+		selector = selectors[1]
+
+		# search parameters replace the ones of the index
+		if isinstance(index, faiss.IndexHNSW):
+			params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+		else:
+			try:
+				params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nprobe)
+			except RuntimeError:
+				params = faiss.SearchParameters(sel=selector)
+		# the selectors have to outlive the search
+		params.selectors = selectors
+		return params
+
+	def _search(self, vector: np.ndarray, n: int, allowed: np.ndarray | None = None) -> Tuple[np.ndarray, np.ndarray]:
+		"""Search the index, skipping the tombstones, and the positions not `allowed` if given."""
+		if (allowed is None and len(self.tombstones) == 0) or self.index.ntotal == 0:
+			return self.index.search(vector, n)
+		if allowed is not None and len(self.tombstones) > 0:
+			allowed = allowed.copy()
+			allowed[self.tombstones] = False
+
+		params = self.search_params(allowed)
+		if params is not None:
+			return self.index.search(vector, n, params=params)
+
+		# enough results to find n ones which are not excluded
+		excluded = len(self.tombstones) if allowed is None else self.index.ntotal - int(allowed.sum())
+		scores, indices = self.index.search(vector, min(n + excluded, max(1, self.index.ntotal)))
+		if allowed is None:
+			kept = ~np.isin(indices[0], self.tombstones)
+		else:
+			kept = (indices[0] >= 0) & allowed[np.maximum(indices[0], 0)]
+		return scores[:, kept][:, :n], indices[:, kept][:, :n]
+
+	@property
+	def has_exact_vectors(self) -> bool:
+		return self.exact_vectors is not None
+
+	def set_exact_vectors(self, vectors: np.ndarray | None):
+		self.exact_vectors = vectors
+		self.added_vectors = []
+		self.exact_vectors_changed = True
+
+	def all_exact_vectors(self) -> np.ndarray:
+		return np.concatenate([self.exact_vectors] + self.added_vectors) if self.added_vectors else np.asarray(self.exact_vectors)
+
+	def _FAISS__add(self, texts, embeddings, metadatas=None, ids=None) -> List[str]:
+		embeddings = list(embeddings)
+		metadatas = list(metadatas) if metadatas is not None else None
+		start = self.index.ntotal
+		ids = super()._FAISS__add(texts, embeddings, metadatas=metadatas, ids=ids)
+		if self.keyword_index is not None:
+			self.keyword_index.add(ids, list(texts))
+		if self.metadata_index is not None:
+			self.metadata_index.add(start, list(metadatas) if metadatas else [{} for _ in ids])
+		if self.chunk_index is not None and metadatas:
+			self.chunk_index.add(ids, metadatas)
+		if self.has_exact_vectors:
+			vectors = np.array(embeddings, dtype=np.float32)
+			if self._normalize_L2:
+				faiss.normalize_L2(vectors)
+			self.added_vectors.append(vectors)
+		return ids
+
+	def remove_exact_vectors(self, positions: np.ndarray):
+		if self.has_exact_vectors:
+			self.set_exact_vectors(np.delete(self.all_exact_vectors(), positions, axis=0))
+
+	def save_exact_vectors(self, folder_path: str, index_name: str):
+		"""
+		Write the vectors aside the index, to be called before the index files are swapped in.
+		Added rows are appended in place: processes which have mapped the file only read their own rows.
+		"""
+		path = exact_vectors_path(folder_path, index_name)
+		if not self.has_exact_vectors:
+			if os.path.exists(path):
+				os.remove(path)
+			return
+
+		if self.exact_vectors_changed:
+			vectors = self.all_exact_vectors()
+			with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+				f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+			os.replace(f"{path}.{os.getpid()}.tmp", path)
+		elif self.added_vectors:
+			with open(path, "ab") as f:
+				for vectors in self.added_vectors:
+					f.write(vectors.tobytes())
+		else:
+			return
+
+		self.exact_vectors = self.load_exact_vectors(folder_path, index_name, self.index.ntotal, self.index.d)
+		self.added_vectors = []
+		self.exact_vectors_changed = False
+
+	@staticmethod
+	def load_exact_vectors(folder_path: str, index_name: str, ntotal: int, dim: int) -> np.ndarray | None:
+		path = exact_vectors_path(folder_path, index_name)
+		try:
+			rows = os.path.getsize(path) // (4 * dim)
+		except OSError:
+			return None
+		# rows past ntotal were appended by a save which did not complete
+		if rows < ntotal:
+			log(f"FAISS index {index_name} has {rows} exact vectors for {ntotal} vectors, not re-ranking", "WARNING")
+			return None
+		if ntotal == 0:
+			return np.zeros((0, dim), dtype=np.float32)
+		return np.memmap(path, dtype=np.float32, mode="r", shape=(ntotal, dim))
+
+	def _search_index(self, vector: np.ndarray, n: int, allowed: np.ndarray | None = None) -> Tuple[np.ndarray, np.ndarray]:
+		"""Search the index for n results, re-ranking extra candidates with the exact vectors if available."""
+		if not self.has_exact_vectors:
+			return self._search(vector, n, allowed)
+
+		_, candidates = self._search(vector, n * FAISS_RERANK_FACTOR, allowed)
+		candidates = candidates[0][candidates[0] >= 0]
+		n_stored = len(self.exact_vectors)
+		rows = np.array([
+			self.exact_vectors[i] if i < n_stored else self.added_vectors_row(i - n_stored)
+			for i in candidates
+		], dtype=np.float32).reshape(len(candidates), self.index.d)
+
+		if self.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+			scores = rows @ vector[0]
+			order = np.argsort(-scores)[:n]
+		else:
+			scores = ((rows - vector[0]) ** 2).sum(axis=1)
+			order = np.argsort(scores)[:n]
+		return scores[order][None, :], candidates[order][None, :]
+
+	def added_vectors_row(self, i: int) -> np.ndarray:
+		for vectors in self.added_vectors:
+			if i < len(vectors):
+				return vectors[i]
+			i -= len(vectors)
+		raise IndexError(i)
+
+	def _documents(self, ids: List[str]) -> Dict[str, Document]:
+		"""Documents of the ids found, fetched at once when they are not in memory."""
+		if isinstance(self.docstore, SQLiteDocstore):
+			return self.docstore.search_many(ids)
+		documents = {}
+		for _id in ids:
+			doc = self.docstore.search(_id)
+			if isinstance(doc, Document):
+				documents[_id] = doc
+		return documents
+
+	def _similarity_search_ids_by_vector(
+		self,
+		embedding: List[float],
+		k: int = 4,
+		filter: Optional[Union[Callable, Dict[str, Any]]] = None,
+		fetch_k: int = 20,
+		score_threshold: Optional[float] = None,
+	) -> List[Tuple[str, Document, float]]:
+		vector = np.array([embedding], dtype=np.float32)
+		if self._normalize_L2:
+			faiss.normalize_L2(vector)
+		# filters on indexed metadata restrict the search itself, other ones filter the results of a larger search
+		allowed = self.allowed_positions(filter)
+		if allowed is not None:
+			filter = None
+		scores, indices = self._search_index(vector, k if filter is None else fetch_k, allowed)
+		docs = []
+
+		if filter is not None:
+			filter_func = self._create_filter_func(filter)
+
+		documents = self._documents([self.index_to_docstore_id[i] for i in indices[0] if i != -1])
+		for j, i in enumerate(indices[0]):
+			if i == -1:
+				# This happens when not enough docs are returned.
+				continue
+			_id = self.index_to_docstore_id[i]
+			doc = documents.get(_id)
+			if doc is None:
+				# removed while searching
+				continue
+			if filter is None or filter_func(doc.metadata):
+				docs.append((_id, doc, scores[0][j]))
+
+		if score_threshold is not None:
+			cmp = (
+				operator.ge
+				if self.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD)
+				else operator.le
+			)
+			docs = [(_id, doc, similarity) for _id, doc, similarity in docs if cmp(similarity, score_threshold)]
+		return docs[:k]
+
+	def similarity_search_with_score_by_vector(
+		self,
+		embedding: List[float],
+		k: int = 4,
+		filter: Optional[Union[Callable, Dict[str, Any]]] = None,
+		fetch_k: int = 20,
+		**kwargs: Any,
+	) -> List[Tuple[Document, float]]:
+		"""Same as `FAISS.similarity_search_with_score_by_vector`, searching through `_search_index`."""
+		return [
+			(doc, score)
+			for _, doc, score in self._similarity_search_ids_by_vector(
+				embedding, k, filter, fetch_k, kwargs.get("score_threshold")
+			)
+		]
+
+	def _keyword_search_ids(
+		self,
+		query: str,
+		k: int,
+		filter: Optional[Union[Callable, Dict[str, Any]]] = None,
+		fetch_k: int = 20,
+	) -> List[Tuple[str, float]]:
+		allowed = self.allowed_positions(filter)
+		if filter is None or allowed is not None:
+			allowed_ids = None if allowed is None else {self.index_to_docstore_id[i] for i in np.flatnonzero(allowed)}
+			return self.keywords().search(query, k, allowed_ids)
+
+		found = self.keywords().search(query, max(k, fetch_k))
+		documents = self._documents([_id for _id, _ in found])
+		filter_func = self._create_filter_func(filter)
+		return [(_id, score) for _id, score in found if _id in documents and filter_func(documents[_id].metadata)][:k]
+
+	def keyword_search_with_score(
+		self,
+		query: str,
+		k: int = 4,
+		filter: Optional[Union[Callable, Dict[str, Any]]] = None,
+	) -> List[Tuple[Document, float]]:
+		"""Documents matching the words of the query, with their BM25 score. No embedding is computed."""
+		return [(doc, score) for _, doc, score in self._keyword_search_documents(query, k, filter)]
+
+	def _keyword_search_documents(self, query: str, k: int, filter=None) -> List[Tuple[str, Document, float]]:
+		found = self._keyword_search_ids(query, k, filter)
+		documents = self._documents([_id for _id, _ in found])
+		return [(_id, documents[_id], score) for _id, score in found if _id in documents]
+
+	def hybrid_search_with_score_by_vector(
+		self,
+		query: str,
+		embedding: List[float],
+		k: int = 4,
+		score_threshold: Optional[float] = None,
+		filter: Optional[Union[Callable, Dict[str, Any]]] = None,
+	) -> List[Tuple[Document, float]]:
+		"""
+		Documents found by both the vector and the keyword index, ordered by reciprocal rank fusion of their rankings,
+		with their fused score: a rank based score (at most 2 / (RRF_K + 1)), not comparable with similarity scores.
+		With a score threshold, only the documents passing it in the vector search are kept, the keyword ranking
+		reorders them: documents matching words of an off-topic question are not recalled.
+		"""
+		return [(doc, score) for _, doc, score in self._hybrid_search_ids(query, embedding, k, score_threshold, filter)]
+
+	def _hybrid_search_ids(self, query: str, embedding: List[float], k: int, score_threshold=None, filter=None) -> List[Tuple[str, Document, float]]:
+		candidates = k * HYBRID_CANDIDATES_FACTOR
+		vector_found = self._similarity_search_ids_by_vector(embedding, candidates, filter, score_threshold=score_threshold)
+		keyword_found = self._keyword_search_ids(query, candidates, filter)
+		if score_threshold is not None:
+			relevant = {_id for _id, _, _ in vector_found}
+			keyword_found = [(_id, score) for _id, score in keyword_found if _id in relevant]
+		fused = reciprocal_rank_fusion([[_id for _id, _, _ in vector_found], [_id for _id, _ in keyword_found]])[:k]
+
+		documents = {_id: doc for _id, doc, _ in vector_found}
+		documents.update(self._documents([_id for _id, _ in fused if _id not in documents]))
+		return [(_id, documents[_id], score) for _id, score in fused if _id in documents]
+
+	def search_with_score(
+		self,
+		query: str,
+		embedding: List[float] | None,
+		k: int = 4,
+		score_threshold: Optional[float] = None,
+		filter: Optional[Union[Callable, Dict[str, Any]]] = None,
+		retrieval: str = "vector",
+		with_vectors: bool = False,
+	) -> List[Tuple[Document, float]] | Tuple[List[Tuple[Document, float]], np.ndarray]:
+		"""
+		Documents found by a `vector`, `keyword` or `hybrid` search, with their score,
+		and their stored vectors if asked, to compare them without embedding them again.
+		"""
+		if retrieval == "keyword":
+			found = self._keyword_search_documents(query, k, filter)
+		elif retrieval == "hybrid":
+			found = self._hybrid_search_ids(query, embedding, k, score_threshold, filter)
+		else:
+			found = self._similarity_search_ids_by_vector(embedding, k, filter, score_threshold=score_threshold)
+
+		memories = [(doc, score) for _, doc, score in found]
+		if not with_vectors:
+			return memories
+		return memories, self.stored_vectors([_id for _id, _, _ in found])
+
+	def stored_vectors(self, ids: List[str]) -> np.ndarray:
+		"""Vectors of documents as stored, the exact ones if kept aside, zeros for documents no longer in the index."""
+		if self._positions_of is not self.index_to_docstore_id or len(self._positions) != len(self.index_to_docstore_id):
+			self._positions = {_id: i for i, _id in self.index_to_docstore_id.items()}
+			self._positions_of = self.index_to_docstore_id
+
+		vectors = np.zeros((len(ids), self.index.d), dtype=np.float32)
+		n_stored = len(self.exact_vectors) if self.has_exact_vectors else 0
+		for row, _id in enumerate(ids):
+			i = self._positions.get(_id)
+			if i is None:
+				continue
+			if self.has_exact_vectors:
+				vectors[row] = self.exact_vectors[i] if i < n_stored else self.added_vectors_row(i - n_stored)
+				continue
+			# IVF indexes have their id -> list map from their load, see `memory.ann_index.ensure_direct_map`
+			vectors[row] = self.index.reconstruct(int(i))
+		return vectors
@@ -0,0 +1,225 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from langchain_community.vectorstores.faiss import FAISS
+
+from factory.embedder import embedder_identity
+from log import log
+from memory.mutation_log import mutation_log
+
+# Memory budget for loaded FAISS indexes, 1 GiB by default
+FAISS_INDEX_CACHE_MAX_BYTES = int(os.getenv("FAISS_INDEX_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# Docstore format of new indexes: `pickle` (FAISS.save_local .pkl file) or `sqlite`
+FAISS_DOCSTORE_FORMAT = os.getenv("FAISS_DOCSTORE_FORMAT", "pickle")
+
+
+def docstore_format(folder_path: str, index_name: str) -> str:
+	"""Docstore format of an existing index, the default format for a new one."""
+	if os.path.exists(os.path.join(folder_path, f"{index_name}.pkl")):
+		return "pickle"
+	if os.path.exists(os.path.join(folder_path, f"{index_name}.ids.npy")):
+		return "sqlite"
+	return FAISS_DOCSTORE_FORMAT
+
+
+def index_files(folder_path: str, index_name: str, format: str | None = None) -> list[str]:
+	"""
+	Index file and the file mapping its positions to the docstore ids, which are replaced together on every save:
+	the `.pkl` written by `FAISS.save_local` for the pickle format, an `.ids.npy` array for the sqlite format
+	(documents being kept in a `.docs.sqlite` file).
+	"""
+	format = format or docstore_format(folder_path, index_name)
+	return [
+		os.path.join(folder_path, f"{index_name}.faiss"),
+		os.path.join(folder_path, f"{index_name}.pkl" if format == "pickle" else f"{index_name}.ids.npy"),
+	]
+
+
+def docstore_path(folder_path: str, index_name: str) -> str:
+	return os.path.join(folder_path, f"{index_name}.docs.sqlite")
+
+
+def files_stamp(paths: list[str]):
+	"""(mtime, size) of every file, None if any of them is missing."""
+	stamp = []
+	for path in paths:
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		stamp.append((stat.st_mtime_ns, stat.st_size))
+	return tuple(stamp)
+
+
+class CachedIndex:
+	def __init__(self, faiss_db: FAISS, version: int, stamp, log_position, size: int):
+		self.faiss_db = faiss_db
+		self.version = version
+		self.stamp = stamp
+		# position of the mutation log up to which the committed transactions are part of the vectorstore
+		self.log_position = log_position
+		self.size = size
+
+
+class FaissIndexCache:
+	"""Process-wide LRU cache of loaded FAISS indexes.
+
+	Entries are keyed by (folder_path, index_name, embedder identity) and bounded by an approximate memory budget,
+	measured as the size of the index files on disk. Searches are given query vectors embedded by the caller,
+	so a cached vectorstore serves every embedder instance of its identity as it is.
+	An entry is dropped as soon as its files change on disk (mtime/size), another process commits a transaction
+	to its mutation log, or its index is written by this process. The transactions of this process are published
+	by its index writer (`put`) as a new version: readers keep the cached one meanwhile.
+	"""
+
+	def __init__(self, max_bytes: int = FAISS_INDEX_CACHE_MAX_BYTES):
+		self.max_bytes = max_bytes
+		self.total_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.loads = 0
+		self.evictions = 0
+
+		self._entries: OrderedDict[tuple, CachedIndex] = OrderedDict()
+		# (folder_path, index_name) -> version, bumped every time the index is written by this process
+		self._versions: dict[tuple, int] = {}
+		# one loading lock per key, so concurrent misses load an index only once
+		self._loading_locks: dict[tuple, threading.Lock] = {}
+		self._lock = threading.RLock()
+
+	@staticmethod
+	def _index_key(folder_path: str, index_name: str) -> tuple:
+		return os.path.abspath(folder_path), str(index_name)
+
+	def _key(self, folder_path: str, index_name: str, embeddings) -> tuple:
+		return self._index_key(folder_path, index_name) + (embedder_identity(embeddings),)
+
+	def get(self, folder_path: str, index_name: str, embeddings) -> FAISS | None:
+		key = self._key(folder_path, index_name, embeddings)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+
+			stamp = files_stamp(index_files(folder_path, index_name))
+			if entry.version != self._versions.get(key[:2], 0) or entry.stamp != stamp:
+				log(f"FAISS index {index_name} changed on disk, dropping it from cache", "DEBUG")
+				self._drop(key)
+				self.misses += 1
+				return None
+
+		# only the records appended since the last check are read, outside of the cache lock
+		foreign, log_position = mutation_log(folder_path, index_name).foreign_commits(entry.log_position)
+
+		with self._lock:
+			if self._entries.get(key) is not entry:
+				# replaced meanwhile
+				return self.get(folder_path, index_name, embeddings)
+			if foreign:
+				log(f"FAISS index {index_name} written by another process, dropping it from cache", "DEBUG")
+				self._drop(key)
+				self.misses += 1
+				return None
+
+			entry.log_position = log_position
+			self._entries.move_to_end(key)
+			self.hits += 1
+
+		# shared by concurrent chats, never modified: it keeps the embedder it was loaded with, of the same identity
+		return entry.faiss_db
+
+	def get_or_load(self, folder_path: str, index_name: str, embeddings, loader: Callable[[], FAISS]) -> FAISS:
+		faiss_db = self.get(folder_path, index_name, embeddings)
+		if faiss_db is not None:
+			return faiss_db
+
+		key = self._key(folder_path, index_name, embeddings)
+		with self._lock:
+			loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+		with loading_lock:
+			# another thread may have loaded it while we were waiting
+			faiss_db = self.get(folder_path, index_name, embeddings)
+			if faiss_db is not None:
+				return faiss_db
+
+			with self._lock:
+				version = self._versions.get(key[:2], 0)
+				self.loads += 1
+			# stamp the files and the log before loading: if they change meanwhile the entry is considered stale
+			stamp = files_stamp(index_files(folder_path, index_name))
+			log_position = mutation_log(folder_path, index_name).position()
+			faiss_db = loader()
+			if stamp is None:
+				# the loader has just created the index
+				stamp = files_stamp(index_files(folder_path, index_name))
+			self._put(key, faiss_db, version, stamp, log_position)
+			return faiss_db
+
+	def put(self, folder_path: str, index_name: str, embeddings, faiss_db: FAISS, log_position):
+		"""
+		Store a new version of an index written by this process, including the transactions committed
+		to its mutation log up to `log_position`.
+		"""
+		index_key = self._index_key(folder_path, index_name)
+		with self._lock:
+			version = self._bump_version(index_key)
+			stamp = files_stamp(index_files(folder_path, index_name))
+			self._put(index_key + (embedder_identity(embeddings),), faiss_db, version, stamp, log_position)
+
+	def invalidate(self, folder_path: str, index_name: str):
+		"""Drop every cached copy of an index, whatever embedder it was loaded with."""
+		with self._lock:
+			self._bump_version(self._index_key(folder_path, index_name))
+
+	def stats(self) -> dict:
+		with self._lock:
+			return {
+				"entries": len(self._entries),
+				"total_bytes": self.total_bytes,
+				"max_bytes": self.max_bytes,
+				"hits": self.hits,
+				"misses": self.misses,
+				"loads": self.loads,
+				"evictions": self.evictions,
+			}
+
+	def _bump_version(self, index_key: tuple) -> int:
+		version = self._versions.get(index_key, 0) + 1
+		self._versions[index_key] = version
+		for key in [k for k in self._entries if k[:2] == index_key]:
+			self._drop(key)
+		return version
+
+	def _put(self, key: tuple, faiss_db: FAISS, version: int, stamp, log_position):
+		if stamp is None:
+			return
+
+		size = sum(s for _, s in stamp)
+		if size > self.max_bytes:
+			log(f"FAISS index {key[1]} ({size} bytes) exceeds the index cache budget, not caching it", "WARNING")
+			return
+
+		with self._lock:
+			if key in self._entries:
+				self._drop(key)
+			self._entries[key] = CachedIndex(faiss_db, version, stamp, log_position, size)
+			self.total_bytes += size
+
+			# evict least recently used indexes until we are within budget
+			while self.total_bytes > self.max_bytes:
+				oldest_key = next(iter(self._entries))
+				log(f"Evicting FAISS index {oldest_key[1]} from cache", "DEBUG")
+				self._drop(oldest_key)
+				self.evictions += 1
+
+	def _drop(self, key: tuple):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self.total_bytes -= entry.size
+
+
+index_cache = FaissIndexCache()
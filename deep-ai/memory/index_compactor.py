@@ -0,0 +1,57 @@
+import os
+import threading
+
+from log import log
+
+# Seconds between two compactions of the indexes with removed documents
+FAISS_COMPACT_INTERVAL = float(os.getenv("FAISS_COMPACT_INTERVAL", 300))
+# Share of removed vectors from which an index is compacted right away
+FAISS_COMPACT_TOMBSTONE_RATIO = float(os.getenv("FAISS_COMPACT_TOMBSTONE_RATIO", 0.2))
+
+
+class IndexCompactor:
+	"""
+	Background thread removing the tombstones (vectors of removed documents) of the indexes, every
+	`FAISS_COMPACT_INTERVAL` seconds or as soon as too many of an index vectors are tombstones.
+	The index is rewritten once for all the removals since the previous compaction.
+	"""
+
+	def __init__(self, interval: float = FAISS_COMPACT_INTERVAL, tombstone_ratio: float = FAISS_COMPACT_TOMBSTONE_RATIO):
+		self.interval = interval
+		self.tombstone_ratio = tombstone_ratio
+		self.compactions = 0
+		# (folder_path, index_name) -> vector memory to compact it with
+		self._dirty: dict[tuple, object] = {}
+		self._wakeup = threading.Event()
+		self._thread = None
+		self._lock = threading.Lock()
+
+	def mark(self, vector_memory, faiss_db, index_name: str, folder_path: str):
+		tombstones = len(getattr(faiss_db, "tombstones", ()))
+		if tombstones == 0:
+			return
+
+		with self._lock:
+			self._dirty[(folder_path, index_name)] = vector_memory
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._loop, name="index-compactor", daemon=True)
+				self._thread.start()
+		if tombstones >= self.tombstone_ratio * max(1, faiss_db.index.ntotal):
+			self._wakeup.set()
+
+	def _loop(self):
+		while True:
+			self._wakeup.wait(self.interval)
+			self._wakeup.clear()
+			with self._lock:
+				dirty, self._dirty = self._dirty, {}
+
+			for (folder_path, index_name), vector_memory in dirty.items():
+				try:
+					if vector_memory.compact(index_name, folder_path):
+						self.compactions += 1
+				except Exception as e:
+					log(f"Failed to compact FAISS index {index_name}: {e}", "ERROR")
+
+
+index_compactor = IndexCompactor()
@@ -0,0 +1,198 @@
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable
+
+from factory.embedder import embedder_identity
+from log import log
+
+try:
+	import fcntl
+except ImportError:
+	# Windows: writers of other processes are not locked out
+	fcntl = None
+
+# Separates the knowledge base from the embedder namespace in the index file names: {knowledge_base_id}@{namespace}.faiss
+NAMESPACE_SEPARATOR = "@"
+# Indexes shared by every embedder: the tools are embedded again per embedder by the MadHatter
+SHARED_INDEXES = ("procedural",)
+# Knowledge bases re-embedded at the same time
+REEMBED_THREADS = 2
+
+
+def embedder_namespace(embedder) -> str:
+	"""The embedder model, and the dimension when the model has several, as a file name part."""
+	namespace = embedder_identity(embedder)
+	wrapped_embedder = getattr(embedder, "wrapped_embedder", embedder)
+	dimensions = getattr(wrapped_embedder, "dimensions", None)
+	if dimensions:
+		namespace = f"{namespace}-{dimensions}"
+	return re.sub(r"[^A-Za-z0-9._-]", "_", namespace)
+
+
+def namespaced_index(index_name: str, namespace: str) -> str:
+	"""Name of the index of a knowledge base for an embedder namespace, the knowledge base itself for legacy indexes."""
+	return f"{index_name}{NAMESPACE_SEPARATOR}{namespace}" if namespace else index_name
+
+
+def base_index_name(index_name: str) -> str:
+	return str(index_name).split(NAMESPACE_SEPARATOR, 1)[0]
+
+
+def index_namespaces(folder_path: str, index_name: str) -> list[str]:
+	"""Namespaces of the indexes of a knowledge base on disk, "" for the index written before namespaces."""
+	prefix = f"{index_name}{NAMESPACE_SEPARATOR}"
+	try:
+		files = os.listdir(folder_path)
+	except FileNotFoundError:
+		return []
+	namespaces = {
+		file[len(prefix):-len(suffix)]
+		for file in files for suffix in (".faiss", ".wal")
+		if file.startswith(prefix) and file.endswith(suffix)
+	}
+	if os.path.exists(os.path.join(folder_path, f"{index_name}.faiss")):
+		namespaces.add("")
+	return sorted(namespaces)
+
+
+class IndexCatalog:
+	"""
+	Revisions of the indexes of a knowledge base, one per embedder namespace, in `{knowledge_base_id}.namespaces.json`.
+	Every transaction adding documents to one of them is a new revision of the knowledge base: an index is up to date
+	when it has all of them, the other ones are stale until re-embedded.
+	"""
+
+	def __init__(self, folder_path: str, index_name: str):
+		self.folder_path = folder_path
+		self.index_name = index_name
+		self.path = os.path.join(folder_path, f"{index_name}.namespaces.json")
+		self._lock = threading.RLock()
+		self._read = (None, None)
+
+	@contextmanager
+	def lock(self):
+		with self._lock:
+			if fcntl is None:
+				yield
+				return
+			os.makedirs(self.folder_path, exist_ok=True)
+			with open(f"{self.path}.lock", "a") as f:
+				fcntl.flock(f, fcntl.LOCK_EX)
+				try:
+					yield
+				finally:
+					fcntl.flock(f, fcntl.LOCK_UN)
+
+	def read(self) -> dict:
+		"""{"revision": ..., "namespaces": {namespace: revision it has}}, re-read only when the file changes."""
+		try:
+			stat = os.stat(self.path)
+			stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+		except OSError:
+			# indexes written before namespaces are the first revision
+			legacy = os.path.exists(os.path.join(self.folder_path, f"{self.index_name}.faiss"))
+			return {"revision": 0, "namespaces": {"": 0} if legacy else {}}
+		if self._read[0] != stamp:
+			with open(self.path, "r") as f:
+				self._read = (stamp, json.load(f))
+		return self._read[1]
+
+	def is_legacy(self) -> bool:
+		"""Whether the knowledge base only has the index written before namespaces."""
+		return not os.path.exists(self.path) and os.path.exists(os.path.join(self.folder_path, f"{self.index_name}.faiss"))
+
+	def adopt_legacy(self, namespace: str, adopt: Callable[[], bool]):
+		"""
+		Record the index written before namespaces as the index of a namespace when `adopt` (renaming its files) does,
+		as the legacy "" namespace otherwise. Done once, by the first process to get the lock.
+		"""
+		with self.lock():
+			if not self.is_legacy():
+				return
+			adopted = adopt()
+			self._write({"revision": 0, "namespaces": {namespace if adopted else "": 0}})
+
+	def _write(self, catalog: dict):
+		tmp_path = f"{self.path}.{os.getpid()}.tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(catalog, f)
+		os.replace(tmp_path, self.path)
+
+	def status(self, namespace: str) -> str:
+		"""`current`, `stale` (some documents missing) or `missing` (not embedded yet) for an embedder namespace."""
+		catalog = self.read()
+		revision = catalog["namespaces"].get(namespace)
+		if revision is None:
+			return "missing" if catalog["namespaces"] else "current"
+		return "current" if revision >= catalog["revision"] else "stale"
+
+	def freshest(self, exclude: str | None = None) -> str | None:
+		"""The namespace with the most revisions, but `exclude`."""
+		namespaces = {ns: revision for ns, revision in self.read()["namespaces"].items() if ns != exclude}
+		return max(namespaces, key=lambda ns: (namespaces[ns], ns != "")) if namespaces else None
+
+	def written(self, namespace: str):
+		"""Documents have been added to the index of a namespace: the other ones miss them."""
+		with self.lock():
+			catalog = self.read()
+			current = self.status(namespace) == "current"
+			catalog = {"revision": catalog["revision"] + 1, "namespaces": dict(catalog["namespaces"])}
+			if current:
+				catalog["namespaces"][namespace] = catalog["revision"]
+			self._write(catalog)
+
+	def synced(self, namespace: str, revision: int):
+		"""The index of a namespace has the documents of the knowledge base up to a revision."""
+		with self.lock():
+			catalog = self.read()
+			namespaces = dict(catalog["namespaces"])
+			namespaces[namespace] = max(namespaces.get(namespace, -1), revision)
+			self._write({"revision": catalog["revision"], "namespaces": namespaces})
+
+
+_catalogs: dict[tuple, IndexCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def index_catalog(folder_path: str, index_name: str) -> IndexCatalog:
+	key = (os.path.abspath(folder_path), index_name)
+	with _catalogs_lock:
+		if key not in _catalogs:
+			_catalogs[key] = IndexCatalog(folder_path, index_name)
+		return _catalogs[key]
+
+
+class IndexReembedder:
+	"""
+	Embeds the documents of a knowledge base again in the background, from the texts stored in its other indexes,
+	when it is used with an embedder whose index is missing or stale: switching models never means uploading again.
+	"""
+
+	def __init__(self):
+		self._executor = ThreadPoolExecutor(max_workers=REEMBED_THREADS, thread_name_prefix="index-reembedder")
+		self._pending: set[tuple] = set()
+		self._lock = threading.Lock()
+
+	def schedule(self, vector_memory, index_name: str, embedder, folder_path: str):
+		key = (os.path.abspath(folder_path), index_name, embedder_namespace(embedder))
+		with self._lock:
+			if key in self._pending:
+				return
+			self._pending.add(key)
+		self._executor.submit(self._run, vector_memory, index_name, embedder, folder_path, key)
+
+	def _run(self, vector_memory, index_name: str, embedder, folder_path: str, key: tuple):
+		try:
+			vector_memory.reembed(index_name, embedder, folder_path)
+		except Exception as e:
+			log(f"Failed to re-embed FAISS index {index_name} for {key[2]}: {e}", "ERROR")
+		finally:
+			with self._lock:
+				self._pending.discard(key)
+
+
+index_reembedder = IndexReembedder()
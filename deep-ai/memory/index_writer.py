@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from langchain_community.vectorstores.faiss import FAISS
+
+# Indexes written at the same time, each by a single thread
+WRITER_THREADS = 4
+# Seconds a writer waits for more transactions to merge into the version it publishes, each version copying the index
+FAISS_WRITER_BATCH_SECONDS = float(os.getenv("FAISS_WRITER_BATCH_SECONDS", 0.05))
+
+
+class IndexWriter:
+	"""
+	Single writer of an index in this process. Transactions committed while it is applying previous ones
+	are merged, and applied together into the next version of the vectorstore.
+	Every version is a new vectorstore published to the index cache once complete: readers keep searching
+	the version they got, and pick up the new one on their next access.
+	"""
+
+	def __init__(self, folder_path: str, index_name: str):
+		self.folder_path = folder_path
+		self.index_name = index_name
+		self.versions = 0
+		self._waiting: list[Future] = []
+		self._running = False
+		self._lock = threading.Lock()
+
+	def apply(self, vector_memory) -> FAISS:
+		"""Wait for the transactions committed so far to be applied, returns the vectorstore version including them."""
+		future = Future()
+		with self._lock:
+			self._waiting.append(future)
+			if not self._running:
+				self._running = True
+				_executor.submit(self._drain, vector_memory)
+		return future.result()
+
+	def _drain(self, vector_memory):
+		while True:
+			time.sleep(FAISS_WRITER_BATCH_SECONDS)
+			with self._lock:
+				waiting, self._waiting = self._waiting, []
+				if len(waiting) == 0:
+					self._running = False
+					return
+
+			try:
+				faiss_db = vector_memory.apply_mutations(self.index_name, self.folder_path)
+			except Exception as e:
+				for future in waiting:
+					future.set_exception(e)
+				continue
+			self.versions += 1
+			for future in waiting:
+				future.set_result(faiss_db)
+
+
+_executor = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix="index-writer")
+_writers: dict[tuple, IndexWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def index_writer(folder_path: str, index_name: str) -> IndexWriter:
+	"""The writer of an index, shared by the threads of the process."""
+	key = (os.path.abspath(folder_path), index_name)
+	with _writers_lock:
+		if key not in _writers:
+			_writers[key] = IndexWriter(folder_path, index_name)
+		return _writers[key]
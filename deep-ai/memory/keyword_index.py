@@ -0,0 +1,168 @@
+import heapq
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal rank fusion constant, see https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+RRF_K = 60
+
+# identifiers such as error codes, API names or ticket numbers are kept whole,
+# runs of CJK characters (kana and hangul included) are split into bigrams
+TOKEN_PATTERN = re.compile(
+	r"[0-9a-z_]+(?:[.\-/:#][0-9a-z_]+)*|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+"
+)
+IDENTIFIER_SEPARATORS = re.compile(r"[.\-/:#]")
+
+
+def keyword_index_path(folder_path: str, index_name: str) -> str:
+	return os.path.join(folder_path, f"{index_name}.keywords.npz")
+
+
+def tokenize(text: str) -> list[str]:
+	"""Lowercased words and identifiers, and their parts, with CJK character bigrams."""
+	tokens = []
+	for match in TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).lower()):
+		token = match.group()
+		if token[0].isascii():
+			tokens.append(token)
+			if IDENTIFIER_SEPARATORS.search(token):
+				tokens += [part for part in IDENTIFIER_SEPARATORS.split(token) if part]
+		elif len(token) == 1:
+			tokens.append(token)
+		else:
+			tokens += [token[i:i + 2] for i in range(len(token) - 1)]
+	return tokens
+
+
+class KeywordIndex:
+	"""
+	BM25 inverted index of the documents of a vectorstore, by docstore id.
+	Removed documents are only forgotten, their postings are dropped when the index is saved.
+	"""
+
+	def __init__(self):
+		self.ids: list[str | None] = []
+		self.lengths: list[int] = []
+		self.positions: dict[str, int] = {}
+		# term -> {document position: term frequency}
+		self.postings: dict[str, dict[int, int]] = {}
+		self.total_length = 0
+
+	def __len__(self):
+		return len(self.positions)
+
+	def add(self, ids: list[str], texts: list[str]):
+		for _id, text in zip(ids, texts):
+			if _id in self.positions:
+				continue
+			position = len(self.ids)
+			terms = Counter(tokenize(text))
+			for term, frequency in terms.items():
+				self.postings.setdefault(term, {})[position] = frequency
+			length = sum(terms.values())
+			self.ids.append(_id)
+			self.lengths.append(length)
+			self.positions[_id] = position
+			self.total_length += length
+
+	def remove(self, ids: list[str]):
+		for _id in ids:
+			position = self.positions.pop(_id, None)
+			if position is not None:
+				self.ids[position] = None
+				self.total_length -= self.lengths[position]
+
+	def search(self, query: str, k: int = 4, allowed_ids: set[str] | None = None) -> list[tuple[str, float]]:
+		"""
+		Ids of the best matching documents with their BM25 score, documents matching no term excluded,
+		and the ones not in `allowed_ids` if given.
+		"""
+		n = len(self.positions)
+		if n == 0:
+			return []
+		average_length = max(self.total_length / n, 1e-6)
+		scores: dict[int, float] = {}
+		for term in set(tokenize(query)):
+			postings = self.postings.get(term)
+			if not postings:
+				continue
+			idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+			for position, frequency in postings.items():
+				_id = self.ids[position]
+				if _id is None or (allowed_ids is not None and _id not in allowed_ids):
+					continue
+				norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / average_length)
+				scores[position] = scores.get(position, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+		best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+		return [(self.ids[position], score) for position, score in best]
+
+	def copy(self) -> "KeywordIndex":
+		copied = KeywordIndex()
+		copied.ids = list(self.ids)
+		copied.lengths = list(self.lengths)
+		copied.positions = dict(self.positions)
+		copied.postings = {term: dict(postings) for term, postings in self.postings.items()}
+		copied.total_length = self.total_length
+		return copied
+
+	def save(self, path: str):
+		"""Write the live documents postings as arrays, aside first and then atomically swapped in."""
+		renumber = np.full(len(self.ids), -1, dtype=np.int64)
+		live = [position for position, _id in enumerate(self.ids) if _id is not None]
+		renumber[live] = np.arange(len(live))
+
+		terms, offsets, documents, frequencies = [], [0], [], []
+		for term, postings in self.postings.items():
+			kept = [(renumber[p], f) for p, f in postings.items() if renumber[p] >= 0]
+			if not kept:
+				continue
+			terms.append(term)
+			documents += [p for p, _ in kept]
+			frequencies += [f for _, f in kept]
+			offsets.append(len(documents))
+
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			np.savez(
+				f,
+				ids=np.array([self.ids[p] for p in live], dtype=str),
+				lengths=np.array([self.lengths[p] for p in live], dtype=np.int32),
+				terms=np.array(terms, dtype=str),
+				offsets=np.array(offsets, dtype=np.int64),
+				documents=np.array(documents, dtype=np.int32),
+				frequencies=np.array(frequencies, dtype=np.int32),
+			)
+		os.replace(tmp_path, path)
+
+	@staticmethod
+	def load(path: str) -> "KeywordIndex | None":
+		if not os.path.exists(path):
+			return None
+		with np.load(path, allow_pickle=False) as arrays:
+			index = KeywordIndex()
+			index.ids = arrays["ids"].tolist()
+			index.lengths = arrays["lengths"].tolist()
+			offsets = arrays["offsets"].tolist()
+			documents = arrays["documents"].tolist()
+			frequencies = arrays["frequencies"].tolist()
+			for i, term in enumerate(arrays["terms"].tolist()):
+				index.postings[term] = dict(zip(documents[offsets[i]:offsets[i + 1]], frequencies[offsets[i]:offsets[i + 1]]))
+		index.positions = {_id: position for position, _id in enumerate(index.ids)}
+		index.total_length = sum(index.lengths)
+		return index
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = RRF_K) -> list[tuple[str, float]]:
+	"""Ids of several rankings ordered by their fused score, the sum of 1 / (k + rank) over the rankings."""
+	scores: dict[str, float] = {}
+	for ranking in rankings:
+		for rank, _id in enumerate(ranking):
+			scores[_id] = scores.get(_id, 0.0) + 1 / (k + rank + 1)
+	return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,120 @@
+from typing import Any
+
+import numpy as np
+
+# Metadata fields which can filter recall before searching: top-level ones, or fields of the Feishu node of a document
+INDEXED_FIELDS = ("source", "when", "space_id", "node_token")
+# Fields filtered by ranges ({"gte": ..., "lt": ...}) rather than values
+NUMERIC_FIELDS = ("when",)
+RANGE_OPERATORS = {
+	"gt": np.greater,
+	"gte": np.greater_equal,
+	"lt": np.less,
+	"lte": np.less_equal,
+}
+
+
+def metadata_value(metadata: dict, field: str) -> Any:
+	value = metadata.get(field)
+	if value is None:
+		node = metadata.get("node")
+		value = node.get(field) if isinstance(node, dict) else getattr(node, field, None)
+	return value
+
+
+class MetadataIndex:
+	"""
+	Bitmap index of the indexed metadata fields of a vectorstore, by index position:
+	the positions of every value of the categorical fields, and a column of the numeric ones.
+	A metadata filter is resolved into a mask of the allowed positions, to search only them.
+	"""
+
+	def __init__(self):
+		self.size = 0
+		# field -> value -> positions
+		self.values: dict[str, dict[Any, list[int]]] = {field: {} for field in INDEXED_FIELDS if field not in NUMERIC_FIELDS}
+		# field -> value per position, NaN when missing
+		self.numbers: dict[str, list[float]] = {field: [] for field in NUMERIC_FIELDS}
+		self._columns: dict[str, np.ndarray] = {}
+
+	def add(self, start: int, metadatas: list[dict]):
+		"""Index the metadata of the documents added at the positions from `start`."""
+		for field in self.numbers:
+			self.numbers[field] += [np.nan] * (start - len(self.numbers[field]))
+		for position, metadata in enumerate(metadatas, start):
+			for field, values in self.values.items():
+				value = metadata_value(metadata, field)
+				try:
+					values.setdefault(value, []).append(position)
+				except TypeError:
+					# unhashable values are not indexed
+					pass
+			for field, column in self.numbers.items():
+				value = metadata_value(metadata, field)
+				column.append(float(value) if isinstance(value, (int, float)) else np.nan)
+		self.size = max(self.size, start + len(metadatas))
+		self._columns = {}
+
+	def remove_positions(self, keep: np.ndarray):
+		"""Renumber the positions after vectors have been removed from the index, `keep` being the mask of the kept ones."""
+		renumber = np.cumsum(keep) - 1
+		for field, values in self.values.items():
+			for value, positions in list(values.items()):
+				positions = np.asarray(positions, dtype=np.int64)
+				kept = renumber[positions[keep[positions]]].tolist()
+				if kept:
+					values[value] = kept
+				else:
+					del values[value]
+		for field, column in self.numbers.items():
+			self.numbers[field] = np.asarray(column, dtype=np.float64)[keep[:len(column)]].tolist()
+		self.size = int(keep.sum())
+		self._columns = {}
+
+	def copy(self) -> "MetadataIndex":
+		copied = MetadataIndex()
+		copied.size = self.size
+		copied.values = {field: {value: list(positions) for value, positions in values.items()} for field, values in self.values.items()}
+		copied.numbers = {field: list(column) for field, column in self.numbers.items()}
+		return copied
+
+	def column(self, field: str) -> np.ndarray:
+		if field not in self._columns:
+			self._columns[field] = np.asarray(self.numbers[field], dtype=np.float64)
+		return self._columns[field]
+
+	def allowed(self, filter: dict, ntotal: int) -> np.ndarray | None:
+		"""
+		Mask of the positions matching every condition of the filter: a value, a list of values,
+		or a range for numeric fields. None if the filter uses fields which are not indexed.
+		"""
+		if not isinstance(filter, dict) or any(field not in INDEXED_FIELDS for field in filter):
+			return None
+		mask = np.ones(ntotal, dtype=bool)
+		for field, condition in filter.items():
+			if field in NUMERIC_FIELDS:
+				field_mask = self._numeric_mask(field, condition, ntotal)
+				if field_mask is None:
+					return None
+			else:
+				field_mask = np.zeros(ntotal, dtype=bool)
+				values = condition if isinstance(condition, (list, tuple, set)) else [condition]
+				for value in values:
+					positions = self.values[field].get(value)
+					if positions:
+						field_mask[np.asarray(positions, dtype=np.int64)] = True
+			mask &= field_mask
+		return mask
+
+	def _numeric_mask(self, field: str, condition, ntotal: int) -> np.ndarray | None:
+		column = self.column(field)
+		column = np.concatenate([column, np.full(max(0, ntotal - len(column)), np.nan)])[:ntotal]
+		if isinstance(condition, dict):
+			if any(op not in RANGE_OPERATORS for op in condition):
+				return None
+			mask = ~np.isnan(column)
+			for op, bound in condition.items():
+				mask &= RANGE_OPERATORS[op](column, float(bound))
+			return mask
+		values = condition if isinstance(condition, (list, tuple, set)) else [condition]
+		return np.isin(column, np.asarray(values, dtype=np.float64))
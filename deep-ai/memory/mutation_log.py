@@ -0,0 +1,367 @@
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+from log import log
+from memory.sqlite_docstore import dumps_metadata, loads_metadata
+
+try:
+	import fcntl
+except ImportError:
+	# Windows: writers of other processes are not locked out
+	fcntl = None
+
+# A checkpoint folds the mutation log of an index into a new snapshot after this many transactions,
+# or this many seconds after the first one
+FAISS_CHECKPOINT_OPERATIONS = int(os.getenv("FAISS_CHECKPOINT_OPERATIONS", 1000))
+FAISS_CHECKPOINT_INTERVAL = float(os.getenv("FAISS_CHECKPOINT_INTERVAL", 60))
+# fsync the mutation log on every commit
+FAISS_WAL_FSYNC = os.getenv("FAISS_WAL_FSYNC", "true").lower() == "true"
+# Records of a transaction never committed (its process died) are dropped by checkpoints after this many seconds
+FAISS_WAL_TRANSACTION_TIMEOUT = 3600
+
+# payload length, crc32 of the payload
+RECORD_HEADER = struct.Struct("<II")
+JSON_LENGTH = struct.Struct("<I")
+
+
+def wal_path(folder_path: str, index_name: str) -> str:
+	"""Mutation log of the index since its last snapshot."""
+	return os.path.join(folder_path, f"{index_name}.wal")
+
+
+class Mutation:
+	"""A record of the mutation log: `add`, `remove`, `clear`, `commit` or `abort`, part of a transaction."""
+
+	def __init__(self, op: str, transaction: str, ids=None, texts=None, metadatas=None, vectors=None, at=None):
+		self.op = op
+		self.transaction = transaction
+		self.ids = ids
+		self.texts = texts
+		self.metadatas = metadatas
+		self.vectors = vectors
+		self.at = at or time.time()
+
+	def encode(self) -> bytes:
+		header = dumps_metadata({
+			"op": self.op,
+			"transaction": self.transaction,
+			"at": self.at,
+			"ids": self.ids,
+			"texts": self.texts,
+			"metadatas": self.metadatas,
+			"dim": None if self.vectors is None else self.vectors.shape[1],
+		}).encode("utf-8")
+		payload = JSON_LENGTH.pack(len(header)) + header
+		if self.vectors is not None:
+			payload += np.ascontiguousarray(self.vectors, dtype="<f4").tobytes()
+		return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+	@staticmethod
+	def decode(payload: bytes) -> "Mutation":
+		(header_length,) = JSON_LENGTH.unpack_from(payload)
+		header = loads_metadata(payload[JSON_LENGTH.size:JSON_LENGTH.size + header_length].decode("utf-8"))
+		vectors = None
+		if header["dim"] is not None:
+			vectors = np.frombuffer(payload[JSON_LENGTH.size + header_length:], dtype="<f4").reshape(-1, header["dim"])
+		return Mutation(
+			header["op"], header["transaction"], header["ids"], header["texts"], header["metadatas"], vectors, header["at"]
+		)
+
+
+class MutationLog:
+	"""
+	Append-only log of the mutations of an index since its last snapshot, as length-prefixed, CRC-checked records.
+	Reads stop at the first incomplete or corrupted record, so a write interrupted by a crash is simply ignored.
+	"""
+
+	def __init__(self, folder_path: str, index_name: str):
+		self.path = wal_path(folder_path, index_name)
+		self.lock_path = f"{self.path}.lock"
+		self._lock = threading.RLock()
+		# transactions committed by this process since the last checkpoint
+		self.pending_transactions = 0
+		# position of the end of the log, as last appended or checked by this process
+		self._end = None
+		# transactions committed by this process: its index writer publishes them, readers do not reload for them
+		self.local_transactions: set[str] = set()
+
+	@contextmanager
+	def lock(self):
+		"""Exclusive access to the log, between the threads and the processes writing it."""
+		with self._lock:
+			if fcntl is None:
+				yield
+				return
+			os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+			with open(self.lock_path, "a") as f:
+				fcntl.flock(f, fcntl.LOCK_EX)
+				try:
+					yield
+				finally:
+					fcntl.flock(f, fcntl.LOCK_UN)
+
+	def append(self, mutations: list[Mutation], sync: bool = False):
+		data = b"".join(mutation.encode() for mutation in mutations)
+		with self.lock():
+			self._repair()
+			with open(self.path, "ab") as f:
+				f.write(data)
+				f.flush()
+				if sync and FAISS_WAL_FSYNC:
+					os.fsync(f.fileno())
+				self._end = os.fstat(f.fileno()).st_ino, f.tell()
+
+	def _repair(self):
+		"""Cut the incomplete record a crashed writer may have left at the end of the log, before appending after it."""
+		position = self.position()
+		if position is None or position == self._end:
+			return
+		# only what other writers appended since is checked
+		_, end = self.read(self._end)
+		if end[1] < position[1]:
+			log(f"Truncating the incomplete record at the end of mutation log {self.path}", "WARNING")
+			os.truncate(self.path, end[1])
+		self._end = end
+
+	def position(self) -> tuple[int, int] | None:
+		"""(inode, size) of the log, None if there is none."""
+		try:
+			stat = os.stat(self.path)
+		except OSError:
+			return None
+		return stat.st_ino, stat.st_size
+
+	def read(self, position: tuple[int, int] | None = None) -> tuple[list[tuple[int, Mutation]], tuple[int, int] | None]:
+		"""
+		Records from a position of the log (from its start if the log has been rewritten since), with their offsets.
+		Returns them with the position after the last valid record.
+		"""
+		try:
+			f = open(self.path, "rb")
+		except FileNotFoundError:
+			return [], None
+
+		records = []
+		with f:
+			inode = os.fstat(f.fileno()).st_ino
+			offset = position[1] if position is not None and position[0] == inode else 0
+			f.seek(offset)
+			data = f.read()
+
+		cursor = 0
+		while cursor + RECORD_HEADER.size <= len(data):
+			length, crc = RECORD_HEADER.unpack_from(data, cursor)
+			payload = data[cursor + RECORD_HEADER.size:cursor + RECORD_HEADER.size + length]
+			if len(payload) < length or zlib.crc32(payload) != crc:
+				log(f"Mutation log {self.path} has an incomplete record at {offset + cursor}, ignoring the rest", "WARNING")
+				break
+			records.append((offset + cursor, Mutation.decode(payload)))
+			cursor += RECORD_HEADER.size + length
+		return records, (inode, offset + cursor)
+
+	def foreign_commits(self, position: tuple[int, int] | None) -> tuple[bool, tuple[int, int] | None]:
+		"""
+		Whether transactions of other processes have been committed since a position of the log, and the position
+		of its end. Records of transactions still open do not count, a log rewritten since does.
+		"""
+		current = self.position()
+		if current == position:
+			return False, position
+		if current is None:
+			# removed by a checkpoint, along with a new snapshot
+			return False, None
+		if position is not None and current[0] != position[0]:
+			return True, current
+		records, end = self.read(position)
+		foreign = any(m.op == "commit" and m.transaction not in self.local_transactions for _, m in records)
+		return foreign, end
+
+	def truncate(self, position: tuple[int, int] | None) -> tuple[int, int] | None:
+		"""
+		Drop the records before a position, once they are part of a snapshot.
+		Records of transactions not committed yet are kept, unless they are too old.
+		Returns the position of the kept records in the rewritten log. To be called while holding the lock.
+		"""
+		current = self.position()
+		if position is None or current is None or current[0] != position[0]:
+			# nothing applied yet, or rewritten by another process since
+			return position
+
+		records, _ = self.read()
+		finished = {m.transaction for _, m in records if m.op in ("commit", "abort")}
+		expired_at = time.time() - FAISS_WAL_TRANSACTION_TIMEOUT
+		kept = [
+			m for start, m in records
+			if start >= position[1] or (m.transaction not in finished and m.at > expired_at)
+		]
+		self.local_transactions &= {m.transaction for m in kept}
+		if len(kept) == 0:
+			os.remove(self.path)
+			self._end = None
+			return None
+
+		tmp_path = f"{self.path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			f.write(b"".join(m.encode() for m in kept))
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
+		self._end = self.position()
+		return self._end[0], 0
+
+
+_logs: dict[str, MutationLog] = {}
+_logs_lock = threading.Lock()
+
+
+def mutation_log(folder_path: str, index_name: str) -> MutationLog:
+	"""The mutation log of an index, shared by the threads of the process."""
+	path = os.path.abspath(wal_path(folder_path, index_name))
+	with _logs_lock:
+		if path not in _logs:
+			_logs[path] = MutationLog(folder_path, index_name)
+		return _logs[path]
+
+
+def committed_mutations(
+	records: list[tuple[int, Mutation]],
+	position: tuple[int, int] | None
+) -> tuple[list[Mutation], tuple[int, int] | None]:
+	"""
+	Mutations of the committed transactions in commit order, and the position up to which the log is applied:
+	before the first record of a transaction still open, to read it again once committed.
+	"""
+	pending: dict[str, list[Mutation]] = {}
+	starts: dict[str, int] = {}
+	mutations = []
+	for start, mutation in records:
+		if mutation.op in ("commit", "abort"):
+			if mutation.op == "commit":
+				mutations += pending.get(mutation.transaction, [])
+			pending.pop(mutation.transaction, None)
+			starts.pop(mutation.transaction, None)
+		else:
+			pending.setdefault(mutation.transaction, []).append(mutation)
+			starts.setdefault(mutation.transaction, start)
+
+	expired_at = time.time() - FAISS_WAL_TRANSACTION_TIMEOUT
+	open_starts = [starts[t] for t, m in pending.items() if m[0].at > expired_at]
+	if open_starts and position is not None:
+		position = (position[0], min(open_starts))
+	return mutations, position
+
+
+class MutationTransaction:
+	"""
+	Mutations of an index logged as they come, but applied only once committed:
+	an ingestion interrupted half way leaves the index untouched.
+	"""
+
+	def __init__(self, mutation_log: MutationLog):
+		self.log = mutation_log
+		self.id = uuid.uuid4().hex
+		self.operations = 0
+		# ids of the documents added
+		self.added_ids: list[str] = []
+		# the vectorstore with the transaction applied, once committed
+		self.faiss_db = None
+
+	def add_embeddings(
+		self,
+		text_embeddings: list[tuple[str, list[float]]],
+		metadatas: list[dict] | None = None,
+		ids: list[str] | None = None
+	) -> list[str]:
+		"""Add documents, with new ids unless they are given (the same document in another index)."""
+		if len(text_embeddings) == 0:
+			return []
+		texts = [text for text, _ in text_embeddings]
+		ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+		vectors = np.array([embedding for _, embedding in text_embeddings], dtype=np.float32)
+		self.log.append([Mutation("add", self.id, ids, texts, metadatas or [{} for _ in texts], vectors)])
+		self.operations += 1
+		self.added_ids += ids
+		return ids
+
+	@property
+	def added(self) -> int:
+		return len(self.added_ids)
+
+	def remove(self, ids: list[str] | None):
+		"""Remove documents by id, all of them if ids is None."""
+		if ids is None:
+			self.log.append([Mutation("clear", self.id)])
+		else:
+			self.log.append([Mutation("remove", self.id, list(ids))])
+		self.operations += 1
+
+	def commit(self):
+		self.log.local_transactions.add(self.id)
+		self.log.append([Mutation("commit", self.id)], sync=True)
+
+	def abort(self):
+		self.log.append([Mutation("abort", self.id)])
+
+	def rollback(self):
+		"""
+		Undo a transaction committed but not applied, by committing the removal of the documents it added:
+		they end up tombstones wherever it is replayed. Its removals are not undone.
+		"""
+		if len(self.added_ids) == 0:
+			return
+		undo = MutationTransaction(self.log)
+		undo.remove(self.added_ids)
+		undo.commit()
+
+
+class IndexCheckpointer:
+	"""
+	Background thread folding the mutation logs into new snapshots, every `FAISS_CHECKPOINT_INTERVAL` seconds
+	or as soon as `FAISS_CHECKPOINT_OPERATIONS` transactions have been committed to an index.
+	"""
+
+	def __init__(self, interval: float = FAISS_CHECKPOINT_INTERVAL, operations: int = FAISS_CHECKPOINT_OPERATIONS):
+		self.interval = interval
+		self.operations = operations
+		self.checkpoints = 0
+		# (folder_path, index_name) -> vector memory to checkpoint it with
+		self._dirty: dict[tuple, object] = {}
+		self._wakeup = threading.Event()
+		self._thread = None
+		self._lock = threading.Lock()
+
+	def mark(self, vector_memory, index_name: str, folder_path: str):
+		mutations = mutation_log(folder_path, index_name)
+		mutations.pending_transactions += 1
+		with self._lock:
+			self._dirty[(folder_path, index_name)] = vector_memory
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._loop, name="index-checkpointer", daemon=True)
+				self._thread.start()
+		if mutations.pending_transactions >= self.operations:
+			self._wakeup.set()
+
+	def _loop(self):
+		while True:
+			self._wakeup.wait(self.interval)
+			self._wakeup.clear()
+			with self._lock:
+				dirty, self._dirty = self._dirty, {}
+
+			for (folder_path, index_name), vector_memory in dirty.items():
+				try:
+					if vector_memory.checkpoint(index_name, folder_path):
+						self.checkpoints += 1
+						mutation_log(folder_path, index_name).pending_transactions = 0
+				except Exception as e:
+					log(f"Failed to checkpoint FAISS index {index_name}: {e}", "ERROR")
+
+
+index_checkpointer = IndexCheckpointer()
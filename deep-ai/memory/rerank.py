@@ -0,0 +1,90 @@
+import time
+from typing import Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from pydantic import BaseModel
+
+from memory.keyword_index import RRF_K
+from memory.metadata_index import metadata_value
+
+
+def relevance(memories: list[tuple[Document, float]], retrieval: str) -> list[float]:
+	"""
+	Scores of the memories of an index as relevances in [0, 1], higher is better, to merge the memories of several indexes:
+	vector scores are L2 distances, comparable between indexes of the same embedder, hybrid ones are reciprocal rank
+	fusions of two rankings, and BM25 scores, which depend on the corpus, are relative to the best one.
+	"""
+	scores = np.array([score for _, score in memories], dtype=np.float64)
+	if len(scores) == 0:
+		return []
+	if retrieval == "keyword":
+		scores = scores / max(scores.max(), 1e-12)
+	elif retrieval == "hybrid":
+		scores = scores * (RRF_K + 1) / 2
+	else:
+		scores = 1 / (1 + np.maximum(scores, 0))
+	return np.clip(scores, 0, 1).tolist()
+
+
+def maximal_marginal_relevance(relevances: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float) -> list[int]:
+	"""
+	Candidates picked one by one, each maximizing `lambda_mult * relevance - (1 - lambda_mult) * redundancy`,
+	the redundancy being its highest cosine similarity with the candidates already picked.
+	"""
+	n = len(relevances)
+	if n == 0:
+		return []
+	vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+	similarities = vectors @ vectors.T
+
+	picked = []
+	redundancy = np.zeros(n)
+	available = np.ones(n, dtype=bool)
+	for _ in range(min(k, n)):
+		scores = np.where(available, lambda_mult * relevances - (1 - lambda_mult) * redundancy, -np.inf)
+		i = int(np.argmax(scores))
+		picked.append(i)
+		available[i] = False
+		redundancy = np.maximum(redundancy, similarities[i])
+	return picked
+
+
+class RerankSettings(BaseModel):
+	"""
+	Post-retrieval stage of a recall, the `rerank` of the recall config: `fetch_k` candidates are fetched once,
+	boosted, and the k memories are picked among them by maximal marginal relevance, on their stored vectors.
+	"""
+	# candidates fetched from every index, None: no re-ranking
+	fetch_k: Optional[int] = None
+	# 1 ranks by relevance only, 0 by diversity only, None: no diversity
+	mmr_lambda: Optional[float] = None
+	# added to the relevance of a memory from now, halved every `recency_half_life` seconds of its `when`
+	recency_boost: float = 0.0
+	recency_half_life: float = 30 * 24 * 3600
+	# added to the relevance of the memories of a source
+	source_boosts: dict[str, float] = {}
+
+	@property
+	def enabled(self) -> bool:
+		return self.fetch_k is not None and (
+			self.mmr_lambda is not None or self.recency_boost != 0 or len(self.source_boosts) > 0
+		)
+
+	def boosts(self, metadatas: list[dict], now: float | None = None) -> np.ndarray:
+		boosts = np.zeros(len(metadatas))
+		if self.recency_boost != 0:
+			when = np.array([metadata_value(metadata, "when") for metadata in metadatas], dtype=object)
+			known = np.array([isinstance(w, (int, float)) for w in when], dtype=bool)
+			ages = np.maximum((now or time.time()) - when[known].astype(np.float64), 0)
+			boosts[known] += self.recency_boost * np.exp2(-ages / self.recency_half_life)
+		if self.source_boosts:
+			boosts += [self.source_boosts.get(metadata.get("source"), 0.0) for metadata in metadatas]
+		return boosts
+
+	def rank(self, relevances: list[float], metadatas: list[dict], vectors: np.ndarray, k: int) -> list[int]:
+		"""Positions of the k candidates to recall, in order."""
+		relevances = np.asarray(relevances, dtype=np.float64) + self.boosts(metadatas)
+		if self.mmr_lambda is None:
+			return np.argsort(-relevances, kind="stable")[:k].tolist()
+		return maximal_marginal_relevance(relevances, vectors, k, self.mmr_lambda)
@@ -0,0 +1,107 @@
+import dataclasses
+import json
+import sqlite3
+import threading
+from typing import Dict, List, Union
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+# dataclasses which can be stored in the documents metadata, by name
+_metadata_types: dict[str, type] = {}
+
+
+def register_metadata_type(cls):
+	"""Class decorator, to store instances of a dataclass in the metadata of SQLite stored documents."""
+	_metadata_types[cls.__name__] = cls
+	return cls
+
+
+def _encode_metadata_value(value):
+	if dataclasses.is_dataclass(value) and not isinstance(value, type):
+		return {"__dataclass__": type(value).__name__, **dataclasses.asdict(value)}
+	return str(value)
+
+
+def _decode_metadata_value(obj: dict):
+	name = obj.pop("__dataclass__", None)
+	if name in _metadata_types:
+		return _metadata_types[name](**obj)
+	return obj
+
+
+def dumps_metadata(metadata: dict) -> str:
+	return json.dumps(metadata, default=_encode_metadata_value, ensure_ascii=False)
+
+
+def loads_metadata(metadata: str) -> dict:
+	return json.loads(metadata, object_hook=_decode_metadata_value)
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+	"""
+	Docstore kept in a SQLite file, documents being read only when they are searched for.
+	Metadata are stored as JSON, registered dataclasses (see `register_metadata_type`) included.
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+		# sqlite connections cannot be shared between threads
+		self._local = threading.local()
+
+	def _connection(self) -> sqlite3.Connection:
+		connection = getattr(self._local, "connection", None)
+		if connection is None:
+			connection = sqlite3.connect(self.path, timeout=30)
+			# readers of other processes are not blocked by writes
+			connection.execute("PRAGMA journal_mode=WAL")
+			connection.execute(
+				"CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)"
+			)
+			self._local.connection = connection
+		return connection
+
+	@staticmethod
+	def _document(row) -> Document:
+		return Document(page_content=row[0], metadata=loads_metadata(row[1]))
+
+	def add(self, texts: Dict[str, Document]) -> None:
+		# the file is shared by the processes replaying the same mutation log, adding a document twice is not an error
+		connection = self._connection()
+		with connection:
+			connection.executemany(
+				"INSERT OR REPLACE INTO documents (id, page_content, metadata) VALUES (?, ?, ?)",
+				[(_id, doc.page_content, dumps_metadata(doc.metadata)) for _id, doc in texts.items()]
+			)
+
+	def delete(self, ids: List) -> None:
+		connection = self._connection()
+		with connection:
+			connection.executemany("DELETE FROM documents WHERE id = ?", [(_id,) for _id in ids])
+
+	def search(self, search: str) -> Union[str, Document]:
+		row = self._connection().execute(
+			"SELECT page_content, metadata FROM documents WHERE id = ?", (search,)
+		).fetchone()
+		if row is None:
+			return f"ID {search} not found."
+		return self._document(row)
+
+	def search_many(self, ids: List[str]) -> Dict[str, Document]:
+		"""Documents of the ids found, in a single query."""
+		if len(ids) == 0:
+			return {}
+		rows = self._connection().execute(
+			f"SELECT id, page_content, metadata FROM documents WHERE id IN ({','.join('?' * len(ids))})", list(ids)
+		).fetchall()
+		return {row[0]: self._document(row[1:]) for row in rows}
+
+	def ids(self) -> set[str]:
+		return {row[0] for row in self._connection().execute("SELECT id FROM documents")}
+
+	def all(self) -> Dict[str, Document]:
+		rows = self._connection().execute("SELECT id, page_content, metadata FROM documents").fetchall()
+		return {row[0]: self._document(row[1:]) for row in rows}
+
+	def __len__(self):
+		return self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
@@ -1,11 +1,63 @@
 import os
+import pickle
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Optional, List
 
+import faiss
 import numpy as np
+from langchain.docstore.document import Document
 from langchain.embeddings.base import Embeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores.faiss import FAISS
 
 from log import log
+from factory.embedding_scheduler import embedding_scheduler
+from memory.ann_index import (
+	IndexSettings,
+	apply_search_params,
+	ensure_direct_map,
+	index_promoter,
+	index_quantization,
+	remove_positions
+)
+from memory.faiss_store import DeepAIFAISS
+from memory.index_cache import docstore_format, docstore_path, files_stamp, index_cache, index_files
+from memory.sqlite_docstore import SQLiteDocstore
+from memory.index_compactor import index_compactor
+from memory.chunk_index import ChunkIndex, merge_chunks
+from memory.index_namespace import (
+	NAMESPACE_SEPARATOR,
+	SHARED_INDEXES,
+	base_index_name,
+	embedder_namespace,
+	index_catalog,
+	index_namespaces,
+	index_reembedder,
+	namespaced_index
+)
+from memory.index_writer import index_writer
+from memory.keyword_index import KeywordIndex, keyword_index_path
+from memory.metadata_index import MetadataIndex
+from memory.mutation_log import MutationTransaction, committed_mutations, index_checkpointer, mutation_log
+from memory.rerank import RerankSettings, relevance
+
+# Memory-map the FAISS indexes read-only, so the OS page cache shares them between uvicorn workers
+FAISS_MMAP_INDEXES = os.getenv("FAISS_MMAP_INDEXES", "false").lower() == "true"
+# Attempts to load an index whose files are being replaced by a writer at the same time
+FAISS_LOAD_RETRIES = 3
+# Document every new index is created with
+NEW_INDEX_TEXT = "Hello, Deep AI!"
+# Indexes searched at the same time by the recalls of all the requests
+RECALL_THREADS = int(os.getenv("RECALL_THREADS", 8))
+
+# Files of an index written before namespaces, renamed when adopted by an embedder namespace: the index file last
+LEGACY_INDEX_SUFFIXES = [
+	".pkl", ".ids.npy", ".docs.sqlite", ".docs.sqlite-wal", ".docs.sqlite-shm", ".vectors.f32", ".keywords.npz", ".wal", ".faiss"
+]
+
+_search_executor = ThreadPoolExecutor(max_workers=RECALL_THREADS, thread_name_prefix="index-search")
 
 
 class VectorMemory:
@@ -24,27 +76,466 @@ class VectorMemory:
 	def refresh_embedder(self, embedder):
 		self.embedder = embedder
 
-	def faiss_db(self, index_name: str = 'index', folder_path=None) -> FAISS:
-		user_db = VectorMemoryCollection.build(
-			bot=self.bot,
-			folder_path=self.common_storage if folder_path is None else folder_path,
-			embeddings=self.embedder,
-			index_name=str(index_name)
+	def index_name(self, index_name: str, embedder=None) -> str:
+		"""
+		Function to get the name of the index of a knowledge base for the embedder: indexes are namespaced by embedder,
+		see `memory.index_namespace`. Names of namespaced and shared indexes are kept as they are.
+		"""
+		index_name = str(index_name)
+		if NAMESPACE_SEPARATOR in index_name or index_name in SHARED_INDEXES:
+			return index_name
+		return namespaced_index(index_name, embedder_namespace(embedder or self.embedder))
+
+	def searched_index(self, index_name: str, folder_path=None, embedder=None) -> tuple[str, bool]:
+		"""
+		Function to get the index of a knowledge base to search, and whether its vectors are from the embedder
+		(the one of the vector memory by default).
+		Missing or stale indexes are re-embedded in the background: until then, the freshest other index
+		of the knowledge base is searched by keywords.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		if NAMESPACE_SEPARATOR in index_name or index_name in SHARED_INDEXES:
+			return index_name, True
+
+		self.adopt_legacy_index(index_name, folder_path)
+		embedder = embedder or self.embedder
+		namespace = embedder_namespace(embedder)
+		catalog = index_catalog(folder_path, index_name)
+		status = catalog.status(namespace)
+		if status != "current":
+			index_reembedder.schedule(self, index_name, embedder, folder_path)
+		if status == "missing":
+			return namespaced_index(index_name, catalog.freshest(exclude=namespace)), False
+		return namespaced_index(index_name, namespace), True
+
+	def faiss_db(self, index_name: str = 'index', folder_path=None, writable=False) -> FAISS:
+		"""
+		Function to get the vectorstore of a knowledge base for the embedder, a version which is never modified once returned.
+		Callers modify the vectorstore through a `transaction`, `writable` ones are heap copies of memory-mapped indexes.
+		"""
+		self.adopt_legacy_index(index_name, folder_path)
+		return self._faiss_db(self.index_name(index_name), folder_path, writable)
+
+	def _faiss_db(self, index_name: str, folder_path=None, writable=False, embedder=None) -> FAISS:
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		# a missing index is created with the embedder of its namespace
+		embedder = embedder or self.embedder
+
+		if writable and FAISS_MMAP_INDEXES:
+			# copy-on-write: memory-mapped indexes are read-only, writers get their own heap copy
+			return VectorMemoryCollection.build(
+				bot=self.bot,
+				folder_path=folder_path,
+				embeddings=embedder,
+				index_name=index_name,
+				mmap=False
+			)
+
+		# loaded indexes are cached per process, and reloaded only when their files change
+		user_db = index_cache.get_or_load(
+			folder_path,
+			index_name,
+			embedder,
+			lambda: VectorMemoryCollection.build(
+				bot=self.bot,
+				folder_path=folder_path,
+				embeddings=embedder,
+				index_name=index_name,
+				mmap=FAISS_MMAP_INDEXES
+			)
 		)
+		# removed documents left by a previous process
+		index_compactor.mark(self, user_db, index_name, folder_path)
 
 		return user_db
 
+	def adopt_legacy_index(self, index_name: str, folder_path=None):
+		"""
+		Function to make the index of a knowledge base written before namespaces the index of the default embedder,
+		which built it, rather than re-embedding it: its files are renamed when the dimensions match.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		if NAMESPACE_SEPARATOR in index_name or index_name in SHARED_INDEXES:
+			return
+		catalog = index_catalog(folder_path, index_name)
+		if not catalog.is_legacy():
+			return
+
+		namespace = embedder_namespace(self.embedder)
+		try:
+			catalog.adopt_legacy(namespace, lambda: self._rename_legacy_index(index_name, namespace, folder_path))
+		except Exception as e:
+			# retried on the next access, the legacy index is searched meanwhile
+			log(f"Failed to adopt FAISS index {index_name} for {namespace}: {e}", "ERROR")
+
+	def _rename_legacy_index(self, index_name: str, namespace: str, folder_path: str) -> bool:
+		target_name = namespaced_index(index_name, namespace)
+		index_path = index_files(folder_path, index_name)[0]
+		dimension = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY).d
+		if dimension != len(self.embedder.embed_query(NEW_INDEX_TEXT)):
+			log(f"FAISS index {index_name} was not built by {namespace} ({dimension} dimensions), keeping it apart", "WARNING")
+			return False
+		if os.path.exists(index_files(folder_path, target_name)[0]):
+			return False
+
+		# under the lock, no transaction is applied to the legacy index meanwhile
+		with mutation_log(folder_path, index_name).lock():
+			for suffix in LEGACY_INDEX_SUFFIXES:
+				path = os.path.join(folder_path, f"{index_name}{suffix}")
+				if os.path.exists(path):
+					os.replace(path, os.path.join(folder_path, f"{target_name}{suffix}"))
+		index_cache.invalidate(folder_path, index_name)
+		log(f"FAISS index {index_name} adopted as the index of {namespace}", 'INFO')
+		return True
+
+	def load(self, index_name: str, folder_path=None) -> FAISS:
+		"""
+		Function to load a private copy of the vectorstore, not shared with the index cache.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		return VectorMemoryCollection.load(folder_path, self.embedder, str(index_name))
+
+	def search(
+		self,
+		index_name: str,
+		folder_path=None,
+		query_text: str = "",
+		query_embedding: Future | List[float] | None = None,
+		k: int = 2,
+		threshold: Optional[float] = None,
+		filter: Optional[dict] = None,
+		retrieval: str = "vector",
+		with_vectors: bool = False,
+		embedder=None
+	) -> List[tuple[Document, float]] | tuple[List[tuple[Document, float]], np.ndarray]:
+		"""
+		Function to search an index with the `vector`, `keyword` or `hybrid` retrieval.
+		The query embedding may be a Future: the index is loaded while it is computed.
+		"""
+		faiss_db = self._faiss_db(index_name, folder_path, embedder=embedder)
+		if isinstance(query_embedding, Future):
+			query_embedding = query_embedding.result() if retrieval != "keyword" else None
+
+		# metadata filters on indexed fields restrict the search itself, see `memory.metadata_index`
+		return faiss_db.search_with_score(
+			query_text, query_embedding, k=k, score_threshold=threshold, filter=filter, retrieval=retrieval, with_vectors=with_vectors
+		)
+
+	def recall(
+		self,
+		index_names: List[str],
+		folder_path=None,
+		query_text: str = "",
+		query_embedding: Future | List[float] | None = None,
+		k: int = 2,
+		threshold: Optional[float] = None,
+		filter: Optional[dict] = None,
+		retrieval: str = "vector",
+		rerank: Optional[dict] = None,
+		neighbours: int = 0,
+		embedder=None
+	) -> List[tuple[Document, float]]:
+		"""
+		Function to recall memories from several indexes, e.g. a knowledge base and the global ones, searched in parallel
+		with the query embedded once. The best k memories over all of them are returned, compared by their `relevance`,
+		each with the index it comes from as `knowledge_base_id` in its metadata.
+		With `rerank` settings, see `memory.rerank.RerankSettings`, the k memories are picked among more candidates.
+		With `neighbours`, they are extended with their neighbour chunks, see `expand_neighbours`.
+		The indexes searched are the ones of the `embedder` of the chat, the one of the vector memory by default.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		embedder = embedder or self.embedder
+		index_names = [str(index_name) for index_name in dict.fromkeys(index_names)]
+		if query_embedding is None and retrieval != "keyword":
+			query_embedding = embedder.embed_query(query_text)
+		rerank = RerankSettings(**(rerank or {}))
+		n = max(k, rerank.fetch_k) if rerank.enabled else k
+
+		# indexes not embedded by the embedder yet are searched by keywords
+		searched = [self.searched_index(index_name, folder_path, embedder) for index_name in index_names]
+		retrievals = [retrieval if embedded else "keyword" for _, embedded in searched]
+		searches = [
+			_search_executor.submit(
+				self.search, name, folder_path, query_text, query_embedding, n, threshold, filter, index_retrieval,
+				rerank.enabled and embedded, embedder if embedded else None
+			)
+			for (name, embedded), index_retrieval in zip(searched, retrievals)
+		]
+
+		candidates, relevances, vectors = [], [], []
+		for index_name, (_, embedded), index_retrieval, search in zip(index_names, searched, retrievals, searches):
+			if rerank.enabled and embedded:
+				memories, index_vectors = search.result()
+			else:
+				memories, index_vectors = search.result(), None
+			vectors += [index_vectors] if index_vectors is not None else [None] * len(memories)
+			relevances += relevance(memories, index_retrieval)
+			for doc, score in memories:
+				# a copy: documents of in-memory docstores are shared by the searches of the index
+				doc = Document(page_content=doc.page_content, metadata={**doc.metadata, "knowledge_base_id": index_name})
+				candidates.append((doc, score))
+
+		if len(candidates) == 0:
+			return []
+		if rerank.enabled:
+			# memories of indexes searched by keywords have no comparable vectors, they are never redundant
+			dim = next((v.shape[1] for v in vectors if v is not None), 1)
+			vectors = np.concatenate([v if v is not None else np.zeros((1, dim), dtype=np.float32) for v in vectors])
+			order = rerank.rank(relevances, [doc.metadata for doc, _ in candidates], vectors, k)
+		else:
+			# stable: memories of equal relevance keep the order of the indexes
+			order = np.argsort(-np.asarray(relevances), kind="stable")[:k].tolist()
+		memories = [candidates[i] for i in order]
+		if neighbours > 0:
+			memories = self.expand_neighbours(memories, folder_path, neighbours, embedder)
+		return memories
+
+	def expand_neighbours(
+		self, memories: List[tuple[Document, float]], folder_path=None, neighbours: int = 1, embedder=None
+	) -> List[tuple[Document, float]]:
+		"""
+		Function to extend recalled chunks with the chunks before and after them in their source, found by the order
+		recorded at ingestion, their overlaps written once. Recalled chunks whose neighbourhoods overlap become one memory,
+		ranked as the best of them. Chunks ingested without order are left as they are.
+		"""
+		# [doc, score, (knowledge base, source), first ordinal, last ordinal]
+		expanded = []
+		for doc, score in memories:
+			ordinal = doc.metadata.get("ordinal")
+			if not isinstance(ordinal, int) or doc.metadata.get("source") is None:
+				expanded.append([doc, score, None, None, None])
+				continue
+			key = (doc.metadata.get("knowledge_base_id"), doc.metadata["source"])
+			first, last = ordinal - neighbours, ordinal + neighbours
+			merged = next((m for m in expanded if m[2] == key and first <= m[4] + 1 and m[3] <= last + 1), None)
+			if merged is None:
+				expanded.append([doc, score, key, first, last])
+			else:
+				merged[3], merged[4] = min(merged[3], first), max(merged[4], last)
+
+		results = []
+		for doc, score, key, first, last in expanded:
+			if key is None:
+				results.append((doc, score))
+				continue
+			index_name, embedded = self.searched_index(key[0], folder_path, embedder)
+			faiss_db = self._faiss_db(index_name, folder_path, embedder=embedder if embedded else None)
+			chunks = faiss_db.neighbour_documents(key[1], list(range(max(first, 0), last + 1)))
+			chunks.setdefault(doc.metadata["ordinal"], doc)
+			ordinals = sorted(chunks)
+			results.append((
+				Document(
+					page_content=merge_chunks([chunks[ordinal].page_content for ordinal in ordinals]),
+					metadata={**doc.metadata, "ordinals": ordinals}
+				),
+				score
+			))
+		return results
+
+	@contextmanager
+	def transaction(self, index_name: str, folder_path=None):
+		"""
+		Function to modify the vectorstore of a knowledge base for the embedder: mutations are appended to the mutation log
+		of the index as they come, and applied all at once when the block exits without error.
+		The vectorstore is then `transaction.faiss_db`.
+
+			with vector_memory.transaction(index_name) as transaction:
+				transaction.remove(old_ids)
+				ids = transaction.add_embeddings(text_embeddings, metadatas)
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		self.adopt_legacy_index(index_name, folder_path)
+		namespaced_name = self.index_name(index_name)
+		with self._transaction(namespaced_name, folder_path) as transaction:
+			yield transaction
+		if transaction.added > 0 and NAMESPACE_SEPARATOR in namespaced_name:
+			# the indexes of the knowledge base for other embedders miss the added documents
+			base_name, namespace = namespaced_name.split(NAMESPACE_SEPARATOR, 1)
+			index_catalog(folder_path, base_name).written(namespace)
+
+	@contextmanager
+	def _transaction(self, index_name: str, folder_path=None):
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		transaction = MutationTransaction(mutation_log(folder_path, index_name))
+		try:
+			yield transaction
+		except BaseException:
+			if transaction.operations > 0:
+				transaction.abort()
+			raise
+		if transaction.operations == 0:
+			return
+		transaction.commit()
+		try:
+			# concurrent transactions of the index are merged by its single writer
+			transaction.faiss_db = index_writer(folder_path, index_name).apply(self)
+		except BaseException:
+			# the commit is durable, but the caller fails and keeps no record of the added documents
+			transaction.rollback()
+			raise
+
+	def apply_mutations(self, index_name: str, folder_path=None) -> FAISS:
+		"""
+		Function to apply the mutations committed to the log of an index to a new version of its vectorstore,
+		and publish it. Only called by the writer of the index, see `memory.index_writer`.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		mutations_log = mutation_log(folder_path, index_name)
+		with mutations_log.lock():
+			# under the lock, no checkpoint can replace the snapshot between the load and the replay
+			faiss_db = self._faiss_db(index_name, folder_path, writable=True)
+			records, end = mutations_log.read(faiss_db.wal_position)
+			mutations, position = committed_mutations(records, end)
+			if not FAISS_MMAP_INDEXES and len(mutations) > 0:
+				# the cached version keeps serving searches, mutations are applied to a copy,
+				# which clones the vectors only when some are added (removals are tombstones)
+				faiss_db = faiss_db.copy(clone_index=any(mutation.op in ("add", "clear") for mutation in mutations))
+			VectorMemoryCollection.replay(faiss_db, mutations)
+			faiss_db.wal_position = position
+			# every transaction committed up to the end of the log read is part of the new version
+			self._publish(faiss_db, index_name, folder_path, end)
+			mutations_log.local_transactions -= {mutation.transaction for mutation in mutations}
+
+		index_compactor.mark(self, faiss_db, index_name, folder_path)
+		index_checkpointer.mark(self, index_name, folder_path)
+		# large knowledge bases are rebuilt as ANN indexes in the background
+		index_promoter.maybe_schedule(self, faiss_db, index_name, folder_path)
+		return faiss_db
+
+	def save(self, faiss_db: FAISS, index_name: str, folder_path=None, expected_stamp=None) -> bool:
+		"""
+		Function to write the vectorstore as the new snapshot of the index, dropping the mutations it includes
+		from the mutation log, and keep the index cache in sync.
+		With the `expected_stamp` of the snapshot files, nothing is written if they have been replaced since.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		mutations_log = mutation_log(folder_path, index_name)
+		with mutations_log.lock():
+			if expected_stamp is not None and files_stamp(index_files(folder_path, index_name)) != expected_stamp:
+				return False
+			VectorMemoryCollection.save(faiss_db, folder_path, index_name)
+			faiss_db.wal_position = mutations_log.truncate(getattr(faiss_db, "wal_position", None))
+			# transactions committed after the snapshot was read are still to be applied
+			self._publish(faiss_db, index_name, folder_path, faiss_db.wal_position)
+		index_promoter.maybe_schedule(self, faiss_db, index_name, folder_path)
+		return True
+
+	def _publish(self, faiss_db: FAISS, index_name: str, folder_path: str, log_position):
+		if FAISS_MMAP_INDEXES:
+			# readers map the new files on their next access, rather than keeping the writer heap copy around
+			index_cache.invalidate(folder_path, index_name)
+		else:
+			# under the identity of the embedder of its namespace, the one the readers of the index look it up with
+			embedder = getattr(faiss_db, "embedding_function", None) or self.embedder
+			index_cache.put(folder_path, index_name, embedder, faiss_db, log_position)
+
 	def remove(self, index_name: str, ids: Optional[List[str]], folder_path=None):
 		"""
-		Function to remove documents from the vectorstore.
+		Function to remove documents from the vectorstore, from the indexes of the knowledge base for every embedder.
 		"""
-		vectorstore = self.faiss_db(index_name, folder_path)
-		faiss_db, removed, total = VectorMemoryCollection.remove(vectorstore, ids)
-		log(f"Total documents before removal: {total}", 'INFO')
-		log(f"Removed {removed} documents from index name: {index_name}", 'INFO')
-		faiss_db.save_local(self.common_storage if folder_path is None else folder_path, index_name)
+		folder_path = self.common_storage if folder_path is None else folder_path
+		self.adopt_legacy_index(index_name, folder_path)
+		namespaced_name = self.index_name(index_name)
+		index_names = [namespaced_name]
+		if NAMESPACE_SEPARATOR in namespaced_name and base_index_name(namespaced_name) == str(index_name):
+			index_names += [
+				namespaced_index(str(index_name), namespace)
+				for namespace in index_namespaces(folder_path, str(index_name))
+				if namespaced_index(str(index_name), namespace) != namespaced_name
+			]
+
+		faiss_db = None
+		for name in index_names:
+			with self._transaction(name, folder_path) as transaction:
+				transaction.remove(ids)
+			faiss_db = faiss_db or transaction.faiss_db
+		log(f"Removed {'all' if ids is None else len(ids)} documents from index name: {index_name}", 'INFO')
+		# the removed vectors stay in the index until it is compacted in the background
 		return faiss_db
 
+	def reembed(self, index_name: str, embedder, folder_path=None):
+		"""
+		Function to add to the index of a knowledge base for an embedder the documents of its other indexes it misses,
+		embedded from their stored text, with their ids and metadata. Run by `memory.index_namespace.index_reembedder`.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		namespace = embedder_namespace(embedder)
+		target_name = namespaced_index(index_name, namespace)
+		catalog = index_catalog(folder_path, index_name)
+		revision = catalog.read()["revision"]
+
+		sources = [ns for ns in index_namespaces(folder_path, index_name) if ns != namespace]
+		if not os.path.exists(index_files(folder_path, target_name)[0]):
+			# created with the embedder, whatever the embedder of the requests meanwhile
+			VectorMemoryCollection.build(self.bot, folder_path, embedder, target_name)
+		target_ids = set(VectorMemoryCollection.documents(self.load(target_name, folder_path)))
+
+		missing: dict[str, Document] = {}
+		for source in sources:
+			source_db = self.load(namespaced_index(index_name, source), folder_path)
+			documents = VectorMemoryCollection.documents(source_db)
+			for position in range(len(source_db.index_to_docstore_id)):
+				_id = source_db.index_to_docstore_id[position]
+				if _id in documents and _id not in target_ids and _id not in missing:
+					if documents[_id].page_content != NEW_INDEX_TEXT:
+						missing[_id] = documents[_id]
+
+		ids = list(missing.keys())
+		texts = [missing[_id].page_content for _id in ids]
+		log(f"Re-embedding {len(ids)} documents of FAISS index {index_name} for {namespace}", 'INFO')
+		with self._transaction(target_name, folder_path) as transaction:
+			for start, end, _, embeddings in embedding_scheduler.embed_batches(embedder, texts):
+				transaction.add_embeddings(
+					list(zip(texts[start:end], embeddings)),
+					[missing[_id].metadata for _id in ids[start:end]],
+					ids=ids[start:end]
+				)
+		catalog.synced(namespace, revision)
+
+	def compact(self, index_name: str, folder_path=None) -> bool:
+		"""
+		Function to remove the vectors of removed documents from an index, False if there is nothing to do
+		or the index has been written meanwhile (it will be compacted next time).
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		stamp = files_stamp(index_files(folder_path, index_name))
+		# a private copy, the cached vectorstore keeps serving searches meanwhile
+		faiss_db = self.load(index_name, folder_path)
+		removed = VectorMemoryCollection.compact(faiss_db)
+		if removed == 0:
+			return False
+		if not self.save(faiss_db, index_name, folder_path, expected_stamp=stamp):
+			log(f"FAISS index {index_name} changed during its compaction, retrying later", 'INFO')
+			index_compactor.mark(self, self._faiss_db(index_name, folder_path), index_name, folder_path)
+			return False
+
+		log(f"Compacted FAISS index {index_name}, {removed} vectors removed", 'INFO')
+		return True
+
+	def checkpoint(self, index_name: str, folder_path=None) -> bool:
+		"""
+		Function to fold the mutation log of an index into a new snapshot, False if there is nothing to do
+		or another snapshot has been written meanwhile.
+		"""
+		folder_path = self.common_storage if folder_path is None else folder_path
+		index_name = str(index_name)
+		stamp = files_stamp(index_files(folder_path, index_name))
+		if mutation_log(folder_path, index_name).position() is None:
+			return False
+		faiss_db = self.load(index_name, folder_path)
+		if not self.save(faiss_db, index_name, folder_path, expected_stamp=stamp):
+			return False
+		log(f"Checkpointed FAISS index {index_name}", 'DEBUG')
+		return True
+
 
 class VectorMemoryCollection:
 	@staticmethod
@@ -52,23 +543,166 @@ class VectorMemoryCollection:
 		bot,
 		folder_path: str,
 		embeddings: Embeddings | None = None,
-		index_name: str = "index"
+		index_name: str = "index",
+		mmap: bool = False
 	) -> FAISS:
 		try:
 			log(f"Load existing FAISS db {folder_path}, index name is {index_name}", 'INFO')
-			faiss_db = FAISS.load_local(folder_path, embeddings, index_name, allow_dangerous_deserialization=True)
+			faiss_db = VectorMemoryCollection.load(folder_path, embeddings, index_name, mmap)
 			log(f"{index_name} Loaded", 'INFO')
 			return faiss_db
-		except RuntimeError as re:
+		except (RuntimeError, FileNotFoundError) as re:
 			log(re.__str__(), 'DEBUG')
 			log(f"New FAISS db {folder_path}, index name is {index_name}", 'INFO')
 			os.makedirs(folder_path, exist_ok=True)
-			db = FAISS.from_texts(texts=["Hello, Deep AI!"], embedding=embeddings, metadatas=[{"name": "Hello"}])
-			db.save_local(folder_path, index_name)
-			faiss_db = FAISS.load_local(folder_path, embeddings, index_name, allow_dangerous_deserialization=True)
+			db = DeepAIFAISS.from_texts(texts=[NEW_INDEX_TEXT], embedding=embeddings, metadatas=[{"name": "Hello"}])
+			VectorMemoryCollection.save(db, folder_path, index_name)
+			faiss_db = VectorMemoryCollection.load(folder_path, embeddings, index_name, mmap)
 			log(f"{index_name} Loaded", 'INFO')
 			return faiss_db
 
+	@staticmethod
+	def load(folder_path: str, embeddings: Embeddings | None, index_name: str = "index", mmap: bool = False) -> FAISS:
+		"""
+		Same as `FAISS.load_local`, optionally memory-mapping the index file read-only.
+
+		The index and docstore files are replaced one after the other by `save`, so a load racing with a writer
+		may read a new index with an old docstore: it is detected and the load retried.
+		The mutations committed to the log of the index since its snapshot are then replayed.
+		"""
+		# the log is read first: if a checkpoint folds it into the snapshot meanwhile, replaying it again is harmless
+		records, position = mutation_log(folder_path, index_name).read()
+		mutations, position = committed_mutations(records, position)
+		if mutations and mmap:
+			# memory-mapped indexes are read-only, until the next checkpoint
+			mmap = False
+		format = docstore_format(folder_path, index_name)
+		index_path, mapping_path = index_files(folder_path, index_name, format)
+		io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+		for attempt in range(FAISS_LOAD_RETRIES):
+			index = faiss.read_index(index_path, io_flags)
+			if format == "sqlite":
+				# only the ids are loaded, documents are read from the docstore when searched for
+				index_to_docstore_id = dict(enumerate(np.load(mapping_path, allow_pickle=False).tolist()))
+				docstore = SQLiteDocstore(docstore_path(folder_path, index_name))
+			else:
+				with open(mapping_path, "rb") as f:
+					docstore, index_to_docstore_id = pickle.load(f)
+			if index.ntotal == len(index_to_docstore_id):
+				settings = IndexSettings.load(folder_path, index_name)
+				apply_search_params(index, settings)
+				ensure_direct_map(index)
+				exact_vectors = None
+				if settings.rerank and index_quantization(index) != "none":
+					exact_vectors = DeepAIFAISS.load_exact_vectors(folder_path, index_name, index.ntotal, index.d)
+				faiss_db = DeepAIFAISS(embeddings, index, docstore, index_to_docstore_id, exact_vectors=exact_vectors)
+				faiss_db.keyword_index = KeywordIndex.load(keyword_index_path(folder_path, index_name))
+				VectorMemoryCollection.replay(faiss_db, mutations)
+				faiss_db.wal_position = position
+				return faiss_db
+			log(f"FAISS index {index_name} is being written, retrying to load it", 'DEBUG')
+			time.sleep(0.1 * (attempt + 1))
+		raise ValueError(f"FAISS index {index_name} and its docstore do not match")
+
+	@staticmethod
+	def save(
+		faiss_db: FAISS,
+		folder_path: str,
+		index_name: str = "index",
+		write_index: bool = True,
+		format: str | None = None
+	):
+		"""
+		Same as `FAISS.save_local`, but the files are written aside and then atomically swapped in.
+		Processes which have mapped the previous files keep reading them until they reload.
+		The index keeps its docstore format, unless another `format` is given to convert it.
+		"""
+		os.makedirs(folder_path, exist_ok=True)
+		current_format = docstore_format(folder_path, index_name)
+		format = format or current_format
+		index_path, mapping_path = index_files(folder_path, index_name, format)
+		write_index = write_index or format != current_format or not os.path.exists(index_path)
+		if isinstance(faiss_db, DeepAIFAISS):
+			if write_index:
+				faiss_db.save_exact_vectors(folder_path, index_name)
+			# the keyword index is saved with every snapshot, loads then only replay the mutation log on it
+			faiss_db.keywords().save(keyword_index_path(folder_path, index_name))
+		suffix = f".{os.getpid()}.tmp"
+		if write_index:
+			faiss.write_index(faiss_db.index, index_path + suffix)
+
+		if format == "sqlite":
+			if not isinstance(faiss_db.docstore, SQLiteDocstore):
+				# SQLite documents are written as they are added, other docstores are copied once
+				docstore = SQLiteDocstore(docstore_path(folder_path, index_name))
+				documents = VectorMemoryCollection.documents(faiss_db)
+				docstore.delete(list(documents.keys()))
+				docstore.add(documents)
+				faiss_db.docstore = docstore
+			ids = [faiss_db.index_to_docstore_id[i] for i in range(len(faiss_db.index_to_docstore_id))]
+			with open(mapping_path + suffix, "wb") as f:
+				np.save(f, np.array(ids, dtype=str), allow_pickle=False)
+		else:
+			if isinstance(faiss_db.docstore, SQLiteDocstore):
+				faiss_db.docstore = InMemoryDocstore(faiss_db.docstore.all())
+			with open(mapping_path + suffix, "wb") as f:
+				pickle.dump((faiss_db.docstore, faiss_db.index_to_docstore_id), f)
+
+		if write_index:
+			os.replace(index_path + suffix, index_path)
+		os.replace(mapping_path + suffix, mapping_path)
+
+		if format != current_format:
+			# the mapping file of the previous format is what tells the format of an index, drop it
+			old_mapping_path = index_files(folder_path, index_name, current_format)[1]
+			if os.path.exists(old_mapping_path):
+				os.remove(old_mapping_path)
+			if current_format == "sqlite":
+				VectorMemoryCollection.delete_files(folder_path, index_name, [".docs.sqlite", ".docs.sqlite-wal", ".docs.sqlite-shm"])
+
+	@staticmethod
+	def replay(faiss_db: FAISS, mutations: list) -> int:
+		"""
+		Function to apply mutations of the log to the vectorstore. Additions already in the vectorstore are skipped,
+		so replaying mutations already part of the snapshot is harmless. Returns the number of mutations applied.
+		"""
+		if len(mutations) == 0:
+			return 0
+		mapped_ids = set(faiss_db.index_to_docstore_id.values())
+		applied = 0
+		for mutation in mutations:
+			if mutation.op == "add":
+				if mutation.ids[0] in mapped_ids:
+					continue
+				faiss_db.add_embeddings(list(zip(mutation.texts, mutation.vectors)), mutation.metadatas, ids=mutation.ids)
+				mapped_ids.update(mutation.ids)
+			elif mutation.op == "remove":
+				VectorMemoryCollection.remove(faiss_db, list(dict.fromkeys(mutation.ids)))
+			elif mutation.op == "clear":
+				VectorMemoryCollection.remove(faiss_db, None)
+				mapped_ids = set()
+			applied += 1
+		return applied
+
+	@staticmethod
+	def documents(vectorstore: FAISS) -> dict:
+		"""All the documents of a vectorstore by id, whatever its docstore."""
+		if isinstance(vectorstore.docstore, SQLiteDocstore):
+			return vectorstore.docstore.all()
+		return dict(vectorstore.docstore._dict)
+
+	@staticmethod
+	def delete_files(folder_path: str, index_name: str, suffixes: list[str] | None = None):
+		"""Function to delete the files of an index, all of them by default."""
+		suffixes = suffixes or [
+			".faiss", ".pkl", ".ids.npy", ".docs.sqlite", ".docs.sqlite-wal", ".docs.sqlite-shm", ".vectors.f32", ".index.json",
+			".keywords.npz", ".wal", ".wal.lock", ".namespaces.json", ".namespaces.json.lock"
+		]
+		for suffix in suffixes:
+			path = os.path.join(folder_path, f"{index_name}{suffix}")
+			if os.path.exists(path):
+				os.remove(path)
+
 	@staticmethod
 	def remove(vectorstore: FAISS, docstore_ids: Optional[List[str]]):
 		"""
@@ -96,37 +730,66 @@ class VectorMemoryCollection:
 				If there are duplicate ids in the list of ids to remove.
 		"""
 		if docstore_ids is None:
-			vectorstore.docstore = {}
-			vectorstore.index_to_docstore_id = {}
 			n_removed = vectorstore.index.ntotal
 			n_total = vectorstore.index.ntotal
+			vectorstore.docstore = InMemoryDocstore({})
+			vectorstore.index_to_docstore_id = {}
 			vectorstore.index.reset()
+			if isinstance(vectorstore, DeepAIFAISS):
+				vectorstore.clear_tombstones()
+				if vectorstore.has_exact_vectors:
+					vectorstore.set_exact_vectors(np.zeros((0, vectorstore.index.d), dtype=np.float32))
+				vectorstore.keyword_index = KeywordIndex()
+				vectorstore.metadata_index = MetadataIndex()
+				vectorstore.chunk_index = ChunkIndex()
 			return vectorstore, n_removed, n_total
 		set_ids = set(docstore_ids)
 		if len(set_ids) != len(docstore_ids):
 			raise ValueError("Duplicate ids in list of ids to remove.")
-		index_ids = [
-			i_id
-			for i_id, d_id in vectorstore.index_to_docstore_id.items()
-			if d_id in docstore_ids
-		]
-		n_removed = len(index_ids)
-		n_total = vectorstore.index.ntotal
-		vectorstore.index.remove_ids(np.array(index_ids, dtype=np.int64))
-		for i_id, d_id in zip(index_ids, docstore_ids):
-			del vectorstore.docstore._dict[
-				d_id
-			]  # remove the document from the docstore
-
-			del vectorstore.index_to_docstore_id[
-				i_id
-			]  # remove the index to docstore id mapping
-		vectorstore.index_to_docstore_id = {
-			i: d_id
-			for i, d_id in enumerate(vectorstore.index_to_docstore_id.values())
-		}
+
+		# vectorized lookup of the index positions of the ids
+		positions = np.fromiter(vectorstore.index_to_docstore_id.keys(), dtype=np.int64, count=len(vectorstore.index_to_docstore_id))
+		mapped_ids = np.array(list(vectorstore.index_to_docstore_id.values()), dtype=str)
+		mask = np.isin(mapped_ids, np.array(docstore_ids, dtype=str))
+		if isinstance(vectorstore, DeepAIFAISS):
+			# already removed ones are tombstones, no longer in the docstore
+			mask &= ~np.isin(positions, vectorstore.tombstones)
+		n_total = vectorstore.index.ntotal - len(getattr(vectorstore, "tombstones", ()))
+		n_removed = int(mask.sum())
+		if n_removed == 0:
+			return vectorstore, n_removed, n_total
+
+		vectorstore.docstore.delete(mapped_ids[mask].tolist())
+		if isinstance(vectorstore, DeepAIFAISS):
+			vectorstore.add_tombstones(positions[mask])
+			if vectorstore.keyword_index is not None:
+				vectorstore.keyword_index.remove(mapped_ids[mask].tolist())
+		else:
+			vectorstore.index.remove_ids(positions[mask])
+			vectorstore.index_to_docstore_id = dict(enumerate(mapped_ids[~mask].tolist()))
 		return vectorstore, n_removed, n_total
 
+	@staticmethod
+	def compact(vectorstore: DeepAIFAISS) -> int:
+		"""
+		Function to remove the tombstones from the index, shifting the following vectors down.
+		Returns the number of vectors removed.
+		"""
+		tombstones = vectorstore.tombstones
+		if len(tombstones) == 0:
+			return 0
+
+		n = len(vectorstore.index_to_docstore_id)
+		mapped_ids = np.array([vectorstore.index_to_docstore_id[i] for i in range(n)], dtype=str)
+		keep = np.ones(n, dtype=bool)
+		keep[tombstones] = False
+		remove_positions(vectorstore, tombstones)
+		vectorstore.index_to_docstore_id = dict(enumerate(mapped_ids[keep].tolist()))
+		if vectorstore.metadata_index is not None:
+			vectorstore.metadata_index.remove_positions(keep)
+		vectorstore.clear_tombstones()
+		return len(tombstones)
+
 	@staticmethod
 	def is_folder_empty(folder_path):
 		# Check if the folder exists
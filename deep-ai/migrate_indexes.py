@@ -0,0 +1,154 @@
+"""
+Convert the FAISS indexes of a storage folder to other index settings or docstore format:
+
+	python migrate_indexes.py --quantization sq8 --rerank
+	python migrate_indexes.py --quantization pq --folder /app/storage/common/ 1 2 3
+	python migrate_indexes.py --docstore sqlite
+	python migrate_indexes.py --benchmark
+
+Prints, for every index, its memory before and after, and its recall@k against exact search before and after.
+`--benchmark` compares the load time and memory of the pickle and sqlite docstore formats instead, on copies.
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import faiss
+import numpy as np
+
+# registers the dataclasses stored in the documents metadata
+import infrastructure.feishu  # noqa: F401
+from log import log
+from memory.ann_index import IndexSettings, index_kind, rebuild, recall_at_k, store_vectors
+from memory.index_cache import docstore_format, index_files
+from memory.mutation_log import mutation_log
+from memory.vector_memory import VectorMemoryCollection
+
+
+def index_names(folder_path: str) -> list[str]:
+	return sorted(
+		file[:-len(".faiss")]
+		for file in os.listdir(folder_path)
+		if file.endswith(".faiss") and os.path.exists(index_files(folder_path, file[:-len(".faiss")])[1])
+	)
+
+
+def migrate_index(folder_path: str, index_name: str, args) -> dict:
+	faiss_db = VectorMemoryCollection.load(folder_path, None, index_name)
+	before_bytes = os.path.getsize(index_files(folder_path, index_name)[0])
+	before_kind = index_kind(faiss_db.index)
+	before_recall = recall_at_k(faiss_db, store_vectors(faiss_db)) if faiss_db.index.ntotal > 0 else 1.0
+
+	settings = IndexSettings.load(folder_path, index_name)
+	if args.quantization is not None:
+		settings.quantization = args.quantization
+	if args.rerank is not None:
+		settings.rerank = args.rerank
+	if args.index_type is not None:
+		settings.index_type = args.index_type
+
+	report = {
+		"index": index_name,
+		"vectors": faiss_db.index.ntotal,
+		"before": before_kind,
+		"after": before_kind,
+		"before_bytes": before_bytes,
+		"after_bytes": before_bytes,
+		"before_recall": before_recall,
+		"after_recall": before_recall,
+	}
+	rebuilt_db = None
+	if settings.target(faiss_db.index.ntotal) != before_kind and faiss_db.index.ntotal > 0:
+		rebuilt_db, recall = rebuild(faiss_db, settings, index_name)
+		report.update({"after": index_kind(rebuilt_db.index), "after_recall": recall})
+		report["after_bytes"] = faiss.serialize_index(rebuilt_db.index).nbytes
+
+	if not args.dry_run and (rebuilt_db is not None or args.docstore not in (None, docstore_format(folder_path, index_name))):
+		if rebuilt_db is not None:
+			settings.save(folder_path, index_name)
+		migrated_db = rebuilt_db or faiss_db
+		mutations_log = mutation_log(folder_path, index_name)
+		with mutations_log.lock():
+			VectorMemoryCollection.save(migrated_db, folder_path, index_name, format=args.docstore)
+			mutations_log.truncate(migrated_db.wal_position)
+		report["after_bytes"] = os.path.getsize(index_files(folder_path, index_name)[0])
+	return report
+
+
+def benchmark_index(folder_path: str, index_name: str, queries: int = 20) -> dict:
+	"""Load time, memory allocated by the load and search time of both docstore formats, on copies of the index."""
+	faiss_db = VectorMemoryCollection.load(folder_path, None, index_name)
+	vectors = store_vectors(faiss_db)
+	query_vectors = vectors[np.random.default_rng(0).choice(len(vectors), min(queries, len(vectors)), replace=False)]
+
+	results = {"index": index_name, "vectors": faiss_db.index.ntotal}
+	with tempfile.TemporaryDirectory() as tmp_folder:
+		for format in ["pickle", "sqlite"]:
+			format_folder = os.path.join(tmp_folder, format)
+			VectorMemoryCollection.save(faiss_db, format_folder, index_name, format=format)
+
+			tracemalloc.start()
+			started_at = time.perf_counter()
+			loaded_db = VectorMemoryCollection.load(format_folder, None, index_name)
+			load_seconds = time.perf_counter() - started_at
+			_, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+
+			started_at = time.perf_counter()
+			for query in query_vectors:
+				loaded_db.similarity_search_with_score_by_vector(query.tolist(), k=4)
+			search_seconds = (time.perf_counter() - started_at) / max(1, len(query_vectors))
+			results[format] = {"load_seconds": load_seconds, "load_bytes": peak, "search_seconds": search_seconds}
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Convert FAISS indexes to other index settings or docstore format")
+	parser.add_argument("indexes", nargs="*", help="index names, all the indexes of the folder by default")
+	parser.add_argument("--folder", default=os.getenv("COMMON_STORAGE"), help="storage folder, COMMON_STORAGE by default")
+	parser.add_argument("--quantization", choices=["none", "sq8", "pq"], default=None)
+	parser.add_argument("--rerank", action=argparse.BooleanOptionalAction, default=None, help="keep the float32 vectors on disk to re-rank results")
+	parser.add_argument("--index-type", choices=["auto", "flat", "ivf", "hnsw"], default=None)
+	parser.add_argument("--docstore", choices=["pickle", "sqlite"], default=None, help="convert the docstore format")
+	parser.add_argument("--dry-run", action="store_true", help="report without writing the indexes")
+	parser.add_argument("--benchmark", action="store_true", help="compare the docstore formats, without converting")
+	args = parser.parse_args()
+
+	if not args.folder:
+		parser.error("--folder is required when COMMON_STORAGE is not set")
+
+	if args.benchmark:
+		print(f"{'index':<40} {'vectors':>10} {'format':>8} {'load ms':>10} {'load MB':>10} {'search ms':>10}")
+		for index_name in args.indexes or index_names(args.folder):
+			r = benchmark_index(args.folder, index_name)
+			for format in ["pickle", "sqlite"]:
+				print(
+					f"{r['index']:<40} {r['vectors']:>10} {format:>8} {r[format]['load_seconds'] * 1000:>10.1f} "
+					f"{r[format]['load_bytes'] / 2 ** 20:>10.1f} {r[format]['search_seconds'] * 1000:>10.2f}"
+				)
+		return
+
+	total_before, total_after = 0, 0
+	print(f"{'index':<40} {'vectors':>10} {'before':>16} {'after':>16} {'MB before':>10} {'MB after':>10} {'recall':>15}")
+	for index_name in args.indexes or index_names(args.folder):
+		try:
+			r = migrate_index(args.folder, index_name, args)
+		except Exception as e:
+			log(f"Failed to migrate FAISS index {index_name}: {e}", "ERROR")
+			continue
+		total_before += r["before_bytes"]
+		total_after += r["after_bytes"]
+		print(
+			f"{r['index']:<40} {r['vectors']:>10} {'/'.join(r['before']):>16} {'/'.join(r['after']):>16} "
+			f"{r['before_bytes'] / 2 ** 20:>10.1f} {r['after_bytes'] / 2 ** 20:>10.1f} "
+			f"{r['before_recall']:>6.3f} -> {r['after_recall']:.3f}"
+		)
+
+	saved = total_before - total_after
+	print(f"Index memory: {total_before / 2 ** 20:.1f} MB -> {total_after / 2 ** 20:.1f} MB, {saved / 2 ** 20:.1f} MB saved")
+
+
+if __name__ == "__main__":
+	main()
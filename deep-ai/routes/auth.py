@@ -386,7 +386,6 @@ async def update_user(
 	payload: UpdateUserPayload,
 	db: Session = Depends(get_db_session)
 ):
-	bot = get_bot(request.app.state.bot)
 	try:
 		if not payload.id:
 			raise ValueError('id should not be None')
@@ -398,12 +397,9 @@ async def update_user(
 		if instance is None:
 			raise ValueError('User not exists')
 
+		# the model of the user is loaded by each of its chats
 		updated_instance = crud_user.update_user(db, instance, payload.fields)
 
-		if 'model' in payload.fields:
-			model_name = payload.fields['model']
-			bot.rebuild_llm_embedder(model_name)
-
 		return ApiResponse(status=Status.SUCCESS, message='', data=UserPayload.from_orm(updated_instance))
 	except ValueError as e:
 		return ApiResponse(status=Status.ERROR, message=str(e), data=None)
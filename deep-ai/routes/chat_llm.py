@@ -36,7 +36,7 @@ async def chat(
 		raise ValueError("ai_mode is required")
 
 	model = payload['model'] if 'model' in payload else current_user.model
-	llm, _ = bot.rebuild_llm_embedder(model)
+	llm = bot.language_model(model)
 	raw_messages = payload['messages']
 	log(f'Model: {model}')
 	log(f"Messages: {json.dumps(raw_messages, indent=4, ensure_ascii=False)}")
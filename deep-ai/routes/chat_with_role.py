@@ -58,7 +58,7 @@ def ask(
 
 		model = current_user.model if request.model is None else request.model
 		log(f'Model: {model}')
-		bot.rebuild_llm_embedder(model)
+		llm = bot.language_model(model)
 		log(f"Request: {request.dict(exclude={'messages'})}")
 		raw_messages = build_memory(request.messages, instance.description)
 		messages: list[BaseMessage] = []
@@ -75,7 +75,7 @@ def ask(
 				MessagesPlaceholder(variable_name="messages"),
 			]
 		)
-		chain = prompt | bot.llm | StrOutputParser()
+		chain = prompt | llm | StrOutputParser()
 		chain = config_user_metadata_chain(chain, current_user)
 		response = chain.stream({"messages": messages})
 
@@ -37,7 +37,7 @@ async def revision_text(
 		raise ValueError("text is required")
 
 	model = payload['model'] if 'model' in payload else current_user.model
-	llm, _ = bot.rebuild_llm_embedder(model)
+	llm = bot.language_model(model)
 	text = payload['text']
 	log(f'Model: {model}')
 	log(f"Original Text: {text}")
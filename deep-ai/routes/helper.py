@@ -1,4 +1,5 @@
 import asyncio
+import json
 import random
 import string
 from typing import List, Any, Dict
@@ -62,6 +63,11 @@ async def generate(answer: str, delay: float = 0.08):
 		await asyncio.sleep(delay)
 
 
+def sse_event(event: str, data: Any) -> str:
+	"""A server-sent event, its data JSON encoded: tokens may contain new lines."""
+	return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 def get_bot(bot):
 	if isinstance(bot, DeepAI):
 		return bot
@@ -1,4 +1,3 @@
-import os
 from typing import Annotated, Optional
 
 from fastapi import APIRouter, Depends, Request
@@ -8,6 +7,10 @@ from sqlmodel import Session
 from db import models, crud_knowledgebase, crud_vectordocrecord, crud_chathistorymeta
 from db.database import get_db_session
 from log import log
+from memory.ann_index import IndexSettings, index_promoter, index_type
+from memory.index_cache import index_cache
+from memory.index_namespace import index_namespaces, namespaced_index
+from memory.vector_memory import VectorMemoryCollection
 from response import Status, ApiResponse, AiMode
 from routes.auth import get_current_active_user
 from routes.helper import get_bot
@@ -51,6 +54,53 @@ async def get_use_plugins(
 		return ApiResponse(status=Status.ERROR, message=str(e), data=None)
 
 
+@router.get("/index-settings/{knowledge_base_id}")
+async def get_index_settings(
+	_: Annotated[models.User, Depends(get_current_active_user)],
+	request: Request,
+	knowledge_base_id: str,
+):
+	try:
+		bot = get_bot(request.app.state.bot)
+		settings = IndexSettings.load(bot.common_storage, knowledge_base_id)
+		faiss_db = bot.memory.vectors.faiss_db(knowledge_base_id, bot.common_storage)
+		data = {
+			**settings.dict(),
+			"current_index_type": index_type(faiss_db.index),
+			"ntotal": faiss_db.index.ntotal,
+		}
+		return ApiResponse(status=Status.SUCCESS, message='', data=data)
+	except ValueError as e:
+		return ApiResponse(status=Status.ERROR, message=str(e), data=None)
+	except Exception as e:
+		return ApiResponse(status=Status.ERROR, message=str(e), data=None)
+
+
+@router.post("/index-settings/{knowledge_base_id}")
+async def update_index_settings(
+	_: Annotated[models.User, Depends(get_current_active_user)],
+	request: Request,
+	knowledge_base_id: str,
+	payload: IndexSettings,
+):
+	try:
+		bot = get_bot(request.app.state.bot)
+		payload.save(bot.common_storage, knowledge_base_id)
+		# reload with the new search parameters the indexes of every embedder, and rebuild if the index type changed
+		for namespace in index_namespaces(bot.common_storage, knowledge_base_id):
+			index_name = namespaced_index(knowledge_base_id, namespace)
+			index_cache.invalidate(bot.common_storage, index_name)
+			index_promoter.reset(bot.common_storage, index_name)
+		index_name = bot.memory.vectors.index_name(knowledge_base_id)
+		faiss_db = bot.memory.vectors.faiss_db(index_name, bot.common_storage)
+		index_promoter.maybe_schedule(bot.memory.vectors, faiss_db, index_name, bot.common_storage)
+		return ApiResponse(status=Status.SUCCESS, message='', data=payload)
+	except ValueError as e:
+		return ApiResponse(status=Status.ERROR, message=str(e), data=None)
+	except Exception as e:
+		return ApiResponse(status=Status.ERROR, message=str(e), data=None)
+
+
 @router.post("/create")
 async def create(
 	current_user: Annotated[models.User, Depends(get_current_active_user)],
@@ -125,13 +175,12 @@ async def delete(
 		log(f"delete related table chat_history_meta records by knowledge_base_id ${knowledge_base_id} in mysql", 'DEBUG')
 		crud_chathistorymeta.delete_chat_history_meta_by_knowledge_base_id(db, knowledge_base_id)
 
-		log(f"delete related vector store file '${knowledge_base_id}.faiss' and '${knowledge_base_id}.pkl'", 'DEBUG')
-		faiss_file_path = f"{os.path.join(bot.common_storage, knowledge_base_id)}.faiss"
-		pkl_file_path = f"{os.path.join(bot.common_storage, knowledge_base_id)}.pkl"
-		if os.path.exists(faiss_file_path):
-			os.remove(faiss_file_path)
-		if os.path.exists(pkl_file_path):
-			os.remove(pkl_file_path)
+		log(f"delete related vector store files '${knowledge_base_id}.*' and '${knowledge_base_id}@*.*'", 'DEBUG')
+		for namespace in index_namespaces(bot.common_storage, knowledge_base_id):
+			index_name = namespaced_index(knowledge_base_id, namespace)
+			VectorMemoryCollection.delete_files(bot.common_storage, index_name)
+			index_cache.invalidate(bot.common_storage, index_name)
+		VectorMemoryCollection.delete_files(bot.common_storage, knowledge_base_id)
 
 		log(f"delete knowledge base by id ${knowledge_base_id} in mysql and redis", 'DEBUG')
 		crud_knowledgebase.delete_knowledge_base_by_knowledge_base_id(db, knowledge_base_id)
@@ -1,4 +1,6 @@
 import mimetypes
+import traceback
+import uuid
 from typing import TypedDict, List, Annotated, Any
 
 from fastapi import APIRouter, Body, UploadFile, Depends, Form, Response, BackgroundTasks
@@ -6,13 +8,15 @@ from fastapi import Request
 from fastapi.responses import StreamingResponse
 from langchain_community.callbacks import get_openai_callback
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from db import models, crud_vectordocrecord
 from db.database import get_db_session
+from factory.embedding_scheduler import embedding_scheduler
 from log import log
 from response import Status, ApiResponse
 from routes.auth import get_current_active_user
-from routes.helper import generate, get_bot
+from routes.helper import generate, get_bot, sse_event
 from routes.types import UserMessage
 
 router = APIRouter()
@@ -98,11 +102,10 @@ def ingest_text(current_user: Annotated[models.User, Depends(get_current_active_
 								text: str = Body(embed=True)):
 	try:
 		bot = get_bot(request.app.state.bot)
-		faiss_db = bot.memory.vectors.faiss_db(current_user.id.__str__())
-		db = faiss_db.from_texts([text], bot.embedder)
+		embeddings = embedding_scheduler.embed_documents(bot.embedder, [text])
 
-		faiss_db.merge_from(db)
-		faiss_db.save_local(bot.common_storage, current_user.id.__str__())
+		with bot.memory.vectors.transaction(current_user.id.__str__()) as transaction:
+			transaction.add_embeddings(list(zip([text], embeddings)))
 		return ApiResponse(status=Status.SUCCESS, message='', data=None)
 	except Exception as e:
 		return ApiResponse(status=Status.ERROR, message=e.__str__(), data=None)
@@ -120,12 +123,16 @@ async def async_ask_bot(
 		log(f'Model: {current_user.model}')
 
 		bot = get_bot(request.app.state.bot)
-		bot.rebuild_llm_embedder(current_user.model)
-		# Used for tools `get_my_user_information`
-		bot.email = current_user.email
 
+		if isinstance(message.knowledge_base_id, list):
+			knowledge_base_id = [str(_id) for _id in message.knowledge_base_id]
+		else:
+			knowledge_base_id = str(message.knowledge_base_id)
+
+		# the model and the user of this chat, never the ones of the bot shared by the requests
+		context = bot.chat_context(knowledge_base_id, current_user.model, current_user)
 		with get_openai_callback() as cb:
-			answer = bot(message.__dict__, message.knowledge_base_id.__str__())
+			answer = bot(message.__dict__, knowledge_base_id, context=context)
 			log(cb)
 
 		answer["content"] = answer["content"].strip('\'"')
@@ -135,3 +142,50 @@ async def async_ask_bot(
 		return StreamingResponse(generate(str(ve)), media_type="text/event-stream")
 	except Exception as e:
 		return StreamingResponse(generate(str(e)), media_type="text/event-stream")
+
+
+@router.post("/stream-ask-bot")
+async def stream_ask_bot(
+	current_user: Annotated[models.User, Depends(get_current_active_user)],
+	request: Request,
+	message: UserMessage,
+	_: Session = Depends(get_db_session),
+):
+	"""
+	Same chat as `async-ask-bot`, the answer sent as server-sent events: `message` events with the tokens of the LLM
+	as they arrive (see `DeepAI.astream`), then a `refs` event with the Feishu documents the answer is based on, or an `error` event.
+	"""
+	log(f"\n==========Stream local AI User email: {current_user.email}==========\n")
+	log(f'Model: {current_user.model}')
+
+	bot = get_bot(request.app.state.bot)
+	if isinstance(message.knowledge_base_id, list):
+		knowledge_base_id = [str(_id) for _id in message.knowledge_base_id]
+	else:
+		knowledge_base_id = str(message.knowledge_base_id)
+	refs_uuid = str(uuid.uuid4())
+
+	async def event_generator():
+		try:
+			# building the models of the user may block: in the thread pool, the chat itself is async
+			context = await run_in_threadpool(bot.chat_context, knowledge_base_id, current_user.model, current_user)
+			async for chunk in bot.astream(message.__dict__, knowledge_base_id, refs_uuid, context=context):
+				if isinstance(chunk, dict):
+					# fast reply of a hook, or output of a tool returning directly
+					yield sse_event("message", chunk.get("output") or "")
+					continue
+				# message chunks of chat models, strings of completion models
+				token = getattr(chunk, "content", chunk)
+				if token:
+					yield sse_event("message", token)
+			yield sse_event("refs", {"refs_uuid": refs_uuid, "refs": context.working_memory.get("refs", [])})
+		except Exception as e:
+			traceback.print_exc()
+			yield sse_event("error", str(e))
+
+	return StreamingResponse(
+		event_generator(),
+		media_type="text/event-stream",
+		# proxies must not buffer the events
+		headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+	)
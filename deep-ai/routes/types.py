@@ -19,7 +19,8 @@ class ChatHistory(BaseModel):
 
 class UserMessage(BaseModel):
 	text: str
-	knowledge_base_id: str
+	# several knowledge bases are searched together, e.g. the user's and the global ones
+	knowledge_base_id: str | list[str]
 	chat_history: list[ChatHistory]
 
 
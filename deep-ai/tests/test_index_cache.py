@@ -0,0 +1,88 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from langchain_community.embeddings import FakeEmbeddings
+
+from memory.index_cache import index_cache
+from memory.mutation_log import Mutation, MutationTransaction, mutation_log
+from memory.vector_memory import VectorMemory
+
+
+class Bot:
+	def __init__(self, embedder):
+		self.embedder = embedder
+
+
+class IndexCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.folder_path = tempfile.mkdtemp()
+		self.embedder = FakeEmbeddings(size=8)
+		self.vector_memory = VectorMemory(Bot(self.embedder))
+		self.vector_memory.common_storage = self.folder_path
+
+	def add(self, transaction, text):
+		return transaction.add_embeddings([(text, self.embedder.embed_query(text))])
+
+	def test_transactions_do_not_reload_the_index(self):
+		self.vector_memory.faiss_db("kb")
+		loads = index_cache.stats()["loads"]
+
+		for i in range(3):
+			with self.vector_memory.transaction("kb") as transaction:
+				self.add(transaction, f"document {i}")
+				# readers keep the cached version while the transaction is open
+				self.vector_memory.faiss_db("kb")
+
+		faiss_db = self.vector_memory.faiss_db("kb")
+		self.assertEqual(index_cache.stats()["loads"], loads)
+		# the document the index is created with, and the 3 added
+		self.assertEqual(len(faiss_db.index_to_docstore_id), 4)
+
+	def test_removals_share_the_vectors_of_the_previous_version(self):
+		with self.vector_memory.transaction("kb") as transaction:
+			ids = self.add(transaction, "document")
+		previous = self.vector_memory.faiss_db("kb")
+
+		with self.vector_memory.transaction("kb") as transaction:
+			transaction.remove(ids)
+
+		faiss_db = self.vector_memory.faiss_db("kb")
+		self.assertIsNot(faiss_db, previous)
+		self.assertIs(faiss_db.index, previous.index)
+		# the previous version still finds the removed document
+		self.assertEqual(len(previous.find_tombstones()), 0)
+		self.assertEqual(len(faiss_db.tombstones), 1)
+
+	def test_transaction_failing_to_apply_is_rolled_back(self):
+		with mock.patch.object(self.vector_memory, "apply_mutations", side_effect=OSError("disk full")):
+			with self.assertRaises(OSError):
+				with self.vector_memory.transaction("kb") as transaction:
+					ids = self.add(transaction, "document")
+
+		# the next transaction applies the committed one and its rollback
+		with self.vector_memory.transaction("kb") as transaction:
+			self.add(transaction, "other document")
+		faiss_db = self.vector_memory.faiss_db("kb")
+		documents = faiss_db.docstore._dict
+		self.assertNotIn(ids[0], documents)
+		self.assertEqual(len(faiss_db.tombstones), 1)
+
+	def test_commit_of_another_process_reloads_the_index(self):
+		self.vector_memory.faiss_db("kb")
+		loads = index_cache.stats()["loads"]
+
+		# a transaction this process does not know about
+		transaction = MutationTransaction(mutation_log(self.folder_path, self.vector_memory.index_name("kb")))
+		self.add(transaction, "document")
+		self.vector_memory.faiss_db("kb")
+		self.assertEqual(index_cache.stats()["loads"], loads)
+
+		transaction.log.append([Mutation("commit", transaction.id)])
+		faiss_db = self.vector_memory.faiss_db("kb")
+		self.assertEqual(index_cache.stats()["loads"], loads + 1)
+		self.assertEqual(len(faiss_db.index_to_docstore_id), 2)
+
+
+if __name__ == "__main__":
+	unittest.main()